@@ -0,0 +1,443 @@
+#!/usr/bin/env python2.7
+
+import os
+import time
+import json
+import random
+import shutil
+import urllib2
+import tempfile
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import utils
+import fetchers
+from main import CoreSEQUENCE
+from main import main_handler
+from metrics import cpu_time
+from fetchers import fetch_variants_from_ensembl_rest
+from tables import serialize_table
+from scheduler import RequestScheduler
+from stub import StubData
+from stub import start_stub
+from stub import use_servers
+from parsers import iter_uniprot_txt_entries
+from library import aa_symbols_rev_ext
+
+from utils import flash
+from utils import set_request_scheduler
+from utils import set_response_cache
+
+
+def synthetic_sequence(length, seed=0):
+    """
+    Gets a random protein sequence.
+
+    @param length: sequence length
+    @param seed: random seed
+    @return: returns a sequence str()
+    """
+
+    rand = random.Random(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+
+    return "".join([rand.choice(residues) for i in range(length)])
+
+
+def synthetic_variants(sequence, count, prefix="rs", feature_type="transcript_variation", seed=0):
+    """
+    Gets random missense variants for a sequence, with the same
+    keys as the ones loaded by fetch_variants_from_ensembl_rest.
+
+    @param sequence: protein sequence
+    @param count: number of variants
+    @param prefix: variant id prefix ("rs" or "COSM")
+    @param feature_type: Ensembl feature type
+    @param seed: random seed
+    @return: returns a list of variants
+    """
+
+    rand = random.Random(seed)
+    residues = "ACDEFGHIKLMNPQRSTVWY"
+    variants = []
+    for i in range(count):
+        vsite = rand.randint(1, len(sequence) - 1)
+        vres1 = aa_symbols_rev_ext[sequence[vsite - 1]]
+        vres2 = aa_symbols_rev_ext[rand.choice(residues)]
+        variant = OrderedDict()
+        variant["VARIATION"] = "p.%s%s%s" % (vres1, vsite, vres2)
+        variant["SITE"] = str(vsite)
+        variant["RES1"] = vres1
+        variant["RES2"] = vres2
+        variant["SOURCE"] = "%s%s" % (prefix, i + 1)
+        variant["FEATURE_TYPE"] = feature_type
+        variants.append(variant)
+
+    return variants
+
+
+def synthetic_core_sequence(length, nvariants, nmutations, seed=0):
+    """
+    Gets a CoreSEQUENCE object loaded with a synthetic protein,
+    so the per-residue stages can be run without network access.
+
+    @param length: sequence length
+    @param nvariants: number of variants
+    @param nmutations: number of mutations
+    @param seed: random seed
+    @return: returns a CoreSEQUENCE object
+    """
+
+    sequence = CoreSEQUENCE(None, db=False, form="", verbose=False)
+    sequence.identifier = "P99999"
+    sequence.uniprot_fasta = True
+    sequence.uniprot_txt = True
+    sequence.sequence = synthetic_sequence(length, seed=seed)
+    sequence.information = OrderedDict([("SEQUENCE", sequence.sequence)])
+    sequence.variants = synthetic_variants(sequence.sequence, nvariants, prefix="rs", seed=seed)
+    sequence.mutations = synthetic_variants(sequence.sequence, nmutations, prefix="COSM",
+                                            feature_type="somatic_transcript_variation", seed=seed + 1)
+    sequence.entities = None
+    sequence.residues = None
+    sequence.summary = None
+    sequence.table = None
+    sequence.set_stage("information", sequence.information)
+    sequence.set_stage("variations", (sequence.variants, sequence.mutations))
+
+    return sequence
+
+
+def scan_entities(sequence, variants, mutations):
+    """
+    Reference per-residue entities built by scanning the full variant
+    lists for every residue (as done before the site index).
+
+    @param sequence: protein sequence
+    @param variants: list of variants
+    @param mutations: list of mutations
+    @return: returns a dictionary of entities
+    """
+
+    res_entries = OrderedDict()
+    for i in range(len(sequence)):
+        site = str(i + 1)
+        res = OrderedDict()
+        res["VARIANTS"] = [var["SOURCE"] for var in variants if var["SITE"] == site]
+        res["MUTATIONS"] = [var["SOURCE"] for var in mutations if var["SITE"] == site]
+        res_entries[site] = res
+
+    return res_entries
+
+
+def benchmark_site_index(length=5000, nvariants=5000, nmutations=2000, scan=True, verbose=True):
+    """
+    Times the per-residue stages (entities, residues and summary) on a
+    synthetic protein, including their JSON serialization (when the per
+    residue entries are created), against the full scan reference.
+
+    @param length: sequence length
+    @param nvariants: number of variants
+    @param nmutations: number of mutations
+    @param scan: Boolean also times the full scan reference
+    @param verbose: Boolean
+    @return: returns a dictionary of timings (in seconds)
+    """
+
+    sequence = synthetic_core_sequence(length, nvariants, nmutations)
+    timings = OrderedDict()
+
+    start = time.time()
+    entities = sequence.get_entities()
+    timings["entities"] = time.time() - start
+
+    start = time.time()
+    residues = sequence.get_residues()
+    timings["residues"] = time.time() - start
+
+    start = time.time()
+    json.dumps(entities, default=serialize_table)
+    json.dumps(residues, default=serialize_table)
+    timings["serialize"] = time.time() - start
+
+    start = time.time()
+    sequence.get_summary()
+    timings["summary"] = time.time() - start
+
+    if scan:
+        start = time.time()
+        reference = scan_entities(sequence.sequence, sequence.variants, sequence.mutations)
+        timings["entities_scan"] = time.time() - start
+        assert reference == entities
+        timings["speedup"] = timings["entities_scan"] / max(timings["entities"], 1e-9)
+
+    if verbose:
+        flash("Site index (%s residues, %s variants, %s mutations): %s" %
+              (length, nvariants, nmutations, ", ".join(["%s=%.3f" % (key, timings[key]) for key in timings])))
+
+    return timings
+
+
+def scan_ensembl_from_uniprot(identifier, txt_object):
+    """
+    Reference Ensembl cross-references parsed by scanning every line of an
+    entry, with list de-duplication (as done before the streaming parser).
+
+    @param identifier: UniProt ID
+    @param txt_object: UniProt txt lines object
+    @return: returns ensembl gene, transcript and protein identifiers
+    """
+
+    ensemblg = []
+    ensemblt = []
+    ensemblp = []
+
+    for line in txt_object:
+        if "DR   Ensembl;" in line[0:14]:
+            skip = False
+            line = line.rstrip("\r\n")
+            line = line.split(";")
+            enst = line[1].strip()
+            ensp = line[2].strip()
+            ensg = line[3].strip()
+
+            if "[" in ensg:
+                ensg = ensg.split()
+                uni = ensg[1][1:-1]
+                if "%s" % identifier == uni:
+                    ensg = ensg[0].rstrip(".")
+                elif "%s-1" % identifier == uni:
+                    ensg = ensg[0].rstrip(".")
+                else:
+                    skip = True
+            else:
+                ensg = ensg.rstrip(".")
+
+            if not skip:
+                if ensg not in ensemblg:
+                    ensemblg.append(ensg)
+                if enst not in ensemblt:
+                    ensemblt.append(enst)
+                if ensp not in ensemblp:
+                    ensemblp.append(ensp)
+
+    return ensemblg, ensemblt, ensemblp
+
+
+def benchmark_uniprot_txt(dat_path, scan=True, verbose=True):
+    """
+    Times the streaming UniProt txt parser over a multi-entry flat file
+    (e.g. a full Swiss-Prot uniprot_sprot.dat), against the reference
+    that loads every entry into a list of lines and scans all of them.
+    The Ensembl cross-references of both must be the same.
+
+    @param dat_path: path to a UniProt flat file
+    @param scan: Boolean also times the reference
+    @param verbose: Boolean
+    @return: returns a dictionary of timings (in seconds)
+    """
+
+    timings = OrderedDict()
+
+    start = time.time()
+    streamed = []
+    with open(dat_path) as inputfile:
+        for entry in iter_uniprot_txt_entries(inputfile, features=False, checksum=False):
+            streamed.append((entry["ENSEMBL_GENE"], entry["ENSEMBL_TRANSCRIPT"], entry["ENSEMBL_PROTEIN"]))
+    timings["entries"] = len(streamed)
+    timings["stream"] = time.time() - start
+
+    # header, cross-references, features and checksum
+    start = time.time()
+    with open(dat_path) as inputfile:
+        for entry in iter_uniprot_txt_entries(inputfile):
+            pass
+    timings["stream_full"] = time.time() - start
+
+    if scan:
+        start = time.time()
+        scanned = []
+        with open(dat_path) as inputfile:
+            lines = []
+            for line in inputfile:
+                lines.append(line)
+                if line.startswith("//"):
+                    identifier = lines[1][5:].split(";")[0].strip()
+                    scanned.append(scan_ensembl_from_uniprot(identifier, lines))
+                    lines = []
+        timings["scan"] = time.time() - start
+        assert scanned == streamed
+        timings["speedup"] = timings["scan"] / max(timings["stream"], 1e-9)
+
+    if verbose:
+        flash("UniProt txt (%s): %s" % (dat_path, ", ".join(["%s=%.3f" % (key, timings[key]) for key in timings])))
+
+    return timings
+
+
+def stub_stats(url, reset=False):
+    """
+    Gets the traffic counters of a stub server (see stub.StubServer).
+
+    @param url: stub server URL
+    @param reset: Boolean also resets the counters
+    @return: returns a dictionary with requests, bytes received and sent
+    """
+
+    stats = json.loads(urllib2.urlopen(url + "/_stats").read(), object_pairs_hook=OrderedDict)
+    if reset:
+        urllib2.urlopen(url + "/_reset").read()
+
+    return stats
+
+
+@contextmanager
+def offline_environment(data):
+    """
+    Runs a block against a stub server (in its own process), in an empty
+    working directory and with no rate limit or response cache, so runs
+    are reproducible and need no network access.
+
+    @param data: stub.StubData object
+    @return: yields the stub server URL
+    """
+
+    process, url = start_stub(data)
+    previous = use_servers(url, url + "/uniprotkb")
+    scheduler = utils.request_scheduler
+    cache = utils.response_cache
+    set_request_scheduler(RequestScheduler(rate=None))
+    set_response_cache(None)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="benchmark")
+    os.chdir(workdir)
+    with fetchers.transcript_genes_lock:
+        fetchers.transcript_genes.clear()
+    try:
+        yield url
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        use_servers(*previous)
+        set_request_scheduler(scheduler)
+        set_response_cache(cache)
+        process.terminate()
+        process.join()
+
+
+def measure(url, function, *args, **kwargs):
+    """
+    Runs a function, measuring its wall time, CPU time and the requests
+    and bytes it exchanged with the stub server.
+
+    @param url: stub server URL
+    @param function: function to run
+    @return: returns the function output and a dictionary of measures
+    """
+
+    stub_stats(url, reset=True)
+    start = time.time()
+    cpu = cpu_time()
+    output = function(*args, **kwargs)
+    measures = OrderedDict()
+    measures["wall"] = time.time() - start
+    measures["cpu"] = cpu_time() - cpu
+    stats = stub_stats(url)
+    measures["requests"] = stats["requests"]
+    measures["bytes"] = stats["bytes_received"] + stats["bytes_sent"]
+
+    return output, measures
+
+
+def benchmark_pipeline(data, identifiers, workers=1, verbose=True):
+    """
+    Times main_handler end to end for each identifier, and then each
+    CoreSEQUENCE stage on its own (stages run one at a time, in the
+    stage graph order), against a stub server.
+
+    @param data: stub.StubData object (with the identifiers' entries)
+    @param identifiers: list of UniProt accessions
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param verbose: Boolean
+    @return: returns a dictionary of measures (wall, cpu, requests, bytes) per identifier
+    """
+
+    report = OrderedDict()
+    with offline_environment(data) as url:
+        for identifier in identifiers:
+            measures = OrderedDict()
+            information, measures["main_handler"] = measure(url, main_handler, identifier, workers=workers,
+                                                            form="", verbose=False)
+            # the UniProt files are now in Data/, as in any later run
+            shutil.rmtree("Data")
+            with fetchers.transcript_genes_lock:
+                fetchers.transcript_genes.clear()
+
+            sequence = CoreSEQUENCE(identifier, db=False, workers=workers, form="", verbose=False)
+            stages = OrderedDict()
+            for name in sequence.stage_graph:
+                output, stages[name] = measure(url, sequence.stage, name)
+            # the per residue entries are created when serialized
+            output, stages["serialize"] = measure(url, json.dumps, information, default=serialize_table)
+            measures["stages"] = stages
+            report[identifier] = measures
+
+            if verbose:
+                flash("Pipeline %s: %s" % (identifier, format_measures(measures["main_handler"])))
+                for name in stages:
+                    flash("    %s: %s" % (name, format_measures(stages[name])))
+
+    return report
+
+
+def benchmark_fetcher(data, identifier, workers=1, verbose=True):
+    """
+    Times fetch_variants_from_ensembl_rest (variants and mutations, in a
+    single pass) for an identifier, against a stub server.
+
+    @param data: stub.StubData object (with the identifier entry)
+    @param identifier: UniProt accession
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param verbose: Boolean
+    @return: returns a dictionary of measures (wall, cpu, requests, bytes)
+    """
+
+    with offline_environment(data) as url:
+        sequence = CoreSEQUENCE(identifier, db=False, form="", verbose=False)
+        sequence.get_information()
+        variants, measures = measure(url, fetch_variants_from_ensembl_rest, identifier, sequence.sequence,
+                                     sequence.species, sequence.ensemblg, sequence.ensemblt, sequence.ensemblp,
+                                     method="ALL", workers=workers, form="", verbose=False)
+        measures["variants"] = len(variants)
+
+    if verbose:
+        flash("Fetcher %s (%s transcripts, %s workers): %s" %
+              (identifier, len(sequence.ensemblt), workers, format_measures(measures)))
+
+    return measures
+
+
+def format_measures(measures):
+    """Formats a dictionary of measures for printing"""
+
+    return ", ".join(["%s=%.3f" % (key, measures[key]) if isinstance(measures[key], float) else
+                      "%s=%s" % (key, measures[key]) for key in measures])
+
+
+if __name__ == "__main__":
+    import sys
+
+    # benchmarking routines
+    if len(sys.argv) > 1:
+        # e.g. python benchmarks.py uniprot_sprot.dat
+        benchmark_uniprot_txt(sys.argv[1])
+    benchmark_site_index(length=5000, nvariants=5000, nmutations=2000)
+    # titin sized protein (the full scan would take minutes)
+    benchmark_site_index(length=35000, nvariants=30000, nmutations=10000, scan=False)
+
+    # end to end, against a local stub server (no network access)
+    data = StubData(variants=2000)
+    data.add_fixture("P00439")
+    data.add_synthetic("Q99999", 35000, transcripts=8)
+    benchmark_pipeline(data, ["P00439", "Q99999"])
+    benchmark_fetcher(data, "Q99999", workers=1)
+    benchmark_fetcher(data, "Q99999", workers=4)
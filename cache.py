@@ -0,0 +1,365 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from urlparse import urlsplit
+from urlparse import urlunsplit
+
+
+def normalize_url(url, data=None):
+    """
+    Normalizes a URL so equivalent requests share the same cache key:
+    scheme and host are lower-cased and the query parameters (';' or '&'
+    separated) are sorted. A POST body is appended in canonical JSON.
+
+    @param url: input URL
+    @param data: optional object POSTed as a JSON body
+    @return: returns the normalized URL str()
+    """
+
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = [param for param in query.replace("&", ";").split(";") if param != ""]
+    query = ";".join(sorted(params))
+    normalized = urlunsplit((scheme.lower(), netloc.lower(), path, query, ""))
+    if data is not None:
+        normalized += " " + json.dumps(data, sort_keys=True)
+
+    return normalized
+
+
+class ResponseCache(object):
+    """
+    Persistent on-disk cache of HTTP response bodies, keyed by normalized
+    URL. Entries expire after a TTL and the least recently used ones are
+    evicted once the cache grows over its maximum size. Writes are atomic
+    (temporary file + rename) so several threads or processes can share
+    the same cache directory.
+    """
+
+    def __init__(self, directory="Cache", ttl=7 * 24 * 3600, max_size=1024 * 1024 * 1024):
+        """
+        Init method.
+
+        @param directory: cache directory (created if needed)
+        @param ttl: time to live of each entry, in seconds (None never expires)
+        @param max_size: maximum size of the cache, in bytes (None is unbounded)
+        """
+
+        self.directory = os.path.abspath(directory)
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created meanwhile by another worker
+                pass
+        self.size = sum(size for path, size, atime in self.entries())
+
+        return
+
+    def path(self, url, data=None):
+        """Gets the path of the cache entry for a request"""
+
+        key = hashlib.sha1(normalize_url(url, data)).hexdigest()
+        return os.path.join(self.directory, key[0:2], key)
+
+    def entries(self):
+        """Gets (path, size, access time) for all the cache entries"""
+
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith("."):
+                    # temporary files of ongoing writes
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_atime))
+
+        return entries
+
+    def open(self, url, data=None):
+        """
+        Opens a cached response body, so it can be read in chunks.
+
+        @param url: input URL
+        @param data: optional object POSTed as a JSON body
+        @return: returns a file object (to be closed by the caller) or None if not cached
+        """
+
+        path = self.path(url, data)
+        try:
+            stat = os.stat(path)
+            if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+                self.remove(path, stat.st_size)
+                with self.lock:
+                    self.expired += 1
+                    self.misses += 1
+                return None
+            inputfile = open(path, "rb")
+            # keeps the modification time (TTL) and updates the access time (LRU)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (IOError, OSError):
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return inputfile
+
+    def get(self, url, data=None):
+        """
+        Gets a cached response body.
+
+        @param url: input URL
+        @param data: optional object POSTed as a JSON body
+        @return: returns the response body str() or None if not cached
+        """
+
+        inputfile = self.open(url, data)
+        if inputfile is None:
+            return None
+        with inputfile:
+            return inputfile.read()
+
+    def writer(self, url, data=None):
+        """
+        Starts writing a response body in chunks (see CacheWriter).
+
+        @param url: input URL
+        @param data: optional object POSTed as a JSON body
+        @return: returns a CacheWriter or None if the entry cannot be written
+        """
+
+        path = self.path(url, data)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+
+        try:
+            return CacheWriter(self, path)
+        except (IOError, OSError):
+            return None
+
+    def set(self, url, content, data=None):
+        """
+        Stores a response body.
+
+        @param url: input URL
+        @param content: response body str()
+        @param data: optional object POSTed as a JSON body
+        """
+
+        writer = self.writer(url, data)
+        if writer is not None:
+            writer.write(content)
+            writer.commit()
+
+        return
+
+    def stored(self, path, size, previous):
+        """Accounts for an entry of size bytes replacing one of previous bytes (see CacheWriter)"""
+
+        with self.lock:
+            self.size += size - previous
+            oversized = self.max_size is not None and self.size > self.max_size
+        if oversized:
+            self.evict()
+
+        return
+
+    def remove(self, path, size=0):
+        """Removes a cache entry (if it was not removed meanwhile)"""
+
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.size -= size
+
+        return
+
+    def evict(self):
+        """
+        Evicts the least recently used entries until the cache is
+        back to 90% of its maximum size.
+        """
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        limit = int(self.max_size * 0.9)
+        entries.sort(key=lambda entry: entry[2])
+        evicted = 0
+        for path, entry_size, atime in entries:
+            if size <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            evicted += 1
+
+        with self.lock:
+            self.size = size
+            self.evictions += evicted
+
+        return
+
+    def clear(self):
+        """Removes all the cache entries"""
+
+        for path, size, atime in self.entries():
+            self.remove(path, size)
+
+        return
+
+    def stats(self):
+        """
+        Gets the cache counters.
+
+        @return: returns a dictionary with hits, misses, expired, evictions and size
+        """
+
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "expired": self.expired,
+                    "evictions": self.evictions, "size": self.size}
+
+
+class CacheWriter(object):
+    """
+    Writes a cache entry chunk by chunk, to a temporary file that is
+    renamed to the entry on commit (or removed on discard), so large
+    response bodies are never held in memory and readers never see a
+    partial entry. Write errors discard the entry.
+    """
+
+    def __init__(self, cache, path):
+        """
+        Init method.
+
+        @param cache: ResponseCache the entry belongs to
+        @param path: path of the cache entry
+        """
+
+        self.cache = cache
+        self.path = path
+        self.size = 0
+        handle, self.tmp_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+        self.outputfile = os.fdopen(handle, "wb")
+
+        return
+
+    def write(self, chunk):
+        """Appends a chunk (str()) to the entry"""
+
+        if self.outputfile is None:
+            return
+        try:
+            self.outputfile.write(chunk)
+        except (IOError, OSError):
+            self.discard()
+            return
+        self.size += len(chunk)
+
+        return
+
+    def commit(self):
+        """Stores the entry written so far"""
+
+        if self.outputfile is None:
+            return
+        try:
+            self.outputfile.close()
+            self.outputfile = None
+            # an entry overwritten by the rename no longer counts towards the size
+            try:
+                previous = os.path.getsize(self.path)
+            except OSError:
+                previous = 0
+            os.rename(self.tmp_path, self.path)
+        except (IOError, OSError):
+            self.discard()
+            return
+
+        self.cache.stored(self.path, self.size, previous)
+
+        return
+
+    def discard(self):
+        """Drops the entry written so far (e.g. the response was incomplete)"""
+
+        if self.outputfile is not None:
+            try:
+                self.outputfile.close()
+            except (IOError, OSError):
+                pass
+            self.outputfile = None
+        if os.path.exists(self.tmp_path):
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+        return
+
+
+if __name__ == "__main__":
+    # testing routines
+    import shutil
+
+    directory = tempfile.mkdtemp(prefix="cache")
+    try:
+        cache = ResponseCache(directory)
+        cache.set("http://rest.ensembl.org/info/ping", "x" * 100)
+        assert cache.stats()["size"] == 100
+        # overwriting a key leaves the size unchanged (same content) or replaces it
+        cache.set("http://rest.ensembl.org/info/ping", "x" * 100)
+        assert cache.stats()["size"] == 100
+        cache.set("http://rest.ensembl.org/info/ping", "x" * 40)
+        assert cache.stats()["size"] == 40
+        assert ResponseCache(directory).stats()["size"] == 40
+        assert cache.get("http://rest.ensembl.org/info/ping") == "x" * 40
+
+        # entries written and read in chunks
+        url = "http://rest.ensembl.org/overlap/translation/ENSP00000448059"
+        writer = cache.writer(url)
+        for i in range(10):
+            writer.write(str(i) * 10)
+        # not visible until committed
+        assert cache.get(url) is None
+        writer.commit()
+        assert cache.stats()["size"] == 140
+        with cache.open(url) as inputfile:
+            assert iter(lambda: inputfile.read(10), "").next() == "0" * 10
+        assert cache.get(url) == "".join([str(i) * 10 for i in range(10)])
+        # discarded entries leave no (temporary) files behind
+        writer = cache.writer(url + "?feature=transcript_variation")
+        writer.write("y" * 10)
+        writer.discard()
+        assert cache.get(url + "?feature=transcript_variation") is None
+        assert len(cache.entries()) == 2 and cache.stats()["size"] == 140
+        assert len([name for root, dirs, names in os.walk(directory) for name in names]) == 2
+    finally:
+        shutil.rmtree(directory)
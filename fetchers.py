@@ -1,20 +1,472 @@
 #!/usr/bin/env python2.7
 
 import os
+import re
 import json
+import tempfile
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from utils import flash
 from utils import write_log
+from utils import send_request
 from utils import request_info_url
+from utils import request_stream_url
+from utils import request_conditional_url
+from utils import next_page_url
+from utils import get_sequence_store
+from parsers import iter_json_array
+from tables import VariantStore
+from sequences import sequence_checksum
 
 from library import aa_symbols_ext
 from library import aa_symbols_rev_ext
 from library import aa_physicochemical_full
+from library import ensembl_rest_url
+from library import ensembl_post_max_ids
+from library import ensembl_sequence_max_ids
+from library import uniprot_rest_url
+from library import uniprot_batch_max_ids
+from library import uniprot_accession_pattern
+
+# transcript -> gene mappings, memoized across identifiers, least recently
+# used first (see fetch_transcript_genes_from_ensembl_rest)
+transcript_genes = OrderedDict()
+transcript_genes_lock = threading.Lock()
+# maximum number of memoized mappings (long-running processes, e.g. the service)
+transcript_genes_max = 100000
+
+
+def fetch_variation_info_from_ensembl_rest(identifier, species, variant_ids, full=False, server=None,
+                                           chunk_size=ensembl_post_max_ids, verbose=True):
+    """
+    Fetchs variation specific info for a list of variant ids using the
+    Ensembl REST API POST endpoint (/variation/:species), in chunks of
+    at most chunk_size ids per request.
+
+    @param identifier: UNIPROT identifier (used for error handling)
+    @param species: UNIPROT species
+    @param variant_ids: list of variant ids (e.g. rs or COSM ids)
+    @param full: Boolean (also gets populations and genotypes)
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param chunk_size: maximum number of ids per request
+    @param verbose: Boolean
+    @return: returns a dictionary of variation entries keyed by variant id
+    """
+
+    if server is None:
+        server = ensembl_rest_url
+
+    url = "%s/variation/%s" % (server, species)
+    if full:
+        url += "?pops=1;phenotypes=1;genotypes=1;"
+    else:
+        url += "?phenotypes=1;"
+    url += "content-type=application/json"
+
+    # unique ids, keeping the input order
+    ids = []
+    seen = set()
+    for vid in variant_ids:
+        if vid not in seen:
+            seen.add(vid)
+            ids.append(vid)
+
+    var_info = {}
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        read = request_info_url(identifier, url, lines=False, data={"ids": chunk}, verbose=verbose)
+
+        if read != "":
+            info = json.loads(read)
+            for key in info:
+                entry = info[key]
+                var_info[key] = entry
+                # the response can be keyed by a synonym of the requested id
+                if "name" in entry and entry["name"] not in var_info:
+                    var_info[entry["name"]] = entry
+
+    return var_info
+
+
+def fetch_ensembl_release(server=None, verbose=True):
+    """
+    Gets the current Ensembl release (/info/data).
+
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param verbose: Boolean
+    @return: returns the release number str() or None if not available
+    """
+
+    if server is None:
+        server = ensembl_rest_url
+
+    url = "%s/info/data?content-type=application/json" % server
+    read = request_info_url("-", url, lines=False, cached=False, verbose=verbose)
+
+    release = None
+    if read != "":
+        try:
+            release = str(json.loads(read)["releases"][0])
+        except (ValueError, KeyError, IndexError):
+            release = None
+
+    return release
+
+
+def fetch_uniprot_release(server=None, verbose=True):
+    """
+    Gets the current UniProt release, sent by UniProt in the
+    X-UniProt-Release header of its responses.
+
+    @param server: UniProt REST server (defaults to library.uniprot_rest_url)
+    @param verbose: Boolean
+    @return: returns the release str() (e.g. "2024_01") or None if not available
+    """
+
+    if server is None:
+        server = uniprot_rest_url
+
+    url = "%s/search?query=reviewed:true&fields=accession&size=1&format=tsv" % server
+    req = send_request("-", url, verbose=verbose)
+    if req is None or req.status_code != 200:
+        return None
+
+    return req.headers.get("X-UniProt-Release")
+
+
+def fetch_sequences_from_ensembl_rest(identifier, stable_ids, server=None, store=None,
+                                      chunk_size=ensembl_sequence_max_ids, verbose=True):
+    """
+    Fetchs the protein sequences of a list of Ensembl stable ids using the
+    Ensembl REST API POST endpoint (/sequence/id), in chunks of at most
+    chunk_size ids per request. Sequences already in the sequence store
+    are not requested again, and the fetched ones are added to it.
+
+    @param identifier: UNIPROT identifier (used for error handling)
+    @param stable_ids: list of Ensembl protein identifiers
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param store: sequences.SequenceStore (defaults to the one set in utils)
+    @param chunk_size: maximum number of ids per request
+    @param verbose: Boolean
+    @return: returns a dictionary of sequences keyed by stable id
+    """
+
+    if server is None:
+        server = ensembl_rest_url
+    if store is None:
+        store = get_sequence_store()
+
+    sequences = {}
+    ids = []
+    requested = set()
+    for stable_id in stable_ids:
+        if stable_id in sequences or stable_id in requested:
+            continue
+        sequence = None
+        if store is not None:
+            sequence = store.get(stable_id)
+        if sequence is not None:
+            sequences[stable_id] = sequence
+        else:
+            ids.append(stable_id)
+            requested.add(stable_id)
+
+    url = "%s/sequence/id?type=protein;content-type=application/json" % server
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        read = request_info_url(identifier, url, lines=False, data={"ids": chunk}, verbose=verbose)
+
+        if read != "":
+            info = json.loads(read)
+            for entry in info:
+                # the response is keyed by the requested id (query)
+                stable_id = entry.get("query", entry["id"])
+                sequences[stable_id] = str(entry["seq"])
+                if store is not None:
+                    store.put(stable_id, entry["seq"], version=entry.get("version"))
+
+    return sequences
+
+
+def fetch_transcript_genes_from_ensembl_rest(identifier, transcript_ids, server=None,
+                                             chunk_size=ensembl_post_max_ids, verbose=True):
+    """
+    Gets the parent gene of a list of Ensembl transcripts using the Ensembl
+    REST API POST endpoint (/lookup/id), in chunks of at most chunk_size
+    ids per request. Mappings are memoized (up to transcript_genes_max, the
+    least recently used are forgotten), so each transcript is looked up
+    once per run.
+
+    @param identifier: UNIPROT identifier (used for error handling)
+    @param transcript_ids: list of Ensembl transcript identifiers
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param chunk_size: maximum number of ids per request
+    @param verbose: Boolean
+    @return: returns a dictionary of gene ids keyed by transcript id
+        (transcripts not found are left out)
+    """
+
+    if server is None:
+        server = ensembl_rest_url
+
+    genes = {}
+    ids = []
+    with transcript_genes_lock:
+        for enst in transcript_ids:
+            if (server, enst) in transcript_genes:
+                gene = transcript_genes.pop((server, enst))
+                transcript_genes[(server, enst)] = gene
+                if gene is not None:
+                    genes[enst] = gene
+            elif enst not in ids:
+                ids.append(enst)
+
+    url = "%s/lookup/id?content-type=application/json" % server
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        read = request_info_url(identifier, url, lines=False, data={"ids": chunk}, verbose=verbose)
+
+        if read != "":
+            info = json.loads(read)
+            with transcript_genes_lock:
+                for enst in chunk:
+                    # ids not found are returned as null
+                    if info.get(enst) is not None and "Parent" in info[enst]:
+                        transcript_genes[(server, enst)] = info[enst]["Parent"]
+                    elif enst in info:
+                        transcript_genes[(server, enst)] = None
+                    if transcript_genes.get((server, enst)) is not None:
+                        genes[enst] = transcript_genes[(server, enst)]
+                while len(transcript_genes) > transcript_genes_max:
+                    transcript_genes.popitem(last=False)
+
+    return genes
+
+
+def merge_variation_info(variant, entry, full=False):
+    """
+    Merges variation specific info, as returned by /variation/:species,
+    into a variant dictionary.
+
+    @param variant: variant dictionary (as in fetch_variants_from_ensembl_rest)
+    @param entry: variation entry for that variant
+    @param full: Boolean (full variant information with
+        populations, genotypes, phenotypes, etc.)
+    @return: returns the updated variant dictionary
+    """
+
+    variant["LOCATION"] = entry["mappings"][0]["location"]
+    variant["CHROMOSSOME"] = entry["mappings"][0]["assembly_name"]
+    try:
+        variant["TRAIT"] = entry["phenotypes"][0]["trait"]
+    except:
+        variant["TRAIT"] = "-"
+    try:
+        variant["TRAIT_DB"] = entry["phenotypes"][0]["source"]
+    except:
+        variant["TRAIT_DB"] = "-"
+
+    if full:
+        variant["MAPPINGS"] = entry["mappings"]
+        variant["GENOTYPES"] = entry["genotypes"]
+        variant["PHENOTYPES"] = entry["phenotypes"]
+        variant["SYNONYMS"] = entry["synonyms"]
+        variant["POPULATIONS"] = entry["populations"]
+        variant["EVIDENCE"] = entry["evidence"]
+        variant["CONSEQUENCE"] = entry["most_severe_consequence"]
+        variant["SOURCE_DB"] = entry["source"]
+
+    return variant
+
+
+def translation_variant(entry, sequence, ensemblg, ensemblt, ensemblp):
+    """
+    Gets a variant from an /overlap/translation entry, filtering out
+    synonymous variants, frameshifts and other more complicated variants,
+    and variants with ids other than rs/COSM ids.
+
+    @param entry: /overlap/translation entry
+    @param sequence: UNIPROT sequence
+    @param ensemblg: ENSEMBL gene identifier
+    @param ensemblt: ENSEMBL transcript identifier
+    @param ensemblp: ENSEMBL protein identifier
+    @return: returns a variant dictionary or None if filtered out
+    """
+
+    vres = entry["residues"]
+    vtype = entry["type"]
+    vid = entry["id"]
+    vsite = int(entry["start"])
+
+    # filtering out synonymous variants and other more complicated frameshift variants
+    if not (vres != "" and "/" in vres and vtype != "synonymous_variant" and len(vres) == 3 and
+            (vid[0:2] == "rs" or vid[0:4] == "COSM") and vsite < len(sequence)):
+        return None
+
+    # loading variation dictionary
+    variant = OrderedDict()
+
+    vres1 = aa_symbols_rev_ext[vres.split("/")[0]]
+    vres2 = aa_symbols_rev_ext[vres.split("/")[1]]
+
+    variant["VARIATION"] = "p.%s%s%s" % (vres1, vsite, vres2)
+    variant["SITE"] = str(vsite)
+
+    variant["RES1"] = vres1
+    variant["RES2"] = vres2
+    try:
+        variant["RES1_PROP"] = aa_physicochemical_full[vres1]
+    except:
+        variant["RES1_PROP"] = []
+    try:
+        variant["RES2_PROP"] = aa_physicochemical_full[vres2]
+    except:
+        variant["RES2_PROP"] = []
+    variant["SOURCE"] = vid
+    variant["ENSEMBL_GENE"] = ensemblg
+    variant["ENSEMBL_TRANSCRIPT"] = ensemblt
+    variant["ENSEMBL_PROTEIN"] = ensemblp
+    variant["ENSEMBL_TRANSCRIPTS"] = [ensemblt]
+    variant["ENSEMBL_PROTEINS"] = [ensemblp]
+    variant["TYPE"] = " ".join(entry["type"].split("_"))
+    variant["FEATURE_TYPE"] = entry["feature_type"]
+    variant["CODONS"] = entry["codons"]
+    variant["ALLELE"] = entry["allele"]
+    alle_freq = entry["minor_allele_frequency"]
+    if alle_freq is None:
+        variant["ALLELE_FREQUENCY"] = "-"
+    else:
+        variant["ALLELE_FREQUENCY"] = alle_freq
+
+    variant["LOCATION"] = "-"
+    variant["CHROMOSSOME"] = "-"
+    variant["TRAIT"] = "-"
+    variant["TRAIT_DB"] = "-"
+
+    return variant
+
+
+def fetch_variants_from_ensembl_translation(identifier, sequence, species, ensg_list, ensemblt, ensemblp,
+                                            method="ENSEMBL", full=False, server=None, ensembl_seq=None,
+                                            ensemblg=None, verbose=True):
+    """
+    Fetchs variants for a single Ensembl transcript/translation pair, as
+    used by fetch_variants_from_ensembl_rest.
+
+    @param identifier: UNIPROT identifier
+    @param sequence: UNIPROT sequence
+    @param species: UNIPROT species
+    @param ensg_list: list of ENSEMBL gene identifiers
+    @param ensemblt: ENSEMBL transcript identifier
+    @param ensemblp: ENSEMBL protein identifier
+    @param method: ENSEMBL query of transcript variation "ENSEMBL" or somatic var "COSMIC"
+    @param full: Boolean (full variant information with
+        populations, genotypes, phenotypes, etc.)
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param ensembl_seq: ENSEMBL protein sequence, if already fetched
+        (see fetch_sequences_from_ensembl_rest)
+    @param ensemblg: ENSEMBL gene identifier of the transcript (see
+        fetch_transcript_genes_from_ensembl_rest), needed if ensg_list has >1 ids
+    @param verbose: Boolean
+    @return: returns a list of variants (VariantStore)
+    """
+
+    if server is None:
+        server = ensembl_rest_url
+
+    variants = VariantStore()
+
+    if verbose:
+        flash("Ensembl Protein %s..." % ensemblp)
+    # first compares the uniprot sequence to the ensemblp sequence
+    if ensembl_seq is None:
+        url = "%s/sequence/id/%s" % (server, ensemblp)
+        url += "?content-type=text/plain;type=protein"
+        read = request_info_url(identifier, url, lines=True, verbose=verbose)
+        if read != []:
+            ensembl_seq = read[0].rstrip("\r\n")
+
+    if ensembl_seq:
+        # the translation should be the UniProt sequence (same content checksum,
+        # as in the sequence store); translations of the same length that
+        # differ at some residues are still used (as before), as each variant
+        # site is checked against the UniProt residue below, but are logged
+        mapped = sequence_checksum(ensembl_seq) == sequence_checksum(sequence)
+        if not mapped and len(ensembl_seq) == len(sequence):
+            mismatches = sum([1 for res1, res2 in zip(ensembl_seq, sequence) if res1 != res2])
+            message = "%s\tWarning: %s differs from the UniProt sequence at %s residue(s)" % \
+                      (identifier, ensemblp, mismatches)
+            flash(message)
+            path = os.getcwd() + "/"
+            output_file = "error_variants.log"
+            write_log(message, path + output_file)
+            mapped = True
+        if mapped:
+
+            # ensembl gene ID: if there are >1 gene ids, the caller resolves
+            # them all at once (see fetch_transcript_genes_from_ensembl_rest)
+            if ensemblg is None:
+                ensemblg = ensg_list[0] if len(ensg_list) == 1 else "-"
+
+            # gets the variants: either ENSEMBL (transcript variants)
+            # or COSMIC (somatic variants)
+            url = "%s/overlap/translation/%s" % (server, ensemblp)
+            if method == "ENSEMBL":
+                url += "?feature=transcript_variation;"
+            elif method == "COSMIC":
+                url += "?feature=somatic_transcript_variation;"
+            else:
+                url += "?feature=transcript_variation;feature=somatic_transcript_variation;"
+            url += "content-type=application/json"
+            # the response is parsed as it arrives: only the variants that
+            # pass the filter are kept (see translation_variant)
+            entries = iter_json_array(request_stream_url(identifier, url, verbose=verbose))
+            candidates = []
+            for entry in entries:
+                variant = translation_variant(entry, sequence, ensemblg, ensemblt, ensemblp)
+                if variant is not None:
+                    candidates.append(variant)
+
+            if candidates:
+                # get id specific info (populations, genotypes and phenotypes
+                # if full) for all the candidates at once
+                vids = [variant["SOURCE"] for variant in candidates]
+                var_info = fetch_variation_info_from_ensembl_rest(identifier, species, vids, full=full,
+                                                                  server=server, verbose=verbose)
+
+                for variant in candidates:
+                    vid = variant["SOURCE"]
+                    vres1 = variant["RES1"]
+                    vsite = int(variant["SITE"])
+                    if vid in var_info:
+                        merge_variation_info(variant, var_info[vid], full=full)
+
+                    # test for mapping between ensembl and uniprot sequences
+                    try:
+                        # compares the residue that is supposed to match the variation entry with
+                        # the one observed in uniprot sequence
+
+                        if vres1 != "---" and vres1 != "***":
+                            assert aa_symbols_ext[vres1] == sequence[vsite - 1]
+
+                        variants.add(variant)
+
+                    except:
+                        message = "%s\tWarning: %s in sequence position %s, does not match the %s for %s" % \
+                                    (identifier, aa_symbols_ext[vres1], vsite, sequence[vsite - 1], ensemblp)
+                        flash(message)
+                        path = os.getcwd() + "/"
+                        output_file = "error_variants.log"
+                        write_log(message, path + output_file)
+
+    return variants
 
 
 def fetch_variants_from_ensembl_rest(identifier, sequence, species, ensemblg, ensemblt, ensemblp,
-                                     method="ENSEMBL", full=False, form="plain", verbose=True):
+                                     method="ENSEMBL", full=False, form="plain", verbose=True, server=None,
+                                     workers=1):
     """
     Fetchs variants using the Ensembl REST API. As of July 2014, Ensembl
     variants include 1000 Genomes Project, dbSNP, HAPMAP and COSMIC.
@@ -34,12 +486,17 @@ def fetch_variants_from_ensembl_rest(identifier, sequence, species, ensemblg, en
         populations, genotypes, phenotypes, etc.)
     @param form: output format
     @param verbose: Boolean
-    @return: returns a list of variants
+    @param server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param workers: number of transcripts fetched concurrently
+    @return: returns a list of variants (VariantStore)
     """
 
     if verbose:
         flash("Fetching Variants from Ensembl using REST API...")
 
+    if server is None:
+        server = ensembl_rest_url
+
     # example lines to parse
     """
     [{
@@ -116,175 +573,47 @@ def fetch_variants_from_ensembl_rest(identifier, sequence, species, ensemblg, en
     }
     """
 
-    variants = []
+    variants = VariantStore()
 
     ensg_list = ensemblg
     enst_list = ensemblt
     ensp_list = ensemblp
 
-    for ensemblt, ensemblp in zip(enst_list, ensp_list):
-
-        if verbose:
-            flash("Ensembl Protein %s..." % ensemblp)
-        # first compares the uniprot sequence to the ensemblp sequence
-        url = "http://rest.ensembl.org/sequence/id/%s" % ensemblp
-        url += "?content-type=text/plain;type=protein"
-        read = request_info_url(identifier, url, lines=True, verbose=verbose)
-
-        if read != []:
-            ensembl_seq = read[0].rstrip("\r\n")
-            if len(sequence) == len(ensembl_seq):
-
-                # get ensembl gene ID: important if there are >1 gene ids
-                if len(ensg_list) == 1:
-                    ensemblg = ensg_list[0]
-                else:
-                    url = "http://rest.ensembl.org/overlap/id/%s" % ensemblt
-                    url += "?feature=transcript;content-type=application/json"
-                    read = request_info_url(identifier, url, lines=False, verbose=verbose)
-
-                    ensemblg = "-"
-                    if read != "":
-                        info = json.loads(read)
-                        for entry in info:
-                            if entry["id"] == ensemblt:
-                                ensemblg = entry["Parent"]
-
-                # gets the variants: either ENSEMBL (transcript variants)
-                # or COSMIC (somatic variants)
-                url = "http://rest.ensembl.org/overlap/translation/%s" % ensemblp
-                if method == "ENSEMBL":
-                    url += "?feature=transcript_variation;"
-                elif method == "COSMIC":
-                    url += "?feature=somatic_transcript_variation;"
-                else:
-                    url += "?feature=transcript_variation;feature=somatic_transcript_variation;"
-                url += "content-type=application/json"
-                read = request_info_url(identifier, url, lines=False, verbose=verbose)
-
-                if read != "":
-                    # gets result and parse arguments
-                    info = json.loads(read)
-                    for entry in info:
-                        vres = entry["residues"]
-                        vtype = entry["type"]
-                        vid = entry["id"]
-                        vsite = int(entry["start"])
-
-                        # filtering out synonymous variants and other more complicated frameshift variants
-                        if vres != "" and "/" in vres and vtype != "synonymous_variant" and len(vres) == 3 and \
-                            (vid[0:2] == "rs" or vid[0:4] == "COSM") and vsite < len(sequence):
-
-                            # loading variation dictionary
-                            variant = OrderedDict()
-
-                            vres1 = aa_symbols_rev_ext[vres.split("/")[0]]
-                            vres2 = aa_symbols_rev_ext[vres.split("/")[1]]
-
-                            variant["VARIATION"] = "p.%s%s%s" % (vres1, vsite, vres2)
-                            variant["SITE"] = str(vsite)
-
-                            variant["RES1"] = vres1
-                            variant["RES2"] = vres2
-                            try:
-                                variant["RES1_PROP"] = aa_physicochemical_full[vres1]
-                            except:
-                                 variant["RES1_PROP"] = []
-                            try:
-                                variant["RES2_PROP"] = aa_physicochemical_full[vres2]
-                            except:
-                                 variant["RES2_PROP"] = []
-                            variant["SOURCE"] = vid
-                            variant["ENSEMBL_GENE"] = ensemblg
-                            variant["ENSEMBL_TRANSCRIPT"] = ensemblt
-                            variant["ENSEMBL_PROTEIN"] = ensemblp
-                            variant["TYPE"] = " ".join(entry["type"].split("_"))
-                            variant["FEATURE_TYPE"] = entry["feature_type"]
-                            variant["CODONS"] = entry["codons"]
-                            variant["ALLELE"] = entry["allele"]
-                            alle_freq = entry["minor_allele_frequency"]
-                            if alle_freq is None:
-                                variant["ALLELE_FREQUENCY"] = "-"
-                            else:
-                                variant["ALLELE_FREQUENCY"] = alle_freq
-
-                            variant["LOCATION"] = "-"
-                            variant["CHROMOSSOME"] = "-"
-                            variant["TRAIT"] = "-"
-                            variant["TRAIT_DB"] = "-"
-
-                            if full:
-                                # get id specific info on populations, genotypes and phenotypes
-                                url = "http://rest.ensembl.org/variation/%s/%s" % (species, vid)
-                                url += "?pops=1;phenotypes=1;genotypes=1;"
-                                url += "content-type=application/json"
-                                read = request_info_url(identifier, url, lines=False, verbose=verbose)
-
-                                if read != "":
-                                    # get result and parse arguments
-                                    entry2 = json.loads(read)
-                                    variant["LOCATION"] = entry2["mappings"][0]["location"]
-                                    variant["CHROMOSSOME"] = entry2["mappings"][0]["assembly_name"]
-
-                                    try:
-                                        variant["TRAIT"] = entry2["phenotypes"][0]["trait"]
-                                    except:
-                                        variant["TRAIT"] = "-"
-                                    try:
-                                        variant["TRAIT_DB"] = entry2["phenotypes"][0]["source"]
-                                    except:
-                                        variant["TRAIT_DB"] = "-"
-
-                                    variant["MAPPINGS"] = entry2["mappings"]
-                                    variant["GENOTYPES"] = entry2["genotypes"]
-                                    variant["PHENOTYPES"] = entry2["phenotypes"]
-                                    variant["SYNONYMS"] = entry2["synonyms"]
-                                    variant["POPULATIONS"] = entry2["populations"]
-                                    variant["EVIDENCE"] = entry2["evidence"]
-                                    variant["CONSEQUENCE"] = entry2["most_severe_consequence"]
-                                    variant["SOURCE_DB"] = entry2["source"]
-
-                            else:
-                                # get only essential information for each id
-                                url = "http://rest.ensembl.org/variation/%s/%s" % (species, vid)
-                                url += "?phenotypes=1;"
-                                url += "content-type=application/json"
-                                read = request_info_url(identifier, url, lines=False, verbose=verbose)
-
-                                if read != "":
-                                    # get result and parse arguments
-                                    entry2 = json.loads(read)
-
-                                    variant["LOCATION"] = entry2["mappings"][0]["location"]
-                                    variant["CHROMOSSOME"] = entry2["mappings"][0]["assembly_name"]
-                                    try:
-                                        variant["TRAIT"] = entry2["phenotypes"][0]["trait"]
-                                    except:
-                                        variant["TRAIT"] = "-"
-                                    try:
-                                        variant["TRAIT_DB"] = entry2["phenotypes"][0]["source"]
-                                    except:
-                                        variant["TRAIT_DB"] = "-"
-
-                            # test for mapping between ensembl and uniprot sequences
-                            try:
-                                # compares the residue that is supposed to match the variation entry with
-                                # the one observed in uniprot sequence
-
-                                if vres1 != "---" and vres1 != "***":
-                                    assert aa_symbols_ext[vres1] == sequence[vsite - 1]
-
-                                if variant not in variants:
-                                    variants.append(variant)
-
-                            except:
-                                message = "%s\tWarning: %s in sequence position %s, does not match the %s for %s" % \
-                                            (identifier, aa_symbols_ext[vres1], vsite, sequence[vsite - 1], ensemblp)
-                                print(message)
-                                path = os.getcwd() + "/"
-                                output_file = "error_variants.log"
-                                write_log(message, path + output_file)
-
+    jobs = zip(enst_list, ensp_list)
+
+    # all the protein sequences are fetched at once (missing ones are skipped)
+    ensembl_seqs = fetch_sequences_from_ensembl_rest(identifier, ensp_list, server=server, verbose=verbose)
+
+    # and so are the genes of the transcripts, if there are >1 gene ids
+    ensembl_genes = None
+    if len(ensg_list) > 1:
+        ensembl_genes = fetch_transcript_genes_from_ensembl_rest(identifier, enst_list, server=server,
+                                                                 verbose=verbose)
+
+    def fetch_translation(job):
+        ensemblg = None
+        if ensembl_genes is not None:
+            ensemblg = ensembl_genes.get(job[0], "-")
+        return fetch_variants_from_ensembl_translation(identifier, sequence, species, ensg_list, job[0], job[1],
+                                                       method=method, full=full, server=server,
+                                                       ensembl_seq=ensembl_seqs.get(job[1], ""),
+                                                       ensemblg=ensemblg, verbose=verbose)
+
+    # transcripts are independent from each other, so they can be fetched
+    # concurrently; map keeps the results in the transcript order
+    if workers > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(workers, len(jobs)))
+        try:
+            results = pool.map(fetch_translation, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch_translation(job) for job in jobs]
+
+    # the same variant seen from several transcripts is kept once (see VariantStore)
+    for translation_variants in results:
+        variants.update(translation_variants)
 
     if form is "plain":
         print(variants)
@@ -294,6 +623,181 @@ def fetch_variants_from_ensembl_rest(identifier, sequence, species, ensemblg, en
     return variants
 
 
+def split_variants_by_feature_type(variants):
+    """
+    Splits the variants fetched with both feature types (any method other
+    than "ENSEMBL" or "COSMIC" in fetch_variants_from_ensembl_rest) into
+    transcript variants and somatic variants, keeping their order.
+
+    @param variants: list of variants
+    @return: returns the variants and the mutations (VariantStore)
+    """
+
+    transcript_variants = VariantStore()
+    somatic_variants = VariantStore()
+    for variant in variants:
+        if variant["FEATURE_TYPE"] == "somatic_transcript_variation":
+            somatic_variants.add(variant)
+        else:
+            transcript_variants.add(variant)
+
+    return transcript_variants, somatic_variants
+
+
+def split_uniprot_fasta(lines):
+    """
+    Splits a multi-entry UniProt fasta stream into entries.
+
+    @param lines: fasta lines
+    @return: returns a dictionary of lists of lines keyed by accession
+    """
+
+    entries = OrderedDict()
+    entry = None
+    for line in lines:
+        if line.startswith(">"):
+            # example header: >sp|P04217|A1BG_HUMAN Alpha-1B-glycoprotein OS=Homo sapiens GN=A1BG PE=1 SV=4
+            try:
+                accession = line.split("|")[1]
+            except IndexError:
+                accession = line[1:].split()[0]
+            entry = entries.setdefault(accession, [])
+        if entry is not None:
+            entry.append(line)
+
+    return entries
+
+
+def split_uniprot_txt(lines):
+    """
+    Splits a multi-entry UniProt text (flat file) stream into entries.
+    Entries are keyed by all their accessions (primary and secondary).
+
+    @param lines: txt lines
+    @return: returns a dictionary of lists of lines keyed by accession
+    """
+
+    entries = OrderedDict()
+    entry = []
+    accessions = []
+    for line in lines:
+        entry.append(line)
+        if line.startswith("AC   "):
+            accessions.extend([acc.strip() for acc in line[5:].split(";") if acc.strip() != ""])
+        elif line.startswith("//"):
+            for accession in accessions:
+                if accession not in entries:
+                    entries[accession] = entry
+            entry = []
+            accessions = []
+
+    return entries
+
+
+def write_lines_atomic(lines, output_path):
+    """
+    Writes lines to a file, through a temporary file renamed at the end
+    so readers never see a partially written file.
+
+    @param lines: list of lines (without line endings)
+    @param output_path: path to the output file
+    """
+
+    handle, tmp_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(output_path))
+    with os.fdopen(handle, "w") as output:
+        for line in lines:
+            output.write(line + "\n")
+    os.rename(tmp_path, output_path)
+
+    return
+
+
+def prefetch_uniprot_entries(identifiers, path, chunk_size=uniprot_batch_max_ids, server=None, verbose=True):
+    """
+    Downloads the UniProt fasta and txt entries that are not yet in path,
+    in batches of multi-accession streams, and splits them into the
+    per-identifier <id>.fasta and <id>.txt files used by CoreSEQUENCE.
+    Batches ask for all their entries in a single page, and any further
+    pages (Link rel="next") are followed. The Last-Modified and UniProt
+    release of each page are recorded as the validators of its files (see
+    refresh.record_artifacts): the entries were not modified after the
+    page, while the ETag of a page does not apply to its entries.
+
+    @param identifiers: list of UNIPROT identifiers
+    @param path: path to the local UniProt files (e.g. Data/)
+    @param chunk_size: maximum number of identifiers per request
+    @param server: UniProt REST server (defaults to library.uniprot_rest_url)
+    @param verbose: Boolean
+    @return: returns the list of identifiers downloaded
+    """
+
+    # refresh imports the fetchers, so it is only imported here
+    from refresh import artifact_validators
+    from refresh import record_artifacts
+
+    if server is None:
+        server = uniprot_rest_url
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    missing = []
+    seen = set()
+    for identifier in identifiers:
+        if identifier in seen or not re.match(uniprot_accession_pattern, identifier):
+            continue
+        seen.add(identifier)
+        for ext in ("fasta", "txt"):
+            if not os.path.isfile("%s/%s.%s" % (path, identifier, ext)):
+                missing.append(identifier)
+                break
+
+    downloaded = []
+    for i in range(0, len(missing), chunk_size):
+        chunk = missing[i:i + chunk_size]
+        if verbose:
+            flash("Prefetching %s UniProt entries..." % len(chunk))
+
+        url = "%s/accessions?accessions=%s&size=%s" % (server, ",".join(chunk), len(chunk))
+        # accession -> (entry lines, validators), per format
+        entries = OrderedDict()
+        for ext, split_entries in (("fasta", split_uniprot_fasta), ("txt", split_uniprot_txt)):
+            entries[ext] = OrderedDict()
+            page_url = "%s&format=%s" % (url, ext)
+            while page_url is not None:
+                status, content, headers = request_conditional_url(chunk[0], page_url, verbose=verbose)
+                if status != 200:
+                    # entries not downloaded are fetched individually by CoreSEQUENCE
+                    break
+                validators = artifact_validators(headers)
+                validators["ETAG"] = None
+                for accession, entry in split_entries(content.splitlines()).items():
+                    entries[ext].setdefault(accession, (entry, validators))
+                page_url = next_page_url(page_url, headers)
+        fasta_entries = entries["fasta"]
+        txt_entries = entries["txt"]
+
+        artifacts = OrderedDict()
+        for identifier in chunk:
+            if identifier not in txt_entries:
+                continue
+            # secondary accessions are only listed in the txt entry (first AC is the primary)
+            txt_entry, txt_validators = txt_entries[identifier]
+            primary = [line for line in txt_entry if line.startswith("AC   ")][0][5:].split(";")[0].strip()
+            fasta = fasta_entries.get(identifier, fasta_entries.get(primary))
+            if fasta is not None:
+                fasta_entry, fasta_validators = fasta
+                write_lines_atomic(fasta_entry, "%s/%s.fasta" % (path, identifier))
+                write_lines_atomic(txt_entry, "%s/%s.txt" % (path, identifier))
+                downloaded.append(identifier)
+                artifacts["%s.fasta" % identifier] = fasta_validators
+                artifacts["%s.txt" % identifier] = txt_validators
+        if artifacts:
+            record_artifacts(artifacts, path)
+
+    return downloaded
+
+
 if __name__ == "__main__":
     # testing routines
     pass
\ No newline at end of file
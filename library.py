@@ -1,5 +1,21 @@
 #!/usr/bin/env python2.7
 
+# REST servers (can be pointed at a local mirror or stub server)
+ensembl_rest_url = "http://rest.ensembl.org"
+uniprot_rest_url = "https://rest.uniprot.org/uniprotkb"
+
+# maximum number of accessions per UniProt batch (/accessions) request
+uniprot_batch_max_ids = 500
+
+# UniProt accession format, as of 2014
+# http://www.uniprot.org/help/accession_numbers
+uniprot_accession_pattern = "^([OPQ][0-9][A-Z0-9]{3}[0-9]|[A-NR-Z][0-9]([A-Z][A-Z0-9]{2}[0-9]){1,2})$"
+
+# maximum number of ids accepted by the Ensembl POST endpoints
+ensembl_post_max_ids = 200
+# (POST /sequence/id accepts fewer)
+ensembl_sequence_max_ids = 50
+
 # working species in Ensembl Variants, as of November 2014
 # based on ftp://ftp.ensembl.org/pub/release-77/variation/vcf/
 ensembl_species = ["bos_taurus",
@@ -1,21 +1,58 @@
 #!/usr/bin/env python2.7
 
 import os
+import sys
 import json
+import time
+import threading
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from parsers import parse_information_from_uniprot
 from parsers import parse_ensembl_from_uniprot
 from fetchers import fetch_variants_from_ensembl_rest
+from fetchers import prefetch_uniprot_entries
+from fetchers import split_variants_by_feature_type
+from fetchers import fetch_ensembl_release
+from fetchers import fetch_uniprot_release
 
 from utils import flash
 from utils import current_time
 from utils import create_directory
 from utils import write_log
-from utils import request_info_url
+from utils import request_conditional_url
 from utils import load_lines
 from utils import uniprot_summary_mapping
+from utils import configure_http_session
+from utils import set_response_cache
+from utils import set_request_scheduler
+from utils import set_sequence_store
+from utils import set_results_store
+from utils import get_results_store
+from utils import set_metrics
+from utils import get_metrics
+from utils import set_diagnostics_output
+from utils import get_request_failures
+from utils import reset_request_failures
+from cache import ResponseCache
+from scheduler import RequestScheduler
+from sequences import SequenceStore
+from results import ResultsStore
+from results import results_version
+from metrics import Metrics
+from metrics import measure_identifier
+from metrics import service_max_identifiers
+from release import UniProtRelease
+from release import UniProtFasta
+from refresh import refresh_uniprot_entries
+from refresh import load_manifest
+from refresh import artifact_validators
+from refresh import record_artifacts
 from library import ensembl_species
+from library import uniprot_rest_url
+from tables import ResidueTable
+from tables import serialize_table
+from tables import VariantStore
 
 
 class CoreSEQUENCE(object):
@@ -23,26 +60,60 @@ class CoreSEQUENCE(object):
     Loads information based on a UNIPROT identifier.
     This includes path to the local files, web fetched
     data and SIFTS features.
+
+    The pipeline is a graph of lazily evaluated, memoized stages
+    (see stage_graph): each stage is computed once, on first use,
+    after the stages it depends on. Independent dependencies (e.g.
+    the UniProt fasta and txt files) are loaded concurrently, and
+    only the stages needed for the requested outputs are run.
     """
 
-    def __init__(self, identifier=None, db=True, form="plain", verbose=True):
+    # stage -> stages it depends on
+    stage_graph = OrderedDict([("fasta", ()),
+                               ("txt", ()),
+                               ("sequence", ("fasta",)),
+                               ("ensembl", ("txt",)),
+                               ("information", ("sequence", "ensembl")),
+                               ("variations", ("information",)),
+                               ("table", ("variations",)),
+                               ("entities", ("table",)),
+                               ("residues", ("table",)),
+                               ("summary", ("table",))])
+
+    def __init__(self, identifier=None, db=True, form="plain", verbose=True, workers=1, source=None):
         """
-        Init method. Quickly loads uniprot data from fasta and txt.
+        Init method. The UniProt fasta and txt files are only loaded
+        when a stage needs them.
 
         @param identifier: UNIPROT identifier
         @param form: output format
         @param verbose: Boolean
+        @param workers: number of Ensembl transcripts fetched concurrently
+        @param source: optional local UniProt source (e.g. release.UniProtRelease)
+            used instead of Data/ and the network (entries missing from
+            sources that are not offline, e.g. release.UniProtFasta, are
+            still read from Data/ or the network)
         @return: returns sequence, name, gene, species, fasta
                 ensemblg, ensemblt, ensemblp, txt, domains,
                variants, ptms, features, etc.
         """
 
         self.identifier = identifier
+        self.workers = workers
+        self.source = source
         self.form = form
         self.verbose = verbose
+        self.stored = False
+
+        # memoized stage outputs and one lock per stage
+        self.stages = {}
+        self.stage_locks = dict([(name, threading.Lock()) for name in self.stage_graph])
+
         if self.identifier is not None:
             if self.verbose:
                 flash("Loading UNIPROT ID %s..." % self.identifier)
+            # requests that fail from now on make the results incomplete (see save_results)
+            reset_request_failures(self.identifier)
 
             # assert identifier length
             try:
@@ -56,55 +127,12 @@ class CoreSEQUENCE(object):
             # assert current work directory
             cwd_path = os.getcwd()
             self.uniprot_path_uniprot = cwd_path + "/Data"
-            create_directory("Data")
             self.uniprot_fullpath_fasta = "%s/%s.%s" % (self.uniprot_path_uniprot, self.identifier, "fasta")
-            if os.path.isfile(self.uniprot_fullpath_fasta):
-                try:
-                    self.uniprot_fasta = True
-                    self.uniprot_fasta_object = load_lines(self.uniprot_fullpath_fasta, verbose=self.verbose)
-                except:
-                    self.uniprot_fasta = False
-            else:
-                # load source information into the object so it doesn't need be accessed all the time
-                url = 'http://www.uniprot.org/uniprot/%s.fasta' % identifier
-                self.uniprot_fasta_object = request_info_url(identifier, url, lines=True, verbose=self.verbose)
-
-                if self.uniprot_fasta_object != []:
-                    self.uniprot_fasta = True
-                    with open(self.uniprot_fullpath_fasta, "w") as output:
-                        for line in self.uniprot_fasta_object:
-                            output.write(line + "\n")
-                else:
-                    self.uniprot_fasta = False
-                    message = "Warning: %s.fasta not available for download." % identifier
-                    print(message)
-                    path = os.getcwd() + "/"
-                    output_file = "error_uniprot.log"
-                    write_log("%s\t%s" % (current_time(), message), path + output_file)
-
             self.uniprot_fullpath_txt = "%s/%s.%s" % (self.uniprot_path_uniprot, self.identifier, "txt")
-            if os.path.isfile(self.uniprot_fullpath_txt):
-                try:
-                    self.uniprot_txt = True
-                    self.uniprot_txt_object = load_lines(self.uniprot_fullpath_txt, verbose=self.verbose)
-                except:
-                    self.uniprot_txt = False
-            else:
-                url = 'http://www.uniprot.org/uniprot/%s.txt' % identifier
-                self.uniprot_txt_object = request_info_url(identifier, url, lines=True, verbose=self.verbose)
-
-                if self.uniprot_txt_object != []:
-                    self.uniprot_txt = True
-                    with open(self.uniprot_fullpath_txt, "w") as output:
-                        for line in self.uniprot_txt_object:
-                            output.write(line + "\n")
-                else:
-                    self.uniprot_txt = False
-                    message = "Warning: %s.txt not available for download." % identifier
-                    print(message)
-                    path = os.getcwd() + "/"
-                    output_file = "error_uniprot.log"
-                    write_log("%s\t%s" % (current_time(), message), path + output_file)
+            self.uniprot_fasta = None
+            self.uniprot_fasta_object = None
+            self.uniprot_txt = None
+            self.uniprot_txt_object = None
 
             # additional self variables to updated once the methods are launched
             self.sequence = None
@@ -121,38 +149,254 @@ class CoreSEQUENCE(object):
             self.entities = None
             self.residues = None
             self.summary = None
+            self.table = None
 
-            # trying to load data from DB
-            if db:
-                # I removed this bit from here to make the code shorter
-                pass
+            # trying to load data from DB: current results skip the UniProt files and Ensembl
+            if db and get_results_store() is not None:
+                results = get_results_store().load(identifier)
+                if results is not None:
+                    self.load_results(results)
 
         return
 
     def load_identifier(self, identifier, db, form, verbose):
         """Initiates the class with a UniProt identifier"""
 
-        return self.__init__(identifier, db, form, verbose)
+        return self.__init__(identifier, db, form, verbose, workers=self.workers, source=self.source)
 
-    def get_information(self):
+    def stage(self, name):
         """
-        Gets a list of features for that UniProt identifier
-        from UNIPROT and ENSEMBL.
+        Gets the output of a stage, computing it (and the stages it
+        depends on) on first use.
+
+        @param name: stage name (see stage_graph)
+        @return: returns the stage output
+        """
+
+        if name in self.stages:
+            return self.stages[name]
+
+        with self.stage_locks[name]:
+            if name not in self.stages:
+                self.run_stages(self.stage_graph[name])
+                run_metrics = get_metrics()
+                if run_metrics is None:
+                    self.stages[name] = getattr(self, "stage_%s" % name)()
+                else:
+                    start = time.time()
+                    self.stages[name] = getattr(self, "stage_%s" % name)()
+                    run_metrics.record_stage(self.identifier, name, time.time() - start)
+
+        return self.stages[name]
+
+    def run_stages(self, names):
+        """
+        Computes a list of stages (and the stages they depend on).
+        Stages that are not computed yet are run concurrently.
+
+        @param names: list of stage names (see stage_graph)
+        @return: returns a dictionary with the stage outputs
+        """
+
+        pending = [name for name in names if name not in self.stages]
+        if len(pending) > 1:
+            pool = ThreadPool(len(pending))
+            try:
+                pool.map(self.stage, pending)
+            finally:
+                pool.close()
+                pool.join()
+
+        outputs = OrderedDict()
+        for name in names:
+            outputs[name] = self.stage(name)
+
+        return outputs
+
+    def set_stage(self, name, output):
+        """
+        Sets the output of a stage (e.g. computed elsewhere) so it is not computed.
+
+        @param name: stage name (see stage_graph)
+        @param output: stage output
+        """
+
+        self.stages[name] = output
+
+        return
+
+    def get_outputs(self, *names):
+        """
+        Gets only the requested outputs, doing only the I/O they need.
+        e.g. get_outputs("sequence") does not load the txt file nor
+        contact Ensembl.
+
+        @param names: stage names (see stage_graph)
+        @return: returns a dictionary with the stage outputs
+        """
+
+        return self.run_stages(names)
+
+    def load_results(self, results):
+        """
+        Loads stored results (see results.ResultsStore) instead of the
+        UniProt files, so no stage needs to be computed again.
+
+        @param results: dictionary with INFORMATION, VARIANTS, MUTATIONS and SUMMARY
         """
 
         if self.verbose:
-            flash("Getting Information...")
+            flash("Loading stored results...")
+
+        self.stored = True
+        self.uniprot_fasta = True
+        self.uniprot_txt = True
+
+        self.information = results["INFORMATION"]
+        self.sequence = self.information["SEQUENCE"]
+        self.name = self.information["NAME"]
+        self.gene = self.information["GENE"]
+        self.species = self.information["SPECIES"]
+        self.ensemblg = self.information["ENSEMBL_GENE"]
+        self.ensemblt = self.information["ENSEMBL_TRANSCRIPT"]
+        self.ensemblp = self.information["ENSEMBL_PROTEIN"]
+
+        self.variants = results["VARIANTS"]
+        self.mutations = results["MUTATIONS"]
+        self.summary = results["SUMMARY"]
+
+        self.set_stage("fasta", True)
+        self.set_stage("txt", True)
+        self.set_stage("sequence", (self.sequence, self.name, self.gene, self.species))
+        self.set_stage("ensembl", (self.ensemblg, self.ensemblt, self.ensemblp))
+        self.set_stage("information", self.information)
+        self.set_stage("variations", (self.variants, self.mutations))
+        self.set_stage("summary", self.summary)
 
-        feat = OrderedDict()
-        if self.uniprot_fasta and self.uniprot_txt:
+        return
+
+    def save_results(self):
+        """
+        Saves the results to the results store, if one is set and they
+        were computed (see results.ResultsStore). Results computed while
+        a request failed are incomplete, so they are not saved (and are
+        computed again by the next run).
+        """
+
+        store = get_results_store()
+        if store is None or self.stored or not (self.uniprot_fasta and self.uniprot_txt):
+            return
+
+        if get_request_failures(self.identifier) > 0:
+            message = "Warning: %s results not stored (%s requests failed)." % \
+                      (self.identifier, get_request_failures(self.identifier))
+            flash(message)
+            path = os.getcwd() + "/"
+            output_file = "error_main.log"
+            write_log("%s\t%s" % (current_time(), message), path + output_file)
+            return
+
+        store.save(self.identifier, self.information, self.variants, self.mutations, self.summary)
+
+        return
+
+    def load_uniprot_file(self, ext):
+        """
+        Loads a UniProt file (fasta or txt) from the local source, Data/
+        or the network (saved to Data/, with its validators recorded in
+        the refresh manifest, see refresh.record_artifacts).
+
+        @param ext: "fasta" or "txt"
+        @return: returns a list of lines or None if not available
+        """
+
+        identifier = self.identifier
+        fullpath = "%s/%s.%s" % (self.uniprot_path_uniprot, identifier, ext)
+
+        lines = None
+        if self.source is not None:
+            lines = self.source.get_fasta(identifier) if ext == "fasta" else self.source.get_txt(identifier)
+        if lines is not None:
+            return lines
+        elif self.source is not None and self.source.offline:
+            message = "Warning: %s.%s not available in the local release." % (identifier, ext)
+            flash(message)
+            path = os.getcwd() + "/"
+            output_file = "error_uniprot.log"
+            write_log("%s\t%s" % (current_time(), message), path + output_file)
+        elif os.path.isfile(fullpath):
+            try:
+                lines = load_lines(fullpath, verbose=self.verbose)
+            except:
+                lines = None
+        else:
+            # load source information into the object so it doesn't need be accessed all the time
+            create_directory("Data")
+            url = '%s/%s.%s' % (uniprot_rest_url, identifier, ext)
+            status, content, headers = request_conditional_url(identifier, url, verbose=self.verbose)
+
+            if status == 200 and content:
+                lines = content.splitlines()
+                with open(fullpath, "w") as output:
+                    for line in lines:
+                        output.write(line + "\n")
+                record_artifacts({"%s.%s" % (identifier, ext): artifact_validators(headers)},
+                                 self.uniprot_path_uniprot)
+            else:
+                lines = None
+                message = "Warning: %s.%s not available for download." % (identifier, ext)
+                flash(message)
+                path = os.getcwd() + "/"
+                output_file = "error_uniprot.log"
+                write_log("%s\t%s" % (current_time(), message), path + output_file)
+
+        return lines
+
+    def stage_fasta(self):
+        """Loads the UniProt fasta file"""
+
+        self.uniprot_fasta_object = self.load_uniprot_file("fasta")
+        self.uniprot_fasta = self.uniprot_fasta_object is not None
+
+        return self.uniprot_fasta
+
+    def stage_txt(self):
+        """Loads the UniProt txt file"""
+
+        self.uniprot_txt_object = self.load_uniprot_file("txt")
+        self.uniprot_txt = self.uniprot_txt_object is not None
+
+        return self.uniprot_txt
+
+    def stage_sequence(self):
+        """Parses the sequence, name, gene and species from the UniProt fasta"""
+
+        if self.uniprot_fasta:
             self.sequence, self.name, self.gene, self.species = parse_information_from_uniprot(self.uniprot_fasta_object,
                                                                                                form=self.form,
                                                                                                verbose=self.verbose)
+
+        return self.sequence, self.name, self.gene, self.species
+
+    def stage_ensembl(self):
+        """Parses the Ensembl cross-references from the UniProt txt"""
+
+        if self.uniprot_txt:
             self.ensemblg, self.ensemblt, self.ensemblp = parse_ensembl_from_uniprot(self.identifier,
                                                                                      self.uniprot_txt_object,
                                                                                      form=self.form,
                                                                                      verbose=self.verbose)
 
+        return self.ensemblg, self.ensemblt, self.ensemblp
+
+    def stage_information(self):
+        """See get_information"""
+
+        if self.verbose:
+            flash("Getting Information...")
+
+        feat = OrderedDict()
+        if self.uniprot_fasta and self.uniprot_txt:
             feat["NAME"] = self.name
             feat["SEQUENCE"] = self.sequence
             feat["GENE"] = self.gene
@@ -165,199 +409,195 @@ class CoreSEQUENCE(object):
 
         return self.information
 
-    def get_variants(self):
-        """
-        Gets a list of variants for that UniProt identifier.
-        Variants are from UNIPROT and ENSEMBL (as of July 2014).
-        """
+    def stage_variations(self):
+        """See get_variations"""
 
         if self.verbose:
-            flash("Getting Variants Information (Ensembl)...")
-
-        try:
-            assert isinstance(self.information, dict)
-        except:
-            self.get_information()
+            flash("Getting Variants and Mutations Information (Ensembl)...")
 
-        self.variants = []
+        self.variants = VariantStore()
+        self.mutations = VariantStore()
         if self.uniprot_fasta and self.uniprot_txt:
             if self.species in ensembl_species:
-                self.variants = fetch_variants_from_ensembl_rest(self.identifier, self.sequence, self.species,
-                                                                 self.ensemblg, self.ensemblt, self.ensemblp,
-                                                                 method="ENSEMBL", full=False,
-                                                                 form=self.form, verbose=self.verbose)
-        return self.variants
+                variations = fetch_variants_from_ensembl_rest(self.identifier, self.sequence, self.species,
+                                                              self.ensemblg, self.ensemblt, self.ensemblp,
+                                                              method="ALL", full=False,
+                                                              workers=self.workers,
+                                                              form="", verbose=self.verbose)
+                self.variants, self.mutations = split_variants_by_feature_type(variations)
 
-    def get_mutations(self):
-        """
-        Gets a list of variants for that Uniprot identifier.
-        Variants are from UNIPROT and ENSEMBL (as of July 2014).
-        """
+                if self.form is "plain":
+                    print(self.variants)
+                    print(self.mutations)
+                elif self.form is "json":
+                    print(json.dumps(self.variants, sort_keys=False, indent=4))
+                    print(json.dumps(self.mutations, sort_keys=False, indent=4))
 
-        if self.verbose:
-            flash("Getting Mutations Information (Ensembl)...")
+        return self.variants, self.mutations
 
-        try:
-            assert isinstance(self.information, dict)
-        except:
-            self.get_information()
+    def stage_table(self):
+        """See get_table"""
 
-        self.mutations = []
         if self.uniprot_fasta and self.uniprot_txt:
-            if self.species in ensembl_species:
+            self.table = ResidueTable(self.identifier, self.sequence, self.variants, self.mutations)
 
-                self.mutations = fetch_variants_from_ensembl_rest(self.identifier, self.sequence, self.species,
-                                                                  self.ensemblg, self.ensemblt, self.ensemblp,
-                                                                  method="COSMIC", full=False,
-                                                                  form=self.form, verbose=self.verbose)
+        return self.table
 
-        return self.mutations
-
-    def get_entities(self):
-        """
-        Gets Residues information similar to get_residues in CoreSIFTS.
-        """
+    def stage_entities(self):
+        """See get_entities"""
 
         if self.verbose:
             flash("Getting Entities...")
 
-        try:
-            assert isinstance(self.variants, list)
-        except:
-            self.get_variants()
+        # per residue entries are created lazily by the table view
+        res_entries = OrderedDict()
+        if self.uniprot_fasta and self.uniprot_txt:
+            res_entries = self.table.entities()
 
-        try:
-            assert isinstance(self.mutations, list)
-        except:
-            self.get_mutations()
+        self.entities = res_entries
+
+        return self.entities
+
+    def stage_residues(self):
+        """See get_residues"""
+
+        if self.verbose:
+            flash("Getting Residues...")
 
-        # got over each residue in the sequence
+        # per residue entries are created lazily by the table view
         res_entries = OrderedDict()
         if self.uniprot_fasta and self.uniprot_txt:
-            for i in range(len(self.sequence)):
-                site = str(i + 1)
-                res = OrderedDict()
+            res_entries = self.table.residues()
 
-                var_list = []
-                for var in self.variants:
-                    if var["SITE"] == site:
-                        var_list.append(var["SOURCE"])
-                res["VARIANTS"] = var_list
+        self.residues = res_entries
 
-                var_list = []
-                for var in self.mutations:
-                    if var["SITE"] == site:
-                        var_list.append(var["SOURCE"])
-                res["MUTATIONS"] = var_list
+        return self.residues
 
-                res_entries[str(i + 1)] = res
+    def stage_summary(self):
+        """See get_summary"""
 
-        self.entities = res_entries
+        self.summary = self.summary_mapping()
 
-        return self.entities
+        return self.summary
 
-    def get_residues(self):
+    def summary_mapping(self, tracks=None, window=15):
         """
-        Gets Residues information similar to get_residues in CoreSIFTS.
+        Builds a summary from the residue table (needs the "table" stage).
+        Summaries with extra tracks or other windows are not memoized.
+
+        @param tracks: extra summary tracks (see uniprot_summary_mapping)
+        @param window: window size of the density tracks
         """
 
         if self.verbose:
-            flash("Getting Residues...")
-
-        try:
-            assert isinstance(self.variants, list)
-        except:
-            self.get_variants()
+            flash("Getting Summary...")
 
-        try:
-            assert isinstance(self.mutations, list)
-        except:
-            self.get_mutations()
-
-        # get a dictionary of var and site
-        variants = OrderedDict()
-        for var in self.variants:
-            source = var["SOURCE"]
-            variation = var["VARIATION"]
-            site = var["SITE"]
-            variants["%s:%s" % (source, variation)] = [site]
-
-        mutations = OrderedDict()
-        for var in self.mutations:
-            source = var["SOURCE"]
-            variation = var["VARIATION"]
-            site = var["SITE"]
-            mutations["%s:%s" % (source, variation)] = [site]
-
-        # got over each residue in the sequence
-        res_entries = OrderedDict()
+        summary = OrderedDict()
         if self.uniprot_fasta and self.uniprot_txt:
-            for i in range(len(self.sequence)):
-                site = str(i + 1)
-                res = OrderedDict()
-                res["UNIPROT_ID"] = site
-                res["UNIPROT_NAME"] = self.sequence[i]
-                res["UNIPROT_ACC"] = self.identifier
+            summary = uniprot_summary_mapping(self.sequence, self.table.sites["VARIANTS"],
+                                              self.table.sites["MUTATIONS"],
+                                              tracks=tracks, window=window, form=self.form)
 
-                for var in variants:
-                    sites = variants[var]
-                    if site in sites:
-                        res[var] = self.sequence[i]
+        return summary
 
-                for var in mutations:
-                    sites = mutations[var]
-                    if site in sites:
-                        res[var] = self.sequence[i]
+    def get_information(self):
+        """
+        Gets a list of features for that UniProt identifier
+        from UNIPROT and ENSEMBL.
+        """
 
-                res_entries[str(i + 1)] = res
+        return self.stage("information")
 
-        self.residues = res_entries
+    def get_variations(self):
+        """
+        Gets the variants and the mutations for that UniProt identifier
+        at once, in a single pass over the Ensembl transcripts.
+        Variants are from UNIPROT and ENSEMBL (as of July 2014).
+        """
 
-        return self.residues
+        return self.stage("variations")
 
-    def get_summary(self):
+    def get_variants(self):
         """
-        Gets a summary view similar to get_summary in CoreSIFTS.
+        Gets a list of variants for that UniProt identifier.
+        Variants are from UNIPROT and ENSEMBL (as of July 2014).
         """
 
-        if self.verbose:
-            flash("Getting Summary...")
+        return self.stage("variations")[0]
 
-        try:
-            assert isinstance(self.entities, dict)
-        except:
-            self.get_entities()
+    def get_mutations(self):
+        """
+        Gets a list of variants for that Uniprot identifier.
+        Variants are from UNIPROT and ENSEMBL (as of July 2014).
+        """
 
-        try:
-            assert isinstance(self.residues, dict)
-        except:
-            self.get_residues()
+        return self.stage("variations")[1]
 
-        self.summary = OrderedDict()
-        if self.uniprot_fasta and self.uniprot_txt:
-            self.summary = uniprot_summary_mapping(self.entities, self.residues, form=self.form)
+    def get_table(self):
+        """
+        Gets the compact per residue table with the variants and mutations
+        indexed by site (built once per identifier, see tables.ResidueTable).
+        """
 
-        return self.summary
+        return self.stage("table")
+
+    def get_entities(self):
+        """
+        Gets Residues information similar to get_residues in CoreSIFTS.
+        """
+
+        return self.stage("entities")
+
+    def get_residues(self):
+        """
+        Gets Residues information similar to get_residues in CoreSIFTS.
+        """
+
+        return self.stage("residues")
+
+    def get_summary(self, tracks=None, window=15):
+        """
+        Gets a summary view similar to get_summary in CoreSIFTS.
+        The summary is built from the residue table, so it does not
+        need the per residue entities/residues.
+
+        @param tracks: extra summary tracks (see uniprot_summary_mapping)
+        @param window: window size of the density tracks
+        """
+
+        if tracks is None and window == 15:
+            return self.stage("summary")
+
+        # the memoized (and stored) summary is the default one
+        self.stage("table")
+        return self.summary_mapping(tracks=tracks, window=window)
 
 
-def main_handler(identifier, form="plain", verbose=True):
+def main_handler(identifier, form="plain", verbose=True, workers=1, source=None):
     """
     Calls program pipelines according to the input argument.
 
     @param identifier: UNIPROT identifier
     @param form: output format
     @param verbose: Boolean
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param source: optional local UniProt source (see CoreSEQUENCE)
     @return: returns a dictionary with variation information
     """
 
     information = OrderedDict()
 
-    sequence = CoreSEQUENCE(identifier, db=False, form="", verbose=verbose)
-    info = sequence.get_information()
-    variants = sequence.get_variants()
-    mutations = sequence.get_mutations()
-    residues = sequence.get_residues()
-    summary = sequence.get_summary()
+    with measure_identifier(get_metrics(), identifier):
+        try:
+            sequence = CoreSEQUENCE(identifier, db=True, workers=workers, source=source, form="", verbose=verbose)
+            info = sequence.get_information()
+            variants, mutations = sequence.get_variations()
+            residues = sequence.get_residues()
+            summary = sequence.get_summary()
+            sequence.save_results()
+        finally:
+            # the failures only matter to save_results (long-running processes would accumulate them)
+            reset_request_failures(identifier)
 
     information["INFORMATION"] = info
     information["VARIANTS"] = variants
@@ -368,11 +608,269 @@ def main_handler(identifier, form="plain", verbose=True):
     if form is "plain":
         print(information)
     elif form is "json":
-        print(json.dumps(information, sort_keys=False, indent=4))
+        print(json.dumps(information, sort_keys=False, indent=4, default=serialize_table))
 
     return information
 
 
+class UniProtPrefetcher(threading.Thread):
+    """
+    Background thread that downloads the missing UniProt entries of a list
+    of identifiers in batches (see prefetch_uniprot_entries), so identifiers
+    already in Data/ can be processed meanwhile.
+    """
+
+    def __init__(self, identifiers, chunk_size=100, verbose=True):
+        """
+        Init method.
+
+        @param identifiers: list of UNIPROT identifiers
+        @param chunk_size: number of identifiers per batch
+        @param verbose: Boolean
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.chunk_size = chunk_size
+        self.verbose = verbose
+        self.path = os.getcwd() + "/Data"
+
+        # identifiers still to be downloaded, in input order
+        self.missing = OrderedDict()
+        for identifier in identifiers:
+            for ext in ("fasta", "txt"):
+                if not os.path.isfile("%s/%s.%s" % (self.path, identifier, ext)):
+                    self.missing[identifier] = threading.Event()
+                    break
+
+        return
+
+    def run(self):
+        """Downloads the missing entries, batch by batch"""
+
+        identifiers = list(self.missing)
+        for i in range(0, len(identifiers), self.chunk_size):
+            chunk = identifiers[i:i + self.chunk_size]
+            try:
+                prefetch_uniprot_entries(chunk, self.path, chunk_size=self.chunk_size, verbose=self.verbose)
+            finally:
+                # entries not downloaded are fetched individually by CoreSEQUENCE
+                for identifier in chunk:
+                    self.missing[identifier].set()
+
+        return
+
+    def order(self, identifiers):
+        """Gets the identifiers already in Data/ first, then the ones to download"""
+
+        return [identifier for identifier in identifiers if identifier not in self.missing] + \
+               [identifier for identifier in identifiers if identifier in self.missing]
+
+    def wait(self, identifier):
+        """Waits until the batch of an identifier has been downloaded"""
+
+        if identifier in self.missing:
+            self.missing[identifier].wait()
+
+        return
+
+
+class NDJSONWriter(object):
+    """
+    Writes compact JSON records, one per line (NDJSON), to a file object.
+    At most buffer_size records are held before being written out, and
+    writes from several threads never interleave within a line.
+    """
+
+    def __init__(self, output=sys.stdout, buffer_size=256):
+        """
+        Init method.
+
+        @param output: file object where the records are written to
+        @param buffer_size: maximum number of records buffered
+        """
+
+        self.output = output
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = threading.Lock()
+
+        return
+
+    def write(self, record):
+        """
+        Writes a record (flushed once the buffer is full).
+
+        @param record: JSON serializable object
+        """
+
+        line = json.dumps(record, sort_keys=False, separators=(",", ":"), default=serialize_table)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_size:
+                self.flush_buffer()
+
+        return
+
+    def flush(self):
+        """Writes out all the buffered records"""
+
+        with self.lock:
+            self.flush_buffer()
+
+        return
+
+    def flush_buffer(self):
+        """Writes out the buffer (must be called with self.lock held)"""
+
+        if self.buffer:
+            self.output.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.output.flush()
+
+        return
+
+
+def stream_handler(identifier, writer, records="identifier", workers=1, source=None, verbose=True):
+    """
+    Calls the program pipelines like main_handler, but streams the results
+    as NDJSON records: either a single record per identifier, written once
+    it completes, or a record per information/variant/mutation/residue/summary
+    entry, written as soon as each stage finishes.
+
+    @param identifier: UNIPROT identifier
+    @param writer: NDJSONWriter object
+    @param records: "identifier" or "entry"
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param source: optional local UniProt source (see CoreSEQUENCE)
+    @param verbose: Boolean
+    """
+
+    if records == "identifier":
+        information = OrderedDict()
+        information["UNIPROT_ACC"] = identifier
+        information.update(main_handler(identifier, workers=workers, source=source, form="", verbose=verbose))
+        writer.write(information)
+        writer.flush()
+        return
+
+    def entry(record, data, site=None):
+        entry = OrderedDict()
+        entry["UNIPROT_ACC"] = identifier
+        entry["RECORD"] = record
+        if site is not None:
+            entry["SITE"] = site
+        entry["DATA"] = data
+        return entry
+
+    with measure_identifier(get_metrics(), identifier):
+        try:
+            sequence = CoreSEQUENCE(identifier, db=True, workers=workers, source=source, form="", verbose=verbose)
+            writer.write(entry("INFORMATION", sequence.get_information()))
+            writer.flush()
+
+            variants, mutations = sequence.get_variations()
+            for variant in variants:
+                writer.write(entry("VARIANT", variant))
+            writer.flush()
+
+            for mutation in mutations:
+                writer.write(entry("MUTATION", mutation))
+            writer.flush()
+
+            residues = sequence.get_residues()
+            for site in residues:
+                writer.write(entry("RESIDUE", residues[site], site=site))
+            writer.flush()
+
+            writer.write(entry("SUMMARY", sequence.get_summary()))
+            writer.flush()
+            sequence.save_results()
+        finally:
+            reset_request_failures(identifier)
+
+    return
+
+
+def batch_handler(identifiers, jobs=1, workers=1, output=sys.stdout, writer=None, records="identifier",
+                  prefetch=False, source=None, verbose=True):
+    """
+    Runs main_handler for many identifiers concurrently (in a thread pool
+    of 'jobs' threads). The JSON of each identifier is written out as soon
+    as it completes, as a compact line with its UNIPROT_ACC (as the
+    stream_handler records), and failing identifiers do not abort the batch.
+
+    @param identifiers: list of UNIPROT identifiers
+    @param jobs: number of identifiers processed concurrently
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param output: file object where the JSON lines are written to
+    @param writer: optional NDJSONWriter, streams NDJSON records (see stream_handler)
+        instead of writing the JSON to output
+    @param records: NDJSON records: "identifier" or "entry"
+    @param prefetch: Boolean downloads the missing UniProt entries in batches,
+        while the identifiers already in Data/ are processed
+    @param source: optional local UniProt source (see CoreSEQUENCE)
+    @param verbose: Boolean
+    @return: returns a dictionary with the error message of each failed identifier
+    """
+
+    # every job can keep 'workers' connections busy at the same time
+    configure_http_session(pool_maxsize=max(10, jobs * workers))
+
+    prefetcher = None
+    if prefetch and (source is None or not source.offline):
+        prefetcher = UniProtPrefetcher(identifiers, verbose=verbose)
+        prefetcher.start()
+        identifiers = prefetcher.order(identifiers)
+
+    def handler(identifier):
+        try:
+            if prefetcher is not None:
+                prefetcher.wait(identifier)
+            if writer is not None:
+                stream_handler(identifier, writer, records=records, workers=workers, source=source,
+                               verbose=verbose)
+                return identifier, None, None
+            information = main_handler(identifier, workers=workers, source=source, form="", verbose=verbose)
+            return identifier, information, None
+        except Exception as error:
+            return identifier, None, "%s: %s" % (type(error).__name__, error)
+
+    errors = OrderedDict()
+    run_metrics = get_metrics()
+    pool = ThreadPool(max(1, min(jobs, len(identifiers))))
+    try:
+        for identifier, information, error in pool.imap_unordered(handler, identifiers):
+            if run_metrics is not None:
+                # long batches: the Prometheus text file is rewritten periodically
+                run_metrics.flush()
+            if error is None:
+                if information is not None:
+                    # records are written in completion order, so each one carries its identifier
+                    record = OrderedDict()
+                    record["UNIPROT_ACC"] = identifier
+                    record.update(information)
+                    output.write(json.dumps(record, sort_keys=False, separators=(",", ":"),
+                                            default=serialize_table) + "\n")
+                    output.flush()
+            else:
+                errors[identifier] = error
+                message = "%s\tError: %s" % (identifier, error)
+                path = os.getcwd() + "/"
+                output_file = "error_main.log"
+                write_log("%s\t%s" % (current_time(), message), path + output_file)
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        sys.stderr.write("%s of %s identifiers failed:\n" % (len(errors), len(identifiers)))
+        for identifier in errors:
+            sys.stderr.write("%s\t%s\n" % (identifier, errors[identifier]))
+
+    return errors
+
+
 def main():
     """
     Simple main option parser. It does not use OptionParser and ArgumentParser,
@@ -386,11 +884,164 @@ def main():
                         dest='entries', help='input UniProt ID(s)')
     parser.add_argument('-v', '-verbose', dest='verbose', default=False,
                         help='turns verbosity on', action='store_true')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, default=1,
+                        dest='workers', help='number of Ensembl transcripts fetched concurrently')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        dest='jobs', help='number of UniProt ID(s) processed concurrently')
+    parser.add_argument('--cache', metavar='DIR', type=str, default=None,
+                        dest='cache', help='caches the REST responses in DIR')
+    parser.add_argument('--cache-ttl', metavar='S', type=int, default=7 * 24 * 3600,
+                        dest='cache_ttl', help='time to live of the cached responses, in seconds')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=1024,
+                        dest='cache_size', help='maximum size of the response cache, in megabytes')
+    parser.add_argument('--rate', metavar='R', type=float, default=15.0,
+                        dest='rate', help='maximum number of requests per second per host')
+    parser.add_argument('--rate-state', metavar='DIR', type=str, default=None,
+                        dest='rate_state', help='shares the request rate limit with other processes through DIR')
+    parser.add_argument('--sequence-store', metavar='DIR', type=str, default=None,
+                        dest='sequence_store', help='keeps the Ensembl protein sequences in DIR (per Ensembl release)')
+    parser.add_argument('--db', metavar='FILE', type=str, default=None,
+                        dest='db', help='stores the results in (and loads the current ones from) a SQLite database')
+    parser.add_argument('--refresh', dest='refresh', default=False, action='store_true',
+                        help='refreshes the local UniProt files of the input (or all the local) ID(s) and '
+                             'processes only the ones whose inputs changed')
+    parser.add_argument('-o', '--output', metavar='FILE', type=str, default=None,
+                        dest='output', help='writes the output to FILE instead of stdout')
+    parser.add_argument('--ndjson', dest='ndjson', default=False, action='store_true',
+                        help='streams compact JSON records, one per line')
+    parser.add_argument('--ndjson-records', dest='records', default='identifier', choices=['identifier', 'entry'],
+                        help='one NDJSON record per identifier or per information/variant/residue/etc. entry')
+    parser.add_argument('--prefetch', dest='prefetch', default=False, action='store_true',
+                        help='downloads the missing UniProt entries in batches')
+    parser.add_argument('--uniprot-dat', metavar='FILE', type=str, default=None,
+                        dest='uniprot_dat', help='reads UniProt entries offline from a release flat file '
+                                                '(sequences come from its SQ blocks without --uniprot-fasta)')
+    parser.add_argument('--uniprot-fasta', metavar='FILE', type=str, default=None,
+                        dest='uniprot_fasta', help='reads UniProt sequences offline from a release fasta file')
+    parser.add_argument('--fasta', metavar='FILE', type=str, default=None,
+                        dest='fasta', help='reads UniProt sequences from a multi-record fasta file '
+                                           '(all its records are processed if no ID(s) are provided)')
+    parser.add_argument('--serve', metavar='PORT', type=int, default=None,
+                        dest='serve', help='serves the results over a local HTTP/JSON API on PORT '
+                                           '(GET /variants/<ID>, POST /variants, /health, /metrics)')
+    parser.add_argument('--host', metavar='HOST', type=str, default='127.0.0.1',
+                        dest='host', help='address the HTTP/JSON API listens on')
+    parser.add_argument('--queue-size', metavar='N', type=int, default=64,
+                        dest='queue_size', help='maximum number of ID(s) waiting to be processed by the API')
+    parser.add_argument('--metrics', metavar='FILE', type=str, default=None,
+                        dest='metrics', help='writes a JSON report of the request and stage metrics to FILE')
+    parser.add_argument('--metrics-prom', metavar='FILE', type=str, default=None,
+                        dest='metrics_prom', help='writes the metrics to FILE in the Prometheus text format '
+                                                  '(rewritten periodically during the run)')
+    parser.add_argument('--metrics-interval', metavar='S', type=float, default=60.0,
+                        dest='metrics_interval', help='time between rewrites of the Prometheus metrics file, '
+                                                      'in seconds')
 
     args = parser.parse_args()
-    if isinstance(args.entries, list):
-        for identifier in args.entries:
-            main_handler(identifier, form="json", verbose=args.verbose)
+    if args.output is None and args.serve is None:
+        # the records are written to stdout: diagnostics must not be mixed into them
+        set_diagnostics_output(sys.stderr)
+
+    scheduler = RequestScheduler(rate=args.rate, state_dir=args.rate_state)
+    set_request_scheduler(scheduler)
+
+    run_metrics = None
+    if args.metrics is not None or args.metrics_prom is not None:
+        # the service runs until stopped: only the most recent identifier records are kept
+        run_metrics = Metrics(prometheus_path=args.metrics_prom, interval=args.metrics_interval,
+                              max_identifiers=service_max_identifiers if args.serve is not None else None)
+        set_metrics(run_metrics)
+
+    if args.cache is not None:
+        cache = ResponseCache(args.cache, ttl=args.cache_ttl, max_size=args.cache_size * 1024 * 1024)
+        set_response_cache(cache)
+    else:
+        cache = None
+
+    release = None
+    if args.sequence_store is not None or args.db is not None:
+        release = fetch_ensembl_release(verbose=args.verbose)
+
+    uniprot_release = None
+    if args.db is not None:
+        # the current UniProt release, or else the one of the last refresh of Data/
+        uniprot_release = fetch_uniprot_release(verbose=args.verbose)
+        if uniprot_release is None:
+            uniprot_release = load_manifest(os.getcwd() + "/Data")["RELEASES"]["UNIPROT"]
+
+    store = None
+    if args.sequence_store is not None:
+        store = SequenceStore(args.sequence_store, release=release)
+        set_sequence_store(store)
+
+    results = None
+    if args.db is not None:
+        results = ResultsStore(args.db, version=results_version(ensembl_release=release, uniprot_release=uniprot_release))
+        set_results_store(results)
+
+    source = None
+    if args.uniprot_dat is not None or args.uniprot_fasta is not None:
+        source = UniProtRelease(args.uniprot_dat, args.uniprot_fasta, verbose=args.verbose)
+    if args.fasta is not None:
+        source = UniProtFasta(args.fasta, txt_source=source, verbose=args.verbose)
+        if args.entries is None:
+            args.entries = source.identifiers()
+
+    if args.refresh:
+        changed, report = refresh_uniprot_entries(args.entries, jobs=args.jobs, verbose=args.verbose)
+        # a new Ensembl release marks every identifier as changed: which variants
+        # changed is only known by fetching them again, so all the stored results
+        # and cached responses (keyed by URL hash, not by server) are dropped
+        if results is not None:
+            results.remove(changed)
+        if cache is not None and report["ensembl_changed"]:
+            cache.clear()
+        args.entries = changed
+        if not changed:
+            flash("...Nothing changed since the last refresh.")
+
+    if args.serve is not None:
+        # the service runs main_handler, so it is only imported here
+        from service import serve_variants
+        serve_variants(host=args.host, port=args.serve, jobs=args.jobs, queue_size=args.queue_size,
+                       workers=args.workers, source=source, verbose=args.verbose)
+        if run_metrics is not None:
+            if args.metrics is not None:
+                run_metrics.write_report(args.metrics)
+            run_metrics.flush(force=True)
+    elif isinstance(args.entries, list):
+        # the same records (a JSON line per identifier, see batch_handler) for any number of jobs and output
+        output = sys.stdout
+        if args.output is not None:
+            output = open(args.output, "w")
+        writer = None
+        if args.ndjson:
+            writer = NDJSONWriter(output)
+        try:
+            errors = batch_handler(args.entries, jobs=args.jobs, workers=args.workers, output=output,
+                                   writer=writer, records=args.records, prefetch=args.prefetch,
+                                   source=source, verbose=args.verbose)
+        finally:
+            if writer is not None:
+                writer.flush()
+            if output is not sys.stdout:
+                output.close()
+        if args.verbose:
+            flash("Request scheduler: %s" % scheduler.stats())
+            if cache is not None:
+                flash("Response cache: %s" % cache.stats())
+            if store is not None:
+                flash("Sequence store: %s" % store.stats())
+            if results is not None:
+                flash("Results store: %s" % results.stats())
+        if run_metrics is not None:
+            if args.metrics is not None:
+                run_metrics.write_report(args.metrics)
+            run_metrics.flush(force=True)
+            if args.verbose:
+                flash("Metrics: %s" % run_metrics.report()["RUN"])
+        if errors:
+            sys.exit(1)
     else:
         print "...No input provided! Check the program help with 'python main.py -h'"
 
@@ -0,0 +1,489 @@
+#!/usr/bin/env python2.7
+
+import os
+import copy
+import json
+import time
+import bisect
+import tempfile
+import threading
+from contextlib import contextmanager
+from urlparse import urlsplit
+from collections import OrderedDict
+
+# upper bounds (in seconds) of the latency/duration histogram buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# REST endpoint families, by the first component of the URL path
+endpoint_families = ("sequence", "overlap", "variation", "lookup", "info")
+
+# per identifier records kept by long-running processes (e.g. the service)
+service_max_identifiers = 1024
+
+
+def cpu_time():
+    """Gets the CPU time (user and system) used by the process, in seconds"""
+
+    return sum(os.times()[0:2])
+
+
+def endpoint_family(url):
+    """
+    Gets the endpoint family a request is accounted under.
+
+    @param url: request URL
+    @return: returns "uniprot", "sequence", "overlap", "variation", "lookup",
+        "info" or "other"
+    """
+
+    url = urlsplit(url)
+    if "uniprot" in url.netloc or "/uniprot" in url.path:
+        return "uniprot"
+    family = url.path.lstrip("/").split("/", 1)[0]
+    if family in endpoint_families:
+        return family
+
+    return "other"
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observations (Prometheus style): the count
+    of observations lower or equal than each bucket bound, their sum
+    and maximum. Must be updated with the owner's lock held.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        """
+        Init method.
+
+        @param buckets: sorted upper bounds of the buckets
+        """
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+        return
+
+    def observe(self, value):
+        """Adds an observation"""
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+        return
+
+    def report(self):
+        """
+        Gets the histogram summary.
+
+        @return: returns a dictionary with count, sum, mean, max and the
+            (cumulative) count of each bucket
+        """
+
+        report = OrderedDict()
+        report["count"] = self.count
+        report["sum"] = round(self.sum, 6)
+        report["mean"] = round(self.sum / self.count, 6) if self.count else 0.0
+        report["max"] = round(self.max, 6)
+        buckets = OrderedDict()
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            buckets[str(bound)] = total
+        buckets["+Inf"] = self.count
+        report["buckets"] = buckets
+
+        return report
+
+    def prometheus(self, name, labels):
+        """
+        Gets the histogram samples in the Prometheus text format.
+
+        @param name: metric name
+        @param labels: label str() (e.g. 'stage="table"')
+        @return: returns a list of lines
+        """
+
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, total))
+        lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels, repr(self.sum)))
+        lines.append('%s_count{%s} %s' % (name, labels, self.count))
+
+        return lines
+
+
+class Metrics(object):
+    """
+    Run metrics: request count, latency, bytes, retries and status codes
+    per REST endpoint family (see endpoint_family), wall time per
+    CoreSEQUENCE stage and per identifier, and the CPU time of the run.
+    The metrics are reported as a JSON document (see report) and in the
+    Prometheus text format (see prometheus), which can be rewritten
+    periodically during long batches. CPU time is only measured for the
+    whole process, as concurrent identifiers and stages share it.
+
+    Identifiers are counted in totals, and the records of the most
+    recently processed ones (their wall time per stage) are kept up to
+    max_identifiers, so long-running processes do not grow without limit.
+    """
+
+    def __init__(self, buckets=default_buckets, prometheus_path=None, interval=60.0, max_identifiers=None):
+        """
+        Init method.
+
+        @param buckets: upper bounds of the histogram buckets, in seconds
+        @param prometheus_path: optional Prometheus text file rewritten by flush()
+        @param interval: minimum time between flush() rewrites, in seconds
+        @param max_identifiers: maximum number of identifier records kept
+            (None keeps all, e.g. for the report of a batch)
+        """
+
+        self.buckets = buckets
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.max_identifiers = max_identifiers
+
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.start_cpu = cpu_time()
+        self.flushed = 0.0
+
+        self.endpoints = OrderedDict()
+        self.stages = OrderedDict()
+        # identifier -> record, least recently used first
+        self.identifiers = OrderedDict()
+        self.processed = 0
+        self.failed = 0
+        self.identifiers_wall = 0.0
+
+        return
+
+    def endpoint(self, family):
+        """
+        Gets the counters of an endpoint family.
+        Must be called with self.lock held.
+        """
+
+        if family not in self.endpoints:
+            counters = OrderedDict()
+            counters["requests"] = 0
+            counters["cached"] = 0
+            counters["failed"] = 0
+            counters["retries"] = 0
+            counters["bytes"] = 0
+            counters["status"] = OrderedDict()
+            counters["latency"] = Histogram(self.buckets)
+            self.endpoints[family] = counters
+
+        return self.endpoints[family]
+
+    def record_request(self, url, latency, size=0, retries=0, status=None):
+        """
+        Records a request sent to a REST server.
+
+        @param url: request URL
+        @param latency: time until the response (throttle waits and retries
+            included), in seconds
+        @param size: size of the response body, in bytes
+        @param retries: number of times the request was retried
+        @param status: HTTP status code (None if the server could not be reached)
+        """
+
+        family = endpoint_family(url)
+        with self.lock:
+            counters = self.endpoint(family)
+            counters["requests"] += 1
+            counters["retries"] += retries
+            counters["bytes"] += size
+            if status is None:
+                counters["failed"] += 1
+            status = str(status)
+            counters["status"][status] = counters["status"].get(status, 0) + 1
+            counters["latency"].observe(latency)
+
+        return
+
+    def record_bytes(self, url, size):
+        """
+        Records the size of a streamed response, once it is read.
+
+        @param url: request URL
+        @param size: size of the response body, in bytes
+        """
+
+        family = endpoint_family(url)
+        with self.lock:
+            self.endpoint(family)["bytes"] += size
+
+        return
+
+    def record_cached(self, url):
+        """
+        Records a request answered by the response cache.
+
+        @param url: request URL
+        """
+
+        family = endpoint_family(url)
+        with self.lock:
+            self.endpoint(family)["cached"] += 1
+
+        return
+
+    def record_stage(self, identifier, name, wall):
+        """
+        Records a computed CoreSEQUENCE stage.
+
+        @param identifier: UniProt identifier
+        @param name: stage name (see CoreSEQUENCE.stage_graph)
+        @param wall: wall time, in seconds
+        """
+
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = Histogram(self.buckets)
+            self.stages[name].observe(wall)
+            record = self.identifier(identifier) if identifier is not None else None
+            if record is not None:
+                record["STAGES"][name] = round(record["STAGES"].get(name, 0.0) + wall, 6)
+
+        return
+
+    def identifier(self, identifier):
+        """
+        Gets the record of an identifier (None if no records are kept),
+        evicting the least recently used ones over max_identifiers.
+        Must be called with self.lock held.
+        """
+
+        if self.max_identifiers is not None and self.max_identifiers <= 0:
+            return None
+
+        record = self.identifiers.pop(identifier, None)
+        if record is None:
+            record = OrderedDict()
+            record["WALL"] = 0.0
+            record["ERROR"] = False
+            record["STAGES"] = OrderedDict()
+        self.identifiers[identifier] = record
+        if self.max_identifiers is not None:
+            while len(self.identifiers) > self.max_identifiers:
+                self.identifiers.popitem(last=False)
+
+        return record
+
+    def record_identifier(self, identifier, wall, error=False):
+        """
+        Records a processed identifier.
+
+        @param identifier: UniProt identifier
+        @param wall: wall time, in seconds
+        @param error: Boolean the identifier failed
+        """
+
+        with self.lock:
+            self.processed += 1
+            self.failed += 1 if error else 0
+            self.identifiers_wall += wall
+            record = self.identifier(identifier)
+            if record is not None:
+                record["WALL"] = round(record["WALL"] + wall, 6)
+                record["ERROR"] = record["ERROR"] or error
+
+        return
+
+    def report(self):
+        """
+        Gets the metrics report.
+
+        @return: returns a dictionary with the run totals (RUN), and the
+            metrics per endpoint family (REQUESTS), stage (STAGES) and
+            identifier (IDENTIFIERS, the ones kept, see max_identifiers)
+        """
+
+        with self.lock:
+            report = OrderedDict()
+            run = OrderedDict()
+            run["wall"] = round(time.time() - self.start, 6)
+            run["cpu"] = round(cpu_time() - self.start_cpu, 6)
+            run["identifiers"] = self.processed
+            run["failed"] = self.failed
+            run["requests"] = sum([self.endpoints[family]["requests"] for family in self.endpoints])
+            run["bytes"] = sum([self.endpoints[family]["bytes"] for family in self.endpoints])
+            report["RUN"] = run
+
+            report["REQUESTS"] = OrderedDict()
+            for family in self.endpoints:
+                counters = OrderedDict(self.endpoints[family])
+                counters["status"] = OrderedDict(counters["status"])
+                counters["latency"] = counters["latency"].report()
+                report["REQUESTS"][family] = counters
+
+            report["STAGES"] = OrderedDict()
+            for name in self.stages:
+                stage = OrderedDict()
+                stage["wall"] = self.stages[name].report()
+                report["STAGES"][name] = stage
+
+            report["IDENTIFIERS"] = copy.deepcopy(self.identifiers)
+
+        return report
+
+    def prometheus(self, prefix="codereview"):
+        """
+        Gets the metrics in the Prometheus text exposition format
+        (identifiers are only accounted in totals, to bound the number
+        of series).
+
+        @param prefix: metric name prefix
+        @return: returns a str()
+        """
+
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            return "%s_%s" % (prefix, name)
+
+        with self.lock:
+            name = metric("requests_total", "counter", "REST requests sent, per endpoint family and status")
+            for family in self.endpoints:
+                for status, count in self.endpoints[family]["status"].items():
+                    lines.append('%s{endpoint="%s",status="%s"} %s' % (name, family, status, count))
+            for key, help in (("cached", "REST requests answered by the response cache"),
+                              ("failed", "REST requests that could not reach the server"),
+                              ("retries", "REST request retries (throttled or unavailable)"),
+                              ("bytes", "REST response bytes received")):
+                name = metric("request_%s_total" % key, "counter", help)
+                for family in self.endpoints:
+                    lines.append('%s{endpoint="%s"} %s' % (name, family, self.endpoints[family][key]))
+            name = metric("request_duration_seconds", "histogram", "REST request latency (retries included)")
+            for family in self.endpoints:
+                lines.extend(self.endpoints[family]["latency"].prometheus(name, 'endpoint="%s"' % family))
+
+            name = metric("stage_duration_seconds", "histogram", "CoreSEQUENCE stage wall time")
+            for stage in self.stages:
+                lines.extend(self.stages[stage].prometheus(name, 'stage="%s"' % stage))
+
+            name = metric("identifiers_total", "counter", "UniProt identifiers processed")
+            lines.append('%s{status="ok"} %s' % (name, self.processed - self.failed))
+            lines.append('%s{status="failed"} %s' % (name, self.failed))
+            name = metric("identifier_seconds_total", "counter", "UniProt identifiers wall time")
+            lines.append('%s %s' % (name, repr(self.identifiers_wall)))
+
+            name = metric("run_seconds", "gauge", "Run wall time")
+            lines.append('%s %s' % (name, repr(time.time() - self.start)))
+            name = metric("run_cpu_seconds", "gauge", "Run CPU time")
+            lines.append('%s %s' % (name, repr(cpu_time() - self.start_cpu)))
+
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path):
+        """
+        Writes the metrics report as JSON.
+
+        @param path: output file path
+        """
+
+        write_atomic(json.dumps(self.report(), indent=4) + "\n", path)
+
+        return
+
+    def write_prometheus(self, path=None):
+        """
+        Writes the metrics in the Prometheus text format.
+
+        @param path: output file path (defaults to prometheus_path)
+        """
+
+        path = path or self.prometheus_path
+        if path is not None:
+            write_atomic(self.prometheus(), path)
+            self.flushed = time.time()
+
+        return
+
+    def flush(self, force=False):
+        """
+        Rewrites the Prometheus text file (if set) if 'interval' seconds
+        passed since it was last written.
+
+        @param force: Boolean writes it anyway
+        """
+
+        if self.prometheus_path is not None and (force or time.time() - self.flushed >= self.interval):
+            self.write_prometheus()
+
+        return
+
+
+@contextmanager
+def measure_identifier(run_metrics, identifier):
+    """
+    Records the wall time of the block processing an identifier (and
+    whether it raised), if metrics are enabled.
+
+    @param run_metrics: Metrics object or None
+    @param identifier: UniProt identifier
+    """
+
+    if run_metrics is None:
+        yield
+        return
+
+    start = time.time()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        run_metrics.record_identifier(identifier, time.time() - start, error=error)
+
+
+def write_atomic(content, path):
+    """
+    Writes a file through a temporary file renamed at the end, so readers
+    (e.g. a Prometheus node exporter) never see it partially written.
+
+    @param content: file content str()
+    @param path: output file path
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(prefix=".", dir=directory)
+    with os.fdopen(handle, "w") as output:
+        output.write(content)
+    os.rename(tmp_path, path)
+
+    return
+
+
+if __name__ == "__main__":
+    # testing routines
+    # identifier records are bounded, the totals are not
+    run_metrics = Metrics(max_identifiers=2)
+    for identifier in ("P00439", "P04637", "P00439", "Q99999"):
+        run_metrics.record_stage(identifier, "table", 0.5)
+        run_metrics.record_identifier(identifier, 1.0, error=identifier == "Q99999")
+    report = run_metrics.report()
+    assert report["IDENTIFIERS"].keys() == ["P00439", "Q99999"]
+    assert report["IDENTIFIERS"]["P00439"]["STAGES"]["table"] == 1.0
+    assert report["RUN"]["identifiers"] == 4 and report["RUN"]["failed"] == 1
+    assert report["STAGES"]["table"]["wall"]["count"] == 4
+    assert 'codereview_identifiers_total{status="failed"} 1' in run_metrics.prometheus()
+    run_metrics = Metrics(max_identifiers=0)
+    run_metrics.record_stage("P00439", "table", 0.5)
+    run_metrics.record_identifier("P00439", 1.0)
+    assert run_metrics.report()["IDENTIFIERS"] == {} and run_metrics.report()["RUN"]["identifiers"] == 1
@@ -1,7 +1,78 @@
 #!/usr/bin/env python2.7
 
+import json
+from itertools import chain
+from cStringIO import StringIO
+from collections import OrderedDict
+
 from utils import flash
 
+# characters that may continue a JSON number (e.g. "1." + "5", "1e" + "-5")
+json_number_continuation = "0123456789.eE+-"
+
+
+def parse_fasta_header(header):
+    """
+    Gets the accession, name, gene and species from a UniProt fasta header.
+
+    @param header: fasta header line (including the '>')
+    @return: returns accession, name, gene and species
+    """
+
+    header = header.rstrip("\r\n")
+    # example header: it includes the '>' (fasta format)
+    """
+    >sp|P04217|A1BG_HUMAN Alpha-1B-glycoprotein OS=Homo sapiens GN=A1BG PE=1 SV=4
+    """
+    try:
+        accession = header.split("|")[1]
+    except:
+        try:
+            accession = header.lstrip(">").split()[0]
+        except:
+            accession = "-"
+    try:
+        name = (header.split("|")[2]).split()[0]
+    except:
+        name = "-"
+    try:
+        gene = (header.split("GN=")[1]).split()[0]
+    except:
+        gene = "-"
+    try:
+        species = ("_".join((header.split("OS=")[1]).split()[0:2])).lower()
+    except:
+        species = "-"
+
+    return accession, name, gene, species
+
+
+def iter_fasta_records(fasta_handle):
+    """
+    Parses the records of a (multi-record) fasta file or stream, one at
+    a time, so files of any size can be read with constant memory per
+    record. Sequence lines are joined once per record.
+
+    @param fasta_handle: file handle, iterable of lines or str() buffer
+    @return: yields accession, name, gene, species and sequence
+    """
+
+    if isinstance(fasta_handle, basestring):
+        fasta_handle = StringIO(fasta_handle)
+
+    header = None
+    chunks = []
+    for line in fasta_handle:
+        if line.startswith(">"):
+            if header is not None:
+                yield parse_fasta_header(header) + ("".join(chunks),)
+            header = line
+            chunks = []
+        elif header is not None:
+            chunks.append(line.strip())
+    if header is not None:
+        yield parse_fasta_header(header) + ("".join(chunks),)
+
 
 def parse_information_from_uniprot(fasta_object, form="plain", verbose=True):
     """
@@ -20,30 +91,13 @@ def parse_information_from_uniprot(fasta_object, form="plain", verbose=True):
     name = ""
     gene = ""
     species = ""
-    fasta = ""
-
-    for count, line in enumerate(fasta_object):
-        if count is 0:
-            header = line.rstrip("\r\n")
-            # example header: it includes the '>' (fasta format)
-            """
-            >sp|P04217|A1BG_HUMAN Alpha-1B-glycoprotein OS=Homo sapiens GN=A1BG PE=1 SV=4
-            """
-            try:
-                name = (header.split("|")[2]).split()[0]
-            except:
-                name = "-"
-            try:
-                gene = (header.split("GN=")[1]).split()[0]
-            except:
-                gene = "-"
-            try:
-                species = ("_".join((header.split("OS=")[1]).split()[0:2])).lower()
-            except:
-                species = "-"
-        else:
-            sequence += line.rstrip("\r\n")
-        fasta += line
+
+    # the first line is the header (as before, even if it does not start with '>')
+    lines = iter(fasta_object)
+    header = next(lines, None)
+    if header is not None:
+        accession, name, gene, species = parse_fasta_header(header)
+        sequence = "".join([line.rstrip("\r\n") for line in lines])
 
     if form is "plain":
         print(sequence, name, gene, species)
@@ -51,13 +105,262 @@ def parse_information_from_uniprot(fasta_object, form="plain", verbose=True):
     return sequence, name, gene, species
 
 
+def parse_uniprot_txt_stream(identifier, txt_handle, features=True, checksum=True, skip_to_end=False):
+    """
+    Single-pass streaming parser of a UniProt txt (flat file) entry. Reads
+    the header (ID/AC), the Ensembl cross-references (isoform aware, as in
+    parse_ensembl_from_uniprot), the FT features and the SQ CRC64 checksum.
+    It stops reading as soon as it has what it needs: at the SQ line (the
+    sequence block is never read), or right after the DR block if neither
+    the features nor the checksum are needed.
+
+    @param identifier: UniProt ID (used to select the Ensembl isoforms;
+        None uses the entry primary accession)
+    @param txt_handle: file handle, iterable of lines or str() buffer
+    @param features: Boolean parses the FT features
+    @param checksum: Boolean parses the SQ CRC64 checksum
+    @param skip_to_end: Boolean consumes the rest of the entry (up to '//'),
+        so the next entry of a multi-entry stream can be parsed
+    @return: returns a dictionary with NAME, ACCESSIONS, ENSEMBL_GENE,
+        ENSEMBL_TRANSCRIPT, ENSEMBL_PROTEIN, FEATURES (list of (type, start,
+        end, description) tuples) and CRC64 (None if the stream had no entry)
+    """
+
+    if isinstance(txt_handle, basestring):
+        txt_handle = StringIO(txt_handle)
+
+    # example lines
+    """
+    ID   PH4H_HUMAN              Reviewed;         452 AA.
+    AC   P00439; Q16717; Q8TC14;
+    DR   Ensembl; ENST00000553106; ENSP00000448059; ENSG00000171759.
+    FT   VARIANT      16     16       S -> P (in PKU).
+    FT                                /FTId=VAR_000869.
+    SQ   SEQUENCE   452 AA;  51862 MW;  018F00EBBBDDCE2F CRC64;
+    """
+
+    # line codes that follow the DR block
+    after_dr = ("PE", "KW", "FT", "SQ")
+    # line codes read by the parser (all the others are skipped)
+    handled = frozenset(("ID", "AC", "DR", "PE", "KW", "FT", "SQ", "//"))
+    stop_after_dr = not features and not checksum
+
+    entry = None
+    accessions = []
+    ensemblg = OrderedDict()
+    ensemblt = OrderedDict()
+    ensemblp = OrderedDict()
+    feature_list = []
+    feature = None
+    crc64 = None
+    code = None
+
+    lines = iter(txt_handle)
+    for line in lines:
+        if line.strip() != "":
+            entry = OrderedDict()
+            entry["NAME"] = "-"
+            break
+    if entry is None:
+        return None
+
+    for line in chain([line], lines):
+        code = line[0:2]
+        if code not in handled:
+            continue
+
+        if code == "DR":
+            if line.startswith("DR   Ensembl;"):
+                skip = False
+                line = line.rstrip("\r\n")
+                line = line.split(";")
+                enst = line[1].strip()
+                ensp = line[2].strip()
+                ensg = line[3].strip()
+
+                if "[" in ensg:
+                    ensg = ensg.split()
+                    uni = ensg[1][1:-1]
+                    if "%s" % identifier == uni:
+                        ensg = ensg[0].rstrip(".")
+                    elif "%s-1" % identifier == uni:
+                        ensg = ensg[0].rstrip(".")
+                    else:
+                        skip = True
+                else:
+                    ensg = ensg.rstrip(".")
+
+                if not skip:
+                    ensemblg[ensg] = None
+                    ensemblt[enst] = None
+                    ensemblp[ensp] = None
+        elif code == "FT":
+            if not features:
+                pass
+            elif line[5] != " ":
+                # new feature: FT   VARIANT      16     16       S -> P (in PKU).
+                # (or the newer format: FT   VARIANT         16..20)
+                if feature is not None:
+                    feature_list.append((feature[0], feature[1], feature[2], " ".join(feature[3])))
+                fields = line[13:].split(None, 2)
+                if fields and ".." in fields[0]:
+                    start, _, end = fields[0].partition("..")
+                    description = fields[1:]
+                else:
+                    start = fields[0] if len(fields) > 0 else "-"
+                    end = fields[1] if len(fields) > 1 else start
+                    description = fields[2:]
+                feature = (line[5:13].strip(), start, end, [field.strip() for field in description])
+            elif feature is not None:
+                feature[3].append(line[5:].strip())
+        elif code == "ID":
+            entry["NAME"] = line[5:].split()[0]
+        elif code == "AC":
+            accessions.extend([acc.strip() for acc in line[5:].split(";") if acc.strip() != ""])
+            if identifier is None:
+                identifier = accessions[0]
+        elif code == "SQ":
+            for field in line.split(";"):
+                if field.strip().endswith("CRC64"):
+                    crc64 = field.split()[0]
+            break
+        elif code == "//":
+            break
+
+        if stop_after_dr and code in after_dr:
+            break
+
+    if feature is not None:
+        feature_list.append((feature[0], feature[1], feature[2], " ".join(feature[3])))
+
+    if skip_to_end and code != "//":
+        for line in lines:
+            if line.startswith("//"):
+                break
+
+    entry["ACCESSIONS"] = accessions
+    entry["ENSEMBL_GENE"] = list(ensemblg)
+    entry["ENSEMBL_TRANSCRIPT"] = list(ensemblt)
+    entry["ENSEMBL_PROTEIN"] = list(ensemblp)
+    entry["FEATURES"] = feature_list
+    entry["CRC64"] = crc64
+
+    return entry
+
+
+def iter_uniprot_txt_entries(txt_handle, features=True, checksum=True):
+    """
+    Parses all the entries of a multi-entry UniProt txt stream (e.g. a
+    Swiss-Prot release flat file), see parse_uniprot_txt_stream.
+
+    @param txt_handle: file handle, iterable of lines or str() buffer
+    @param features: Boolean parses the FT features
+    @param checksum: Boolean parses the SQ CRC64 checksum
+    @return: yields entry dictionaries (Ensembl isoforms selected with the
+        primary accession of each entry)
+    """
+
+    if isinstance(txt_handle, basestring):
+        txt_handle = StringIO(txt_handle)
+    lines = iter(txt_handle)
+
+    while True:
+        entry = parse_uniprot_txt_stream(None, lines, features=features, checksum=checksum, skip_to_end=True)
+        if entry is None:
+            return
+        yield entry
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally parses a JSON array from a stream of text chunks (e.g.
+    utils.request_stream_url), yielding its elements one at a time, so
+    only the element being parsed, and not the whole document, is held
+    in memory.
+
+    @param chunks: iterable of str() chunks of a JSON array
+    @return: yields each element of the array (nothing if the stream is empty)
+    """
+
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    exhausted = False
+    buffer = ""
+    index = 0
+    # next token: "array" ('['), "first" (element or ']'), "element", "separator" (',' or ']')
+    # or "end" (of the stream)
+    expecting = "array"
+
+    while True:
+        while index < len(buffer) and buffer[index] in " \t\r\n":
+            index += 1
+        if index == len(buffer):
+            if exhausted:
+                break
+            try:
+                buffer = next(chunks)
+            except StopIteration:
+                exhausted = True
+                buffer = ""
+            index = 0
+            continue
+
+        char = buffer[index]
+        if expecting == "end":
+            raise ValueError("Extra data after the JSON array: %r" % buffer[index:index + 50])
+        if expecting == "array":
+            if char != "[":
+                raise ValueError("Expecting a JSON array: %r" % buffer[index:index + 50])
+            index += 1
+            expecting = "first"
+            continue
+        if (expecting == "first" or expecting == "separator") and char == "]":
+            # the rest of the stream is still read (e.g. so it is cached)
+            index += 1
+            expecting = "end"
+            continue
+        if expecting == "separator":
+            if char != ",":
+                raise ValueError("Expecting ',' or ']': %r" % buffer[index:index + 50])
+            index += 1
+            expecting = "element"
+            continue
+
+        try:
+            element, end = decoder.raw_decode(buffer, index)
+        except ValueError:
+            # incomplete element: needs more of the stream
+            if exhausted:
+                raise
+            end = None
+        # a number followed only by number characters may continue in the next chunk
+        if end is None or (not exhausted and isinstance(element, (int, long, float)) and
+                           not isinstance(element, bool) and
+                           (end == len(buffer) or buffer[end] in json_number_continuation) and
+                           not buffer[end:].strip(json_number_continuation)):
+            try:
+                buffer = buffer[index:] + next(chunks)
+            except StopIteration:
+                exhausted = True
+                buffer = buffer[index:]
+            index = 0
+            continue
+
+        index = end
+        expecting = "separator"
+        yield element
+
+    if expecting != "array" and expecting != "end":
+        raise ValueError("Incomplete JSON array")
+
+
 def parse_ensembl_from_uniprot(identifier, txt_object, form="plain", verbose=True):
     """
     Gets Ensembl ids for Gene, Transcript and Protein.
     Converts UniProt id into respective Ensembl ids.
 
     @param identifier: UniProt ID
-    @param txt_object: UniProt txt lines object
+    @param txt_object: UniProt txt lines object (or file handle)
     @param form: output format
     @param verbose: Boolean
     @return: returns ensembl gene, transcript and protein identifiers
@@ -78,38 +381,15 @@ def parse_ensembl_from_uniprot(identifier, txt_object, form="plain", verbose=Tru
     DR   Ensembl; ENST00000553106; ENSP00000448059; ENSG00000171759.
     """
 
+    entry = parse_uniprot_txt_stream(identifier, txt_object, features=False, checksum=False)
+
     ensemblg = []
     ensemblt = []
     ensemblp = []
-
-    for line in txt_object:
-        if "DR   Ensembl;" in line[0:14]:
-            skip = False
-            line = line.rstrip("\r\n")
-            line = line.split(";")
-            enst = line[1].strip()
-            ensp = line[2].strip()
-            ensg = line[3].strip()
-
-            if "[" in ensg:
-                ensg = ensg.split()
-                uni = ensg[1][1:-1]
-                if "%s" % identifier == uni:
-                    ensg = ensg[0].rstrip(".")
-                elif "%s-1" % identifier == uni:
-                    ensg = ensg[0].rstrip(".")
-                else:
-                    skip = True
-            else:
-                ensg = ensg.rstrip(".")
-
-            if not skip:
-                if ensg not in ensemblg:
-                    ensemblg.append(ensg)
-                if enst not in ensemblt:
-                    ensemblt.append(enst)
-                if ensp not in ensemblp:
-                    ensemblp.append(ensp)
+    if entry is not None:
+        ensemblg = entry["ENSEMBL_GENE"]
+        ensemblt = entry["ENSEMBL_TRANSCRIPT"]
+        ensemblp = entry["ENSEMBL_PROTEIN"]
 
     if form is "plain":
         print(ensemblg, ensemblt, ensemblp)
@@ -119,4 +399,28 @@ def parse_ensembl_from_uniprot(identifier, txt_object, form="plain", verbose=Tru
 
 if __name__ == "__main__":
     # testing routines
-    pass
\ No newline at end of file
+    import random
+
+    document = json.dumps([1, -2, 1.5, -0.25, 1e-05, 2.5E+20, 123456789, 0, True, None, "a,b]c",
+                           u"\u00e9\"\\/", {"x": [1.75, "]"], "y": -1e3}, [], ""])
+    expected = json.loads(document)
+    assert list(iter_json_array([document])) == expected
+    # chunk splits inside numbers (at ".", "e", "E", "+", "-") and strings
+    assert list(iter_json_array(["[1.", "5]"])) == [1.5]
+    assert list(iter_json_array(["[1", ".", "5", "e", "-", "2]"])) == [1.5e-2]
+    assert list(iter_json_array(["[-", "1E", "+2, 3]"])) == [-100.0, 3]
+    assert list(iter_json_array(['["a\\', 'u00e9b"]'])) == [u"a\u00e9b"]
+    for i in range(len(document) + 1):
+        assert list(iter_json_array([document[:i], document[i:]])) == expected
+    rand = random.Random(0)
+    for i in range(200):
+        splits = sorted(rand.sample(range(len(document) + 1), 10))
+        chunks = [document[start:stop] for start, stop in zip([0] + splits, splits + [len(document)])]
+        assert list(iter_json_array(chunks)) == expected
+    for chunks in (["[1.]"], ["[1", ".]"], ["[1, 2"], ["[1] 2"]):
+        try:
+            list(iter_json_array(chunks))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Invalid JSON parsed: %r" % chunks)
\ No newline at end of file
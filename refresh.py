@@ -0,0 +1,350 @@
+#!/usr/bin/env python2.7
+
+import os
+import re
+import json
+import glob
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from utils import flash
+from utils import request_conditional_url
+from fetchers import fetch_ensembl_release
+from fetchers import write_lines_atomic
+
+from library import uniprot_rest_url
+from library import uniprot_accession_pattern
+
+# serializes the manifest journal appends and the manifest rewrites
+manifest_lock = threading.Lock()
+
+
+def manifest_path(path):
+    """Gets the path of the refresh manifest of a local UniProt files directory"""
+
+    return os.path.join(path, ".manifest.json")
+
+
+def journal_path(path):
+    """Gets the path of the journal of validators recorded since the manifest was saved"""
+
+    return os.path.join(path, ".manifest.log")
+
+
+def artifact_validators(headers):
+    """
+    Gets the manifest record of a downloaded file from its response headers.
+
+    @param headers: response headers
+    @return: returns a dictionary with ETAG, LAST_MODIFIED and UNIPROT_RELEASE
+    """
+
+    artifact = OrderedDict()
+    artifact["ETAG"] = headers.get("ETag")
+    artifact["LAST_MODIFIED"] = headers.get("Last-Modified")
+    artifact["UNIPROT_RELEASE"] = headers.get("X-UniProt-Release")
+
+    return artifact
+
+
+def record_artifacts(artifacts, path):
+    """
+    Records the validators of downloaded files (e.g. by CoreSEQUENCE or
+    the prefetch), so the next refresh sends them in conditional requests.
+    They are appended to the manifest journal, as rewriting the whole
+    manifest for every download would be quadratic, and merged into the
+    manifest by load_manifest.
+
+    @param artifacts: dictionary of file names (e.g. P00439.fasta) to
+        validators (see artifact_validators)
+    @param path: path to the local UniProt files (e.g. Data/)
+    """
+
+    lines = "".join([json.dumps([name, artifacts[name]]) + "\n" for name in artifacts])
+    with manifest_lock:
+        with open(journal_path(path), "a") as output:
+            output.write(lines)
+
+    return
+
+
+def load_manifest(path):
+    """
+    Loads the refresh manifest of a local UniProt files directory: the
+    Ensembl and UniProt releases of the last refresh and the validators
+    (ETag/Last-Modified) and UniProt release of each file (including the
+    ones recorded in the journal since, see record_artifacts).
+
+    @param path: path to the local UniProt files (e.g. Data/)
+    @return: returns a dictionary with RELEASES and ARTIFACTS
+    """
+
+    manifest = OrderedDict()
+    manifest["RELEASES"] = OrderedDict([("ENSEMBL", None), ("UNIPROT", None)])
+    manifest["ARTIFACTS"] = OrderedDict()
+
+    if os.path.isfile(manifest_path(path)):
+        with open(manifest_path(path)) as inputfile:
+            try:
+                manifest.update(json.load(inputfile, object_pairs_hook=OrderedDict))
+            except ValueError:
+                pass
+
+    if os.path.isfile(journal_path(path)):
+        releases = set()
+        with open(journal_path(path)) as inputfile:
+            for line in inputfile:
+                try:
+                    name, artifact = json.loads(line, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    # line of an interrupted append
+                    continue
+                manifest["ARTIFACTS"][name] = artifact
+                if artifact["UNIPROT_RELEASE"] is not None:
+                    releases.add(artifact["UNIPROT_RELEASE"])
+        if manifest["RELEASES"]["UNIPROT"] is not None:
+            releases.add(manifest["RELEASES"]["UNIPROT"])
+        if releases:
+            manifest["RELEASES"]["UNIPROT"] = max(releases)
+
+    return manifest
+
+
+def save_manifest(manifest, path):
+    """
+    Saves the refresh manifest (through a temporary file renamed at the
+    end). The journal is merged into it (see load_manifest), so it is removed.
+
+    @param manifest: manifest dictionary (see load_manifest)
+    @param path: path to the local UniProt files (e.g. Data/)
+    """
+
+    handle, tmp_path = tempfile.mkstemp(prefix=".", dir=path)
+    with os.fdopen(handle, "w") as output:
+        json.dump(manifest, output, indent=1)
+    with manifest_lock:
+        os.rename(tmp_path, manifest_path(path))
+        if os.path.isfile(journal_path(path)):
+            os.remove(journal_path(path))
+
+    return
+
+
+def local_identifiers(path):
+    """
+    Gets the identifiers with local UniProt files.
+
+    @param path: path to the local UniProt files (e.g. Data/)
+    @return: returns a sorted list of identifiers
+    """
+
+    identifiers = set()
+    for ext in ("fasta", "txt"):
+        for filepath in glob.glob(os.path.join(path, "*.%s" % ext)):
+            identifier = os.path.basename(filepath)[:-len(ext) - 1]
+            if re.match(uniprot_accession_pattern, identifier):
+                identifiers.add(identifier)
+
+    return sorted(identifiers)
+
+
+def refresh_uniprot_entries(identifiers=None, path=None, jobs=1, server=None, ensembl_server=None,
+                            verbose=True):
+    """
+    Incrementally refreshes the local UniProt files (<id>.fasta and
+    <id>.txt). Each file is requested with the validators of its previous
+    download (conditional request), so unchanged files are not transferred
+    again, and files are only rewritten if their content changed. The
+    Ensembl and UniProt releases are recorded, as a new Ensembl release
+    changes the variants of every identifier.
+
+    @param identifiers: list of UNIPROT identifiers (defaults to all the local ones)
+    @param path: path to the local UniProt files (defaults to Data/)
+    @param jobs: number of files refreshed concurrently
+    @param server: UniProt REST server (defaults to library.uniprot_rest_url)
+    @param ensembl_server: Ensembl REST server (defaults to library.ensembl_rest_url)
+    @param verbose: Boolean
+    @return: returns the list of identifiers whose inputs changed (and need
+        to be computed again) and a dictionary with the refresh counters
+    """
+
+    if server is None:
+        server = uniprot_rest_url
+    if path is None:
+        path = os.getcwd() + "/Data"
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if identifiers is None:
+        identifiers = local_identifiers(path)
+
+    manifest = load_manifest(path)
+    artifacts = manifest["ARTIFACTS"]
+    lock = threading.Lock()
+
+    report = OrderedDict()
+    report["identifiers"] = len(identifiers)
+    report["requests"] = 0
+    report["not_modified"] = 0
+    report["unchanged"] = 0
+    report["updated"] = 0
+    report["failed"] = 0
+    report["bytes"] = 0
+
+    uniprot_releases = set()
+
+    def refresh(identifier):
+        changed = False
+        for ext in ("fasta", "txt"):
+            name = "%s.%s" % (identifier, ext)
+            filepath = os.path.join(path, name)
+            with lock:
+                artifact = artifacts.get(name, {})
+            etag = None
+            last_modified = None
+            # validators are only valid if the file is still there
+            if os.path.isfile(filepath):
+                etag = artifact.get("ETAG")
+                last_modified = artifact.get("LAST_MODIFIED")
+
+            url = "%s/%s.%s" % (server, identifier, ext)
+            status, content, headers = request_conditional_url(identifier, url, etag=etag,
+                                                               last_modified=last_modified, verbose=verbose)
+
+            with lock:
+                report["requests"] += 1
+                if status == 304:
+                    report["not_modified"] += 1
+                    continue
+                elif status != 200:
+                    report["failed"] += 1
+                    continue
+                report["bytes"] += len(content)
+
+            lines = content.splitlines()
+            previous = None
+            if os.path.isfile(filepath):
+                with open(filepath) as inputfile:
+                    previous = inputfile.read().splitlines()
+            if lines != previous:
+                write_lines_atomic(lines, filepath)
+                changed = True
+
+            with lock:
+                if lines != previous:
+                    report["updated"] += 1
+                else:
+                    report["unchanged"] += 1
+                artifact = artifact_validators(headers)
+                artifacts[name] = artifact
+                if artifact["UNIPROT_RELEASE"] is not None:
+                    uniprot_releases.add(artifact["UNIPROT_RELEASE"])
+
+        return identifier, changed
+
+    if verbose:
+        flash("Refreshing %s UniProt entries..." % len(identifiers))
+
+    if jobs > 1 and len(identifiers) > 1:
+        pool = ThreadPool(min(jobs, len(identifiers)))
+        try:
+            results = pool.map(refresh, identifiers)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [refresh(identifier) for identifier in identifiers]
+    changed = [identifier for identifier, updated in results if updated]
+
+    # a new Ensembl release changes the inputs of every identifier
+    ensembl_release = fetch_ensembl_release(server=ensembl_server, verbose=verbose)
+    previous_release = manifest["RELEASES"]["ENSEMBL"]
+    report["ensembl_release"] = ensembl_release
+    report["ensembl_changed"] = previous_release is not None and ensembl_release is not None and \
+        previous_release != ensembl_release
+    if report["ensembl_changed"]:
+        changed = list(identifiers)
+
+    if ensembl_release is not None:
+        manifest["RELEASES"]["ENSEMBL"] = ensembl_release
+    if uniprot_releases:
+        manifest["RELEASES"]["UNIPROT"] = max(uniprot_releases)
+    report["uniprot_release"] = manifest["RELEASES"]["UNIPROT"]
+    save_manifest(manifest, path)
+
+    report["changed"] = len(changed)
+    if verbose:
+        flash("Refresh: %s" % ", ".join(["%s=%s" % (key, report[key]) for key in report]))
+
+    return changed, report
+
+
+if __name__ == "__main__":
+    # testing routines
+    import shutil
+    from stub import StubData
+    from stub import StubServer
+
+    data = StubData(release=111, uniprot_release="2024_01")
+    data.add_fixture("P00439", os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data"))
+    stub = StubServer(data)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server = stub.url() + "/uniprotkb"
+
+    directory = tempfile.mkdtemp()
+    try:
+        # first download (as in CoreSEQUENCE.load_uniprot_file): the validators are journaled
+        for ext in ("fasta", "txt"):
+            name = "P00439.%s" % ext
+            status, content, headers = request_conditional_url("P00439", "%s/%s" % (server, name),
+                                                               verbose=False)
+            assert status == 200
+            write_lines_atomic(content.splitlines(), os.path.join(directory, name))
+            record_artifacts({name: artifact_validators(headers)}, directory)
+        manifest = load_manifest(directory)
+        assert list(manifest["ARTIFACTS"]) == ["P00439.fasta", "P00439.txt"]
+        assert manifest["ARTIFACTS"]["P00439.fasta"]["ETAG"] is not None
+        assert manifest["RELEASES"]["UNIPROT"] == "2024_01"
+        assert local_identifiers(directory) == ["P00439"]
+
+        # the first refresh only revalidates the downloaded files
+        changed, report = refresh_uniprot_entries(path=directory, server=server, ensembl_server=stub.url(),
+                                                  verbose=False)
+        assert changed == []
+        assert (report["requests"], report["not_modified"], report["updated"], report["bytes"]) == (2, 2, 0, 0)
+        assert (report["ensembl_release"], report["ensembl_changed"]) == ("111", False)
+        assert not os.path.isfile(journal_path(directory))
+        assert load_manifest(directory)["RELEASES"] == OrderedDict([("ENSEMBL", "111"), ("UNIPROT", "2024_01")])
+
+        # an updated entry is transferred and rewritten (the unchanged file is not)
+        with open(os.path.join(directory, "P00439.fasta")) as inputfile:
+            fasta = inputfile.read()
+        with open(os.path.join(directory, "P00439.txt")) as inputfile:
+            txt = inputfile.read()
+        data.uniprot_release = "2024_02"
+        data.add_entry("P00439", fasta.replace("MSTAVLENPG", "MSTAVLENPA"), txt)
+        changed, report = refresh_uniprot_entries(path=directory, server=server, ensembl_server=stub.url(),
+                                                  verbose=False)
+        assert changed == ["P00439"]
+        assert (report["not_modified"], report["updated"], report["unchanged"]) == (1, 1, 0)
+        assert report["uniprot_release"] == "2024_02"
+        with open(os.path.join(directory, "P00439.fasta")) as inputfile:
+            assert "MSTAVLENPA" in inputfile.read()
+
+        # a new Ensembl release changes every identifier
+        data.release = 112
+        changed, report = refresh_uniprot_entries(path=directory, server=server, ensembl_server=stub.url(),
+                                                  verbose=False)
+        assert changed == ["P00439"] and report["ensembl_changed"] and report["not_modified"] == 2
+
+        # files removed since are downloaded unconditionally
+        os.remove(os.path.join(directory, "P00439.txt"))
+        changed, report = refresh_uniprot_entries(["P00439"], path=directory, server=server,
+                                                  ensembl_server=stub.url(), verbose=False)
+        assert changed == ["P00439"] and (report["not_modified"], report["updated"]) == (1, 1)
+    finally:
+        shutil.rmtree(directory)
+        stub.shutdown()
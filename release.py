@@ -0,0 +1,383 @@
+#!/usr/bin/env python2.7
+
+import os
+import mmap
+import threading
+from collections import OrderedDict
+
+from utils import flash
+from parsers import iter_fasta_records
+
+
+class UniProtRelease(object):
+    """
+    Reads UniProt entries from local release files (e.g. uniprot_sprot.dat
+    and uniprot_sprot.fasta) with no network access and no per-entry files.
+    An accession -> byte offset index is built once per release file, in a
+    single streaming pass, and saved next to it ('<file>.idx'). Entries are
+    then served by slicing the memory-mapped release files.
+    """
+
+    # entries missing from the release are not looked up elsewhere
+    offline = True
+
+    def __init__(self, dat_path=None, fasta_path=None, verbose=True):
+        """
+        Init method. Indexes are loaded (or built) on first use.
+
+        @param dat_path: path to the UniProt release flat file (.dat)
+        @param fasta_path: path to the UniProt release fasta file
+        @param verbose: Boolean
+        """
+
+        self.dat_path = dat_path
+        self.fasta_path = fasta_path
+        self.verbose = verbose
+
+        self.indexes = {}
+        self.maps = {}
+        self.lock = threading.Lock()
+
+        return
+
+    def index_path(self, path):
+        """Gets the path of the index of a release file"""
+
+        return path + ".idx"
+
+    def stamp(self, path):
+        """Gets the stamp (size and modification time) a release file is indexed with"""
+
+        stat = os.stat(path)
+        return "# %s %s" % (stat.st_size, int(stat.st_mtime))
+
+    def build_index(self, path, kind):
+        """
+        Builds the accession index of a release file in a single streaming
+        pass and saves it to disk.
+
+        @param path: path to the release file
+        @param kind: "dat" or "fasta"
+        @return: returns a dictionary of (offset, length, primary accession)
+            tuples keyed by accession
+        """
+
+        if self.verbose:
+            flash("Indexing %s..." % path)
+
+        index = {}
+        offset = 0
+        start = 0
+        accessions = []
+        with open(path, "rb") as release:
+            for line in release:
+                if kind == "dat":
+                    if line.startswith("ID   "):
+                        start = offset
+                        accessions = []
+                    elif line.startswith("AC   "):
+                        accessions.extend([acc.strip() for acc in line[5:].split(";") if acc.strip() != ""])
+                    elif line.startswith("//"):
+                        for accession in accessions:
+                            if accession not in index:
+                                index[accession] = (start, offset + len(line) - start, accessions[0])
+                else:
+                    if line.startswith(">"):
+                        if accessions:
+                            index[accessions[0]] = (start, offset - start, accessions[0])
+                        # example header: >sp|P04217|A1BG_HUMAN Alpha-1B-glycoprotein OS=Homo sapiens ...
+                        start = offset
+                        try:
+                            accessions = [line.split("|")[1]]
+                        except IndexError:
+                            accessions = [line[1:].split()[0]]
+                offset += len(line)
+        if kind == "fasta" and accessions:
+            index[accessions[0]] = (start, offset - start, accessions[0])
+
+        index_path = self.index_path(path)
+        with open(index_path + ".tmp", "w") as output:
+            output.write(self.stamp(path) + "\n")
+            for accession in index:
+                start, length, primary = index[accession]
+                output.write("%s\t%s\t%s\t%s\n" % (accession, start, length, primary))
+        os.rename(index_path + ".tmp", index_path)
+
+        return index
+
+    def load_index(self, path, kind):
+        """
+        Loads the accession index of a release file, building it if it
+        does not exist or the release file changed.
+
+        @param path: path to the release file
+        @param kind: "dat" or "fasta"
+        @return: returns a dictionary of (offset, length, primary accession)
+            tuples keyed by accession
+        """
+
+        index_path = self.index_path(path)
+        if os.path.isfile(index_path):
+            with open(index_path) as inputfile:
+                if inputfile.readline().rstrip("\n") == self.stamp(path):
+                    index = {}
+                    for line in inputfile:
+                        accession, start, length, primary = line.rstrip("\n").split("\t")
+                        index[accession] = (int(start), int(length), primary)
+                    return index
+
+        return self.build_index(path, kind)
+
+    def entry(self, path, kind, accession):
+        """
+        Gets the lines of a release file entry.
+
+        @param path: path to the release file
+        @param kind: "dat" or "fasta"
+        @param accession: UniProt accession
+        @return: returns a list of lines or None if not in the release
+        """
+
+        with self.lock:
+            if path not in self.indexes:
+                self.indexes[path] = self.load_index(path, kind)
+                with open(path, "rb") as release:
+                    self.maps[path] = mmap.mmap(release.fileno(), 0, access=mmap.ACCESS_READ)
+        index = self.indexes[path]
+
+        if accession not in index:
+            return None
+        start, length, primary = index[accession]
+
+        return self.maps[path][start:start + length].splitlines()
+
+    def primary_accession(self, accession):
+        """Gets the primary accession of an accession (from the flat file index)"""
+
+        if self.dat_path is None:
+            return accession
+        lines = self.entry(self.dat_path, "dat", accession)
+        if lines is None:
+            return accession
+
+        return self.indexes[self.dat_path][accession][2]
+
+    def dat_fasta(self, accession):
+        """
+        Builds the fasta lines of an entry from its flat file entry (header
+        from the ID/AC/DE/OS/GN lines, sequence from the SQ block), for
+        releases read without a fasta file.
+
+        @param accession: UniProt accession (primary or secondary)
+        @return: returns a list of lines or None if not in the release
+        """
+
+        if self.dat_path is None:
+            return None
+        lines = self.entry(self.dat_path, "dat", accession)
+        if lines is None:
+            return None
+
+        # example header: >sp|P04217|A1BG_HUMAN Alpha-1B-glycoprotein OS=Homo sapiens GN=A1BG
+        database = "sp"
+        name = "-"
+        description = ""
+        species = ""
+        gene = ""
+        chunks = []
+        sequence = False
+        for line in lines:
+            if sequence:
+                if line.startswith("//"):
+                    break
+                chunks.append("".join(line.split()))
+            elif line.startswith("ID   "):
+                name = line[5:].split()[0]
+                if "Unreviewed;" in line:
+                    database = "tr"
+            elif line.startswith("DE   ") and description == "":
+                if "Full=" in line:
+                    description = line.split("Full=", 1)[1].split("{")[0].strip().rstrip(";").strip()
+            elif line.startswith("OS   "):
+                species += " " + line[5:].strip()
+            elif line.startswith("GN   ") and gene == "":
+                if "Name=" in line:
+                    gene = line.split("Name=", 1)[1].split(";")[0].split("{")[0].strip()
+            elif line.startswith("SQ   "):
+                sequence = True
+
+        header = ">%s|%s|%s" % (database, self.indexes[self.dat_path][accession][2], name)
+        if description != "":
+            header += " %s" % description
+        species = species.strip().rstrip(".").split(" (")[0]
+        if species != "":
+            header += " OS=%s" % species
+        if gene != "":
+            header += " GN=%s" % gene
+
+        return [header] + chunks
+
+    def get_fasta(self, accession):
+        """
+        Gets the fasta lines of an entry, from the fasta file, or built from
+        the flat file if the release has no fasta file (see dat_fasta).
+
+        @param accession: UniProt accession (primary or secondary)
+        @return: returns a list of lines or None if not in the release
+        """
+
+        if self.fasta_path is None:
+            return self.dat_fasta(accession)
+
+        lines = self.entry(self.fasta_path, "fasta", accession)
+        if lines is None:
+            lines = self.entry(self.fasta_path, "fasta", self.primary_accession(accession))
+
+        return lines
+
+    def get_txt(self, accession):
+        """
+        Gets the txt (flat file) lines of an entry.
+
+        @param accession: UniProt accession (primary or secondary)
+        @return: returns a list of lines or None if not in the release
+        """
+
+        if self.dat_path is None:
+            return None
+
+        return self.entry(self.dat_path, "dat", accession)
+
+    def close(self):
+        """Closes the memory-mapped release files"""
+
+        with self.lock:
+            for path in self.maps:
+                self.maps[path].close()
+            self.maps = {}
+            self.indexes = {}
+
+        return
+
+
+class UniProtFasta(object):
+    """
+    Serves UniProt sequences from a (multi-record) fasta file or stream,
+    read in a single pass with iter_fasta_records. Only the header and the
+    joined sequence of each record are kept. The txt entries come from an
+    optional txt source (e.g. a UniProtRelease), otherwise from Data/ or
+    the network as usual.
+    """
+
+    offline = False
+
+    def __init__(self, fasta_handle, txt_source=None, verbose=True):
+        """
+        Init method. Reads all the records.
+
+        @param fasta_handle: path, file handle, iterable of lines or str() buffer
+        @param txt_source: optional source of the txt entries
+        @param verbose: Boolean
+        """
+
+        self.txt_source = txt_source
+        self.verbose = verbose
+        self.records = OrderedDict()
+
+        if isinstance(fasta_handle, basestring) and os.path.isfile(fasta_handle):
+            if self.verbose:
+                flash("Reading %s..." % fasta_handle)
+            with open(fasta_handle) as inputfile:
+                self.read(inputfile)
+        else:
+            self.read(fasta_handle)
+
+        return
+
+    def read(self, fasta_handle):
+        """Reads the records of a fasta stream (the first record of an accession is kept)"""
+
+        for accession, name, gene, species, sequence in iter_fasta_records(fasta_handle):
+            if accession not in self.records:
+                self.records[accession] = (name, gene, species, sequence)
+
+        return
+
+    def identifiers(self):
+        """Gets the accessions of the records, in file order"""
+
+        return list(self.records)
+
+    def get_fasta(self, accession):
+        """
+        Gets the fasta lines of an entry.
+
+        @param accession: UniProt accession
+        @return: returns a list of lines or None if not in the fasta
+        """
+
+        if accession not in self.records:
+            return None
+        name, gene, species, sequence = self.records[accession]
+        header = ">sp|%s|%s" % (accession, name)
+        if species != "-":
+            header += " OS=%s" % " ".join(species.split("_")).capitalize()
+        if gene != "-":
+            header += " GN=%s" % gene
+
+        return [header, sequence]
+
+    def get_txt(self, accession):
+        """
+        Gets the txt (flat file) lines of an entry.
+
+        @param accession: UniProt accession
+        @return: returns a list of lines or None if not available
+        """
+
+        if self.txt_source is None:
+            return None
+
+        return self.txt_source.get_txt(accession)
+
+    def close(self):
+        """Closes the txt source"""
+
+        if self.txt_source is not None:
+            self.txt_source.close()
+
+        return
+
+
+if __name__ == "__main__":
+    # testing routines
+    import shutil
+    import tempfile
+    from parsers import parse_information_from_uniprot
+
+    directory = tempfile.mkdtemp()
+    try:
+        dat_path = os.path.join(directory, "release.dat")
+        with open(dat_path, "w") as output:
+            output.write("ID   PH4H_HUMAN              Reviewed;         12 AA.\n"
+                         "AC   P00439; Q16717;\n"
+                         "DE   RecName: Full=Phenylalanine-4-hydroxylase {ECO:0000305};\n"
+                         "DE            Short=PAH;\n"
+                         "GN   Name=PAH {ECO:0000312|HGNC:HGNC:8582};\n"
+                         "OS   Homo sapiens (Human).\n"
+                         "SQ   SEQUENCE   12 AA;  1394 MW;  0000000000000000 CRC64;\n"
+                         "     MSTAVLENPG LG\n"
+                         "//\n")
+
+        # a flat file only release builds the fasta from the SQ block
+        release = UniProtRelease(dat_path, verbose=False)
+        for accession in ("P00439", "Q16717"):
+            fasta = release.get_fasta(accession)
+            assert fasta[0] == ">sp|P00439|PH4H_HUMAN Phenylalanine-4-hydroxylase OS=Homo sapiens GN=PAH"
+            assert parse_information_from_uniprot(fasta, form="json", verbose=False) == \
+                ("MSTAVLENPGLG", "PH4H_HUMAN", "PAH", "homo_sapiens")
+        assert release.get_fasta("P12345") is None
+        assert release.get_txt("Q16717")[0].startswith("ID   PH4H_HUMAN")
+        release.close()
+    finally:
+        shutil.rmtree(directory)
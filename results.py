@@ -0,0 +1,257 @@
+#!/usr/bin/env python2.7
+
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from tables import VariantStore
+
+
+class ResultsStore(object):
+    """
+    Local SQLite store of the results of each UniProt accession
+    (information, variants, mutations and summary). Each accession is
+    stamped with the version (Ensembl/UniProt release) it was computed
+    with, and is only served while that version is current. Variants are
+    kept one per row, indexed by accession, site and source, so they can
+    also be queried directly.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS entries (
+        accession TEXT PRIMARY KEY,
+        version TEXT,
+        created REAL,
+        information TEXT,
+        summary TEXT
+    );
+    CREATE TABLE IF NOT EXISTS variants (
+        accession TEXT,
+        kind TEXT,
+        position INTEGER,
+        site INTEGER,
+        source TEXT,
+        data TEXT
+    );
+    CREATE INDEX IF NOT EXISTS variants_accession ON variants (accession, kind, position);
+    CREATE INDEX IF NOT EXISTS variants_site ON variants (accession, site);
+    CREATE INDEX IF NOT EXISTS variants_source ON variants (source);
+    """
+
+    def __init__(self, path="results.db", version=None):
+        """
+        Init method. Creates the database if needed.
+
+        @param path: path to the SQLite database
+        @param version: version stamp of the current results
+            (e.g. "ensembl-111/uniprot-2024_01", see results_version)
+        """
+
+        self.path = path
+        self.version = version
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.saved = 0
+
+        # one connection shared by all threads (serialized by self.lock)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.executescript(self.schema)
+            self.connection.commit()
+
+        return
+
+    def load(self, accession):
+        """
+        Loads the results of an accession, if they are current.
+
+        @param accession: UniProt accession
+        @return: returns a dictionary with INFORMATION, VARIANTS, MUTATIONS
+            and SUMMARY, or None if not stored or stale
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT version, information, summary FROM entries "
+                                          "WHERE accession = ?", (accession,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[0] != self.version:
+                self.stale += 1
+                return None
+
+            results = OrderedDict()
+            results["INFORMATION"] = json.loads(row[1], object_pairs_hook=OrderedDict)
+            results["VARIANTS"] = VariantStore()
+            results["MUTATIONS"] = VariantStore()
+            for kind, data in self.connection.execute("SELECT kind, data FROM variants WHERE accession = ? "
+                                                      "ORDER BY kind, position", (accession,)):
+                results[kind].add(json.loads(data, object_pairs_hook=OrderedDict))
+            results["SUMMARY"] = json.loads(row[2], object_pairs_hook=OrderedDict)
+            self.hits += 1
+
+        return results
+
+    def save(self, accession, information, variants, mutations, summary):
+        """
+        Saves (or replaces) the results of an accession, in a single transaction.
+
+        @param accession: UniProt accession
+        @param information: information dictionary
+        @param variants: list of variants
+        @param mutations: list of mutations
+        @param summary: summary dictionary
+        """
+
+        rows = []
+        for kind, records in (("VARIANTS", variants), ("MUTATIONS", mutations)):
+            for position, variant in enumerate(records):
+                rows.append((accession, kind, position, int(variant["SITE"]), variant["SOURCE"],
+                             json.dumps(variant)))
+
+        with self.lock:
+            with self.connection:
+                self.connection.execute("DELETE FROM variants WHERE accession = ?", (accession,))
+                self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                        (accession, self.version, time.time(),
+                                         json.dumps(information), json.dumps(summary)))
+                self.connection.executemany("INSERT INTO variants VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.saved += 1
+
+        return
+
+    def remove(self, accessions):
+        """
+        Removes the results of a list of accessions (e.g. whose inputs changed).
+
+        @param accessions: list of UniProt accessions
+        """
+
+        rows = [(accession,) for accession in accessions]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("DELETE FROM variants WHERE accession = ?", rows)
+                self.connection.executemany("DELETE FROM entries WHERE accession = ?", rows)
+
+        return
+
+    def site_variants(self, accession, site):
+        """
+        Gets the stored variants and mutations of an accession at a site.
+
+        @param accession: UniProt accession
+        @param site: sequence site (1-based int)
+        @return: returns a list of variant dictionaries
+        """
+
+        with self.lock:
+            return [json.loads(data, object_pairs_hook=OrderedDict) for data, in
+                    self.connection.execute("SELECT data FROM variants WHERE accession = ? AND site = ? "
+                                            "ORDER BY kind DESC, position", (accession, site))]
+
+    def source_accessions(self, source):
+        """
+        Gets the accessions a variant (e.g. a rs or COSM id) is stored for.
+
+        @param source: variant source id
+        @return: returns a list of accessions
+        """
+
+        with self.lock:
+            return [accession for accession, in
+                    self.connection.execute("SELECT DISTINCT accession FROM variants WHERE source = ? "
+                                            "ORDER BY accession", (source,))]
+
+    def close(self):
+        """Closes the database"""
+
+        with self.lock:
+            self.connection.close()
+
+        return
+
+    def stats(self):
+        """
+        Gets the store counters.
+
+        @return: returns a dictionary with the version, hits, misses, stale and saved entries
+        """
+
+        with self.lock:
+            return {"version": self.version, "hits": self.hits, "misses": self.misses,
+                    "stale": self.stale, "saved": self.saved}
+
+
+def results_version(ensembl_release=None, uniprot_release=None):
+    """
+    Gets the version stamp results are stored with.
+
+    @param ensembl_release: Ensembl release (see fetchers.fetch_ensembl_release)
+    @param uniprot_release: UniProt release
+    @return: returns a version str()
+    """
+
+    return "ensembl-%s/uniprot-%s" % (ensembl_release or "-", uniprot_release or "-")
+
+
+if __name__ == "__main__":
+    # testing routines
+    import os
+    import shutil
+    import tempfile
+
+    def variant(source, site, res1="F", res2="L"):
+        return OrderedDict([("VARIATION", "p.%s%s%s" % (res1, site, res2)), ("SITE", str(site)),
+                            ("RES1", res1), ("RES2", res2), ("SOURCE", source)])
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "results.db")
+        version = results_version(ensembl_release=111, uniprot_release="2024_01")
+        assert version == "ensembl-111/uniprot-2024_01"
+        assert results_version() == "ensembl--/uniprot--"
+
+        information = OrderedDict([("NAME", "PH4H_HUMAN"), ("GENE", "PAH"), ("SPECIES", "homo_sapiens")])
+        variants = [variant("rs62508698", 1), variant("rs62514907", 3), variant("rs1", 3, "V", "A")]
+        mutations = [variant("MUT1", 3, "V", "G")]
+        summary = OrderedDict([("VARIANTS", 3), ("MUTATIONS", 1)])
+
+        store = ResultsStore(path, version=version)
+        assert store.load("P00439") is None
+        store.save("P00439", information, variants, mutations, summary)
+        results = store.load("P00439")
+        assert list(results) == ["INFORMATION", "VARIANTS", "MUTATIONS", "SUMMARY"]
+        assert results["INFORMATION"] == information and results["SUMMARY"] == summary
+        assert isinstance(results["VARIANTS"], VariantStore)
+        assert list(results["VARIANTS"]) == variants and list(results["MUTATIONS"]) == mutations
+        assert [var["SOURCE"] for var in store.site_variants("P00439", 3)] == ["rs62514907", "rs1", "MUT1"]
+        assert store.source_accessions("rs1") == ["P00439"]
+
+        # saving again replaces the results (no duplicated variants)
+        store.save("P00439", information, variants[:1], [], summary)
+        assert list(store.load("P00439")["VARIANTS"]) == variants[:1]
+        assert store.source_accessions("rs1") == []
+        store.save("P00439", information, variants, mutations, summary)
+        assert store.stats() == {"version": version, "hits": 2, "misses": 1, "stale": 0, "saved": 3}
+        store.close()
+
+        # results of another version (e.g. a new Ensembl release) are stale
+        store = ResultsStore(path, version=results_version(ensembl_release=112, uniprot_release="2024_01"))
+        assert store.load("P00439") is None
+        assert store.stats()["stale"] == 1
+        store.close()
+        store = ResultsStore(path, version=version)
+        assert list(store.load("P00439")["VARIANTS"]) == variants
+
+        # removed results (e.g. whose inputs changed) are computed again
+        store.remove(["P00439", "P04217"])
+        assert store.load("P00439") is None and store.site_variants("P00439", 3) == []
+        assert store.stats()["misses"] == 1
+        store.close()
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python2.7
+
+import os
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from urlparse import urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking available (e.g. Windows): state is kept per process
+    fcntl = None
+
+
+class RequestScheduler(object):
+    """
+    Rate-limit-aware scheduler for the outbound REST requests.
+    Requests are paced with a token bucket per host (Ensembl allows
+    15 requests per second), the 'Retry-After' and 'X-RateLimit-*'
+    headers sent by the servers are honoured, and throttled requests
+    are retried with exponential backoff and jitter, within a bounded
+    retry budget. The bucket state is shared across threads and,
+    if a state directory is provided, across processes.
+    """
+
+    def __init__(self, rate=15.0, burst=None, max_retries=5, backoff=0.5, max_backoff=60.0,
+                 state_dir=None):
+        """
+        Init method.
+
+        @param rate: requests per second allowed per host (None is unlimited)
+        @param burst: maximum number of requests sent in a burst (defaults to rate)
+        @param max_retries: maximum number of retries per request
+        @param backoff: base delay of the exponential backoff, in seconds
+        @param max_backoff: maximum delay between retries, in seconds
+        @param state_dir: directory with the bucket state shared across processes
+        """
+
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state_dir = state_dir
+        if self.state_dir is not None and fcntl is not None:
+            if not os.path.exists(self.state_dir):
+                try:
+                    os.makedirs(self.state_dir)
+                except OSError:
+                    pass
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+        self.requests = 0
+        self.throttle_waits = 0
+        self.throttle_time = 0.0
+        self.retries = 0
+        self.retry_time = 0.0
+        self.failures = 0
+
+        return
+
+    @contextmanager
+    def bucket(self, host):
+        """
+        Gets the bucket state of a host, for reading and updating.
+        Must be called with self.lock held.
+        """
+
+        if self.state_dir is None or fcntl is None:
+            if host not in self.buckets:
+                self.buckets[host] = {"tokens": self.burst, "stamp": time.time(), "blocked": 0.0}
+            yield self.buckets[host]
+            return
+
+        path = os.path.join(self.state_dir, "%s.bucket" % host.replace(":", "_"))
+        with open(path, "a+") as statefile:
+            fcntl.flock(statefile, fcntl.LOCK_EX)
+            try:
+                statefile.seek(0)
+                try:
+                    state = json.loads(statefile.read())
+                except ValueError:
+                    state = {"tokens": self.burst, "stamp": time.time(), "blocked": 0.0}
+                yield state
+                statefile.seek(0)
+                statefile.truncate()
+                statefile.write(json.dumps(state))
+                statefile.flush()
+            finally:
+                fcntl.flock(statefile, fcntl.LOCK_UN)
+
+        return
+
+    def acquire(self, url):
+        """
+        Blocks until a request to url can be sent.
+
+        @param url: input URL
+        @return: returns the time waited, in seconds
+        """
+
+        host = urlsplit(url).netloc
+        waited = 0.0
+        while True:
+            with self.lock:
+                with self.bucket(host) as state:
+                    now = time.time()
+                    if now < state["blocked"]:
+                        delay = state["blocked"] - now
+                    elif self.rate is None:
+                        delay = 0.0
+                    else:
+                        tokens = min(self.burst, state["tokens"] + (now - state["stamp"]) * self.rate)
+                        state["stamp"] = now
+                        if tokens >= 1:
+                            state["tokens"] = tokens - 1
+                            delay = 0.0
+                        else:
+                            state["tokens"] = tokens
+                            delay = (1 - tokens) / self.rate
+                if delay <= 0:
+                    self.requests += 1
+                    if waited > 0:
+                        self.throttle_waits += 1
+                        self.throttle_time += waited
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+    def update(self, url, headers):
+        """
+        Updates the host state from the rate limit headers of a response.
+
+        @param url: requested URL
+        @param headers: response headers
+        @return: returns the time the host is blocked for, in seconds
+        """
+
+        delay = 0.0
+        retry_after = header_seconds(headers, "Retry-After")
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            remaining = header_seconds(headers, "X-RateLimit-Remaining")
+            reset = header_seconds(headers, "X-RateLimit-Reset")
+            if remaining is not None and remaining < 1 and reset is not None:
+                delay = reset
+
+        if delay > 0:
+            host = urlsplit(url).netloc
+            with self.lock:
+                with self.bucket(host) as state:
+                    state["blocked"] = max(state["blocked"], time.time() + delay)
+
+        return delay
+
+    def retry(self, url, headers, attempt):
+        """
+        Waits before retrying a throttled request.
+
+        @param url: requested URL
+        @param headers: response headers (None for connection errors)
+        @param attempt: number of retries already done for this request
+        @return: returns False if the retry budget is exhausted
+        """
+
+        if attempt >= self.max_retries:
+            with self.lock:
+                self.failures += 1
+            return False
+
+        delay = 0.0
+        if headers is not None:
+            delay = self.update(url, headers)
+        # exponential backoff with full jitter, unless the server said how long to wait
+        if delay <= 0:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+        with self.lock:
+            self.retries += 1
+            self.retry_time += delay
+        time.sleep(delay)
+
+        return True
+
+    def stats(self):
+        """
+        Gets the scheduler counters.
+
+        @return: returns a dictionary with requests, throttle waits, retries and failures
+        """
+
+        with self.lock:
+            return {"requests": self.requests,
+                    "throttle_waits": self.throttle_waits,
+                    "throttle_time": round(self.throttle_time, 3),
+                    "retries": self.retries,
+                    "retry_time": round(self.retry_time, 3),
+                    "failures": self.failures}
+
+
+def header_seconds(headers, name):
+    """
+    Gets a numeric header value (in seconds).
+
+    @param headers: response headers
+    @param name: header name
+    @return: returns a float or None if missing or not numeric
+    """
+
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+if __name__ == "__main__":
+    # testing routines
+    import shutil
+    import tempfile
+
+    ensembl = "http://rest.ensembl.org/info/ping"
+    uniprot = "http://www.uniprot.org/uniprot/P00439.fasta"
+
+    # a full bucket sends a burst, then requests are paced at the rate
+    scheduler = RequestScheduler(rate=50.0, burst=5)
+    start = time.time()
+    waits = [scheduler.acquire(ensembl) for i in range(15)]
+    elapsed = time.time() - start
+    assert waits[0:5] == [0.0] * 5
+    assert all([wait > 0 for wait in waits[5:]])
+    # 10 requests over the burst at 50 per second
+    assert 0.18 <= elapsed < 1.0, elapsed
+    stats = scheduler.stats()
+    assert stats["requests"] == 15 and stats["throttle_waits"] == 10
+    # buckets are kept per host
+    assert scheduler.acquire(uniprot) == 0.0
+
+    # an unlimited rate never waits
+    scheduler = RequestScheduler(rate=None)
+    assert sum([scheduler.acquire(ensembl) for i in range(100)]) == 0.0
+
+    # Retry-After and exhausted X-RateLimit-* block the host
+    scheduler = RequestScheduler(rate=None)
+    assert scheduler.update(ensembl, {"Retry-After": "0.1"}) == 0.1
+    assert scheduler.acquire(ensembl) >= 0.09
+    assert scheduler.acquire(uniprot) == 0.0
+    assert scheduler.update(ensembl, {"X-RateLimit-Remaining": "5", "X-RateLimit-Reset": "10"}) == 0.0
+    assert scheduler.update(ensembl, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "0.05"}) == 0.05
+    assert header_seconds({"Retry-After": "soon"}, "Retry-After") is None
+
+    # retries are bounded by the retry budget
+    scheduler = RequestScheduler(max_retries=2, backoff=0.01)
+    attempt = 0
+    while scheduler.retry(ensembl, None, attempt):
+        attempt += 1
+    assert attempt == 2
+    stats = scheduler.stats()
+    assert stats["retries"] == 2 and stats["failures"] == 1
+
+    # the bucket state is shared by the schedulers of a state directory (e.g. processes)
+    if fcntl is not None:
+        directory = tempfile.mkdtemp()
+        try:
+            first = RequestScheduler(rate=1.0, burst=2, state_dir=directory)
+            second = RequestScheduler(rate=1.0, burst=2, state_dir=directory)
+            assert first.acquire(ensembl) == 0.0 and second.acquire(ensembl) == 0.0
+            first.update(ensembl, {"Retry-After": "0.2"})
+            assert second.acquire(ensembl) >= 0.19
+        finally:
+            shutil.rmtree(directory)
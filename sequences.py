@@ -0,0 +1,203 @@
+#!/usr/bin/env python2.7
+
+import os
+import hashlib
+import tempfile
+import threading
+
+
+def sequence_checksum(sequence):
+    """
+    Gets the checksum a sequence is stored under.
+
+    @param sequence: protein sequence str()
+    @return: returns the hex SHA1 digest of the sequence
+    """
+
+    return hashlib.sha1(sequence).hexdigest()
+
+
+class SequenceStore(object):
+    """
+    Local content-addressed store of Ensembl protein sequences. Each
+    sequence is saved once, under its checksum, and indexed per Ensembl
+    release by stable id and by stable id + version, so a sequence is
+    downloaded at most once per release and sequences shared by several
+    ids (or releases) are saved only once.
+    """
+
+    def __init__(self, directory="Sequences", release=None):
+        """
+        Init method.
+
+        @param directory: store directory (created if needed)
+        @param release: Ensembl release the index is kept for (None is "current")
+        """
+
+        self.directory = os.path.abspath(directory)
+        self.release = str(release) if release is not None else "current"
+
+        self.index = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created meanwhile by another worker
+                pass
+
+        return
+
+    def index_path(self):
+        """Gets the path of the stable id index of the release"""
+
+        return os.path.join(self.directory, "release-%s.idx" % self.release)
+
+    def object_path(self, checksum):
+        """Gets the path a sequence is stored under"""
+
+        return os.path.join(self.directory, checksum[0:2], checksum)
+
+    def load_index(self):
+        """
+        Loads the stable id index of the release (once).
+        Must be called with self.lock held.
+
+        @return: returns a dictionary of checksums keyed by stable id
+        """
+
+        if self.index is None:
+            self.index = {}
+            if os.path.isfile(self.index_path()):
+                with open(self.index_path()) as inputfile:
+                    for line in inputfile:
+                        line = line.rstrip("\n").split("\t")
+                        if len(line) == 2:
+                            self.index[line[0]] = line[1]
+
+        return self.index
+
+    def checksum(self, stable_id):
+        """
+        Gets the checksum of the sequence of a stable id.
+
+        @param stable_id: Ensembl stable id (with or without version)
+        @return: returns the checksum or None if not in the store
+        """
+
+        with self.lock:
+            return self.load_index().get(stable_id)
+
+    def get(self, stable_id):
+        """
+        Gets the sequence of a stable id.
+
+        @param stable_id: Ensembl stable id (with or without version)
+        @return: returns the sequence str() or None if not in the store
+        """
+
+        checksum = self.checksum(stable_id)
+        sequence = None
+        if checksum is not None:
+            try:
+                with open(self.object_path(checksum)) as inputfile:
+                    sequence = inputfile.read()
+            except IOError:
+                sequence = None
+
+        with self.lock:
+            if sequence is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return sequence
+
+    def put(self, stable_id, sequence, version=None):
+        """
+        Stores the sequence of a stable id.
+
+        @param stable_id: Ensembl stable id
+        @param sequence: protein sequence str()
+        @param version: optional stable id version (also indexed as 'id.version')
+        @return: returns the checksum of the sequence
+        """
+
+        sequence = str(sequence)
+        checksum = sequence_checksum(sequence)
+        path = self.object_path(checksum)
+        if not os.path.isfile(path):
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+            handle, tmp_path = tempfile.mkstemp(prefix=".", dir=directory)
+            with os.fdopen(handle, "wb") as outputfile:
+                outputfile.write(sequence)
+            os.rename(tmp_path, path)
+
+        keys = [stable_id]
+        if version is not None and "." not in stable_id:
+            keys.append("%s.%s" % (stable_id, version))
+
+        with self.lock:
+            index = self.load_index()
+            keys = [key for key in keys if index.get(key) != checksum]
+            if keys:
+                with open(self.index_path(), "a") as outputfile:
+                    for key in keys:
+                        index[key] = checksum
+                        outputfile.write("%s\t%s\n" % (key, checksum))
+
+        return checksum
+
+    def stats(self):
+        """
+        Gets the store counters.
+
+        @return: returns a dictionary with the release, hits, misses and indexed ids
+        """
+
+        with self.lock:
+            return {"release": self.release, "hits": self.hits, "misses": self.misses,
+                    "ids": len(self.load_index())}
+
+
+if __name__ == "__main__":
+    # testing routines
+    import shutil
+
+    sequence = "MSTAVLENPGLGRKLSDFGQETSYIEDNCNQNGAISLIFSLKEEVGALAKVLRLFEENDVNLTHIESRPSRLKKDEYEFFTHLDKRSLPALTNIIKILRHDIGATVHELSRDKKKDTVPWFPRTIQELDRFANQILSYGAELDADHPGFKDPVYRARRKQFADIAYNYRHGQPIPRVEYMEEEKKTWGTVFKTLKSLYKTHACYEYNHIFPLLEKYCGFHEDNIPQLEDVSQFLQTCTGFRLRPVAGLLSSRDFLGGLAFRVFHCTQYIRHGSKPMYTPEPDICHELLGHVPLFSDRSFAQFSQEIGLASLGAPDEYIEKLATIYWFTVEFGLCKQGDSIKAYGAGLLSSFGELQYCLSEKPKLLPLELEKTACQEYSVTEFQPLYYVAESFNDAKEKVRNFAATIPRPFSVRYDPYTQRIEVLDNTQQLKILADSINSEIGILCSALQKIK"
+    variant = sequence[:99] + "V" + sequence[100:]
+
+    # the checksum is a content checksum: a single residue changes it
+    assert sequence_checksum(sequence) == sequence_checksum(str(sequence))
+    assert sequence_checksum(sequence) != sequence_checksum(variant)
+    assert len(sequence) == len(variant)
+
+    directory = tempfile.mkdtemp()
+    try:
+        store = SequenceStore(directory, release=110)
+        assert store.get("ENSP00000553010") is None
+        checksum = store.put("ENSP00000553010", sequence, version=1)
+        # sequences shared by several ids are saved once
+        assert store.put("ENSP00000307046", sequence) == checksum
+        assert store.put("ENSP00000448059", variant) != checksum
+        assert store.get("ENSP00000553010") == sequence
+        assert store.get("ENSP00000553010.1") == sequence
+        assert store.get("ENSP00000307046") == sequence
+        assert store.get("ENSP00000448059") == variant
+        objects = [name for root, dirs, names in os.walk(directory) for name in names if not name.endswith(".idx")]
+        assert sorted(objects) == sorted([checksum, sequence_checksum(variant)])
+        assert store.stats() == {"release": "110", "hits": 4, "misses": 1, "ids": 4}
+
+        # the index is kept per release, and reloaded from disk
+        assert SequenceStore(directory, release=110).get("ENSP00000553010.1") == sequence
+        assert SequenceStore(directory, release=111).get("ENSP00000553010") is None
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,497 @@
+#!/usr/bin/env python2.7
+
+import re
+import json
+import time
+import Queue
+import signal
+import threading
+from urlparse import urlsplit
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from main import main_handler
+from utils import flash
+from utils import configure_http_session
+from utils import set_metrics
+from utils import get_metrics
+from metrics import Metrics
+from metrics import service_max_identifiers
+from tables import serialize_table
+from library import uniprot_accession_pattern
+
+
+class ServiceBusy(Exception):
+    """The request queue is full"""
+    pass
+
+
+class ServiceTimeout(Exception):
+    """The identifier was not processed in time"""
+    pass
+
+
+def error_content(message, identifier=None):
+    """Gets the JSON str() of an error (of an identifier)"""
+
+    error = OrderedDict()
+    if identifier is not None:
+        error["UNIPROT_ACC"] = identifier
+    error["ERROR"] = message
+
+    return json.dumps(error)
+
+
+class ServiceJob(object):
+    """An identifier queued for processing (shared by concurrent requests for it)"""
+
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.content = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class VariantService(object):
+    """
+    Processes identifiers (as main_handler) for a long-running process,
+    in a fixed pool of 'jobs' threads fed by a bounded request queue.
+    Concurrent requests for the same identifier share a single job, and
+    the serialized results of the most recent identifiers are kept in
+    memory, so repeated lookups are answered without any work. The HTTP
+    connection pool, response cache and stores set for the process stay
+    warm across requests.
+    """
+
+    def __init__(self, jobs=4, queue_size=64, workers=1, source=None, cache_size=1024, ttl=3600,
+                 timeout=300, verbose=False):
+        """
+        Init method. Starts the worker threads.
+
+        @param jobs: number of identifiers processed concurrently
+        @param queue_size: maximum number of identifiers waiting to be processed
+        @param workers: number of Ensembl transcripts fetched concurrently
+        @param source: optional local UniProt source (see CoreSEQUENCE)
+        @param cache_size: number of results kept in memory
+        @param ttl: time to live of the results kept in memory, in seconds
+        @param timeout: maximum time a request waits for its identifier, in seconds
+        @param verbose: Boolean
+        """
+
+        self.jobs = jobs
+        self.queue_size = queue_size
+        self.workers = workers
+        self.source = source
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.verbose = verbose
+
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        # identifier -> ServiceJob (queued or running)
+        self.pending = {}
+        # identifier -> (time, JSON str()), least recently used first
+        self.results = OrderedDict()
+
+        self.counters = OrderedDict([("processed", 0), ("failed", 0), ("cached", 0), ("coalesced", 0),
+                                     ("rejected", 0), ("timeouts", 0)])
+        self.running = 0
+
+        self.threads = []
+        for i in range(jobs):
+            thread = threading.Thread(target=self.work, name="service-%s" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+        return
+
+    def work(self):
+        """Processes the queued jobs, until a None job is queued (see close)"""
+
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            with self.lock:
+                self.running += 1
+            try:
+                information = main_handler(job.identifier, workers=self.workers, source=self.source,
+                                           form="", verbose=self.verbose)
+                job.content = json.dumps(information, sort_keys=False, default=serialize_table)
+            except Exception as error:
+                job.error = "%s: %s" % (type(error).__name__, error)
+
+            with self.lock:
+                self.running -= 1
+                del self.pending[job.identifier]
+                if job.error is None:
+                    self.counters["processed"] += 1
+                    self.results[job.identifier] = (time.time(), job.content)
+                    while len(self.results) > self.cache_size:
+                        self.results.popitem(last=False)
+                else:
+                    self.counters["failed"] += 1
+            job.done.set()
+
+            run_metrics = get_metrics()
+            if run_metrics is not None:
+                run_metrics.flush()
+
+        return
+
+    def submit(self, identifier):
+        """
+        Gets the job of an identifier: its cached result, the job already
+        queued for it, or a newly queued job.
+
+        @param identifier: UniProt identifier
+        @return: returns a ServiceJob object
+        @raise ServiceBusy: if the request queue is full
+        """
+
+        with self.lock:
+            if identifier in self.results:
+                stamp, content = self.results.pop(identifier)
+                if self.ttl is None or time.time() - stamp <= self.ttl:
+                    self.results[identifier] = (stamp, content)
+                    self.counters["cached"] += 1
+                    job = ServiceJob(identifier)
+                    job.content = content
+                    job.done.set()
+                    return job
+
+            if identifier in self.pending:
+                self.counters["coalesced"] += 1
+                return self.pending[identifier]
+
+            job = ServiceJob(identifier)
+            try:
+                self.queue.put_nowait(job)
+            except Queue.Full:
+                self.counters["rejected"] += 1
+                raise ServiceBusy("The request queue is full (%s identifiers)" % self.queue_size)
+            self.pending[identifier] = job
+
+        return job
+
+    def wait(self, job, timeout=None):
+        """
+        Waits for a job to complete.
+
+        @param job: ServiceJob object
+        @param timeout: maximum wait in seconds (defaults to the service timeout)
+        @return: returns the JSON str() of the identifier
+        @raise ServiceTimeout: if the job did not complete in time
+        @raise RuntimeError: if the identifier failed
+        """
+
+        if not job.done.wait(timeout or self.timeout):
+            with self.lock:
+                self.counters["timeouts"] += 1
+            raise ServiceTimeout("%s was not processed within %s seconds" % (job.identifier, timeout or self.timeout))
+        if job.error is not None:
+            raise RuntimeError(job.error)
+
+        return job.content
+
+    def close(self):
+        """Stops the worker threads, once the queued jobs are processed"""
+
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        return
+
+    def stats(self):
+        """
+        Gets the service counters.
+
+        @return: returns a dictionary with the queue, running jobs, cached results and counters
+        """
+
+        with self.lock:
+            stats = OrderedDict()
+            stats["jobs"] = self.jobs
+            stats["queued"] = len(self.pending) - self.running
+            stats["running"] = self.running
+            stats["queue_size"] = self.queue_size
+            stats["results"] = len(self.results)
+            stats.update(self.counters)
+
+        return stats
+
+    def prometheus(self, prefix="codereview"):
+        """
+        Gets the service counters in the Prometheus text exposition format.
+
+        @param prefix: metric name prefix
+        @return: returns a str()
+        """
+
+        stats = self.stats()
+        lines = []
+        for name, kind, help, values in (
+                ("service_jobs", "gauge", "Identifiers processed concurrently (maximum)", [("", stats["jobs"])]),
+                ("service_queue", "gauge", "Identifiers waiting or being processed",
+                 [('{state="queued"}', stats["queued"]), ('{state="running"}', stats["running"])]),
+                ("service_results", "gauge", "Results kept in memory", [("", stats["results"])]),
+                ("service_requests_total", "counter", "Identifier requests, per outcome",
+                 [('{outcome="%s"}' % key, stats[key]) for key in self.counters])):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for labels, value in values:
+                lines.append("%s_%s%s %s" % (prefix, name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP/JSON API of a VariantService:
+
+        GET /variants/<id>   main_handler output of an identifier
+        POST /variants       {"ids": [...]}, outputs keyed by identifier
+        GET /health          service counters
+        GET /metrics         request, stage and service metrics (Prometheus text format)
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, status, content, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def error(self, status, message):
+        self.reply(status, error_content(message))
+
+    def identifier_content(self, identifier):
+        """Gets the status code and JSON str() of an identifier"""
+
+        service = self.server.service
+        if not re.match(uniprot_accession_pattern, identifier):
+            return 400, error_content("Invalid UniProt accession", identifier)
+        try:
+            return 200, service.wait(service.submit(identifier))
+        except ServiceBusy as error:
+            return 503, error_content(str(error), identifier)
+        except ServiceTimeout as error:
+            return 504, error_content(str(error), identifier)
+        except RuntimeError as error:
+            return 500, error_content(str(error), identifier)
+
+    def do_GET(self):
+        service = self.server.service
+        path = urlsplit(self.path).path.rstrip("/")
+        route = path.strip("/").split("/")
+
+        if route[0] == "variants" and len(route) == 2:
+            status, content = self.identifier_content(route[1])
+            headers = {"Retry-After": "1"} if status == 503 else None
+            self.reply(status, content, headers=headers)
+        elif path == "/health":
+            self.reply(200, json.dumps(service.stats()))
+        elif path == "/metrics":
+            content = service.prometheus()
+            run_metrics = get_metrics()
+            if run_metrics is not None:
+                content = run_metrics.prometheus() + content
+            self.reply(200, content, content_type="text/plain; version=0.0.4")
+        else:
+            self.error(404, "Not found: %s" % path)
+
+    def do_POST(self):
+        service = self.server.service
+        path = urlsplit(self.path).path.rstrip("/")
+        size = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(size)
+
+        if path != "/variants":
+            return self.error(404, "Not found: %s" % path)
+        try:
+            identifiers = json.loads(body)["ids"]
+            assert isinstance(identifiers, list)
+            assert all([isinstance(identifier, basestring) for identifier in identifiers])
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return self.error(400, 'Expecting a JSON body like {"ids": ["P00439"]}')
+        if len(set(identifiers)) > service.queue_size:
+            return self.error(400, "Too many identifiers (maximum %s)" % service.queue_size)
+
+        # all the identifiers are queued before waiting for any of them
+        jobs = OrderedDict()
+        for identifier in identifiers:
+            if identifier in jobs:
+                continue
+            try:
+                if not re.match(uniprot_accession_pattern, identifier):
+                    jobs[identifier] = "Invalid UniProt accession"
+                else:
+                    jobs[identifier] = service.submit(identifier)
+            except ServiceBusy as error:
+                jobs[identifier] = str(error)
+
+        # each output is already serialized: the response is only concatenated
+        contents = []
+        for identifier in jobs:
+            job = jobs[identifier]
+            if isinstance(job, ServiceJob):
+                try:
+                    content = service.wait(job)
+                except (ServiceTimeout, RuntimeError) as error:
+                    content = error_content(str(error))
+            else:
+                content = error_content(job)
+            contents.append("%s: %s" % (json.dumps(identifier), content))
+
+        self.reply(200, "{%s}" % ", ".join(contents))
+
+
+class VariantServer(ThreadingMixIn, HTTPServer):
+    """HTTP server of a VariantService (see ServiceHandler)"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, host="127.0.0.1", port=8080):
+        HTTPServer.__init__(self, (host, port), ServiceHandler)
+        self.service = service
+
+    def url(self):
+        """Gets the URL of the server"""
+
+        return "http://%s:%s" % self.server_address[0:2]
+
+
+def serve_variants(host="127.0.0.1", port=8080, jobs=4, queue_size=64, workers=1, source=None, cache_size=1024,
+                   ttl=3600, timeout=300, verbose=True):
+    """
+    Serves main_handler results over a local HTTP/JSON API (see
+    ServiceHandler), until interrupted.
+
+    @param host: address the server listens on
+    @param port: port the server listens on
+    @param jobs: number of identifiers processed concurrently
+    @param queue_size: maximum number of identifiers waiting to be processed
+    @param workers: number of Ensembl transcripts fetched concurrently
+    @param source: optional local UniProt source (see CoreSEQUENCE)
+    @param cache_size: number of results kept in memory
+    @param ttl: time to live of the results kept in memory, in seconds
+    @param timeout: maximum time a request waits for its identifier, in seconds
+    @param verbose: Boolean
+    """
+
+    # every job can keep 'workers' connections busy at the same time
+    configure_http_session(pool_maxsize=max(10, jobs * workers))
+    if get_metrics() is None:
+        set_metrics(Metrics(max_identifiers=service_max_identifiers))
+
+    service = VariantService(jobs=jobs, queue_size=queue_size, workers=workers, source=source,
+                             cache_size=cache_size, ttl=ttl, timeout=timeout, verbose=verbose)
+    server = VariantServer(service, host=host, port=port)
+
+    # stops cleanly when terminated (e.g. by a process supervisor), as when interrupted
+    def terminate(signum, frame):
+        raise KeyboardInterrupt()
+    try:
+        signal.signal(signal.SIGTERM, terminate)
+    except ValueError:
+        # not called from the main thread
+        pass
+
+    flash("Serving on %s (%s jobs, queue of %s)" % (server.url(), jobs, queue_size))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    return
+
+
+if __name__ == "__main__":
+    # testing routines
+    import os
+    import shutil
+    import urllib2
+    import tempfile
+    from stub import StubData
+    from stub import StubServer
+    from stub import use_servers
+
+    data = StubData()
+    data.add_fixture("P00439", os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data"))
+    stub = StubServer(data)
+    thread = threading.Thread(target=stub.serve_forever)
+    thread.daemon = True
+    thread.start()
+    use_servers(stub.url(), stub.url() + "/uniprotkb")
+
+    def request(path, body=None):
+        try:
+            response = urllib2.urlopen(server.url() + path, body)
+            return response.getcode(), response.read()
+        except urllib2.HTTPError as error:
+            return error.code, error.read()
+
+    # Data/ and the logs of the run go to a temporary directory
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        set_metrics(Metrics(max_identifiers=service_max_identifiers))
+        service = VariantService(jobs=2, queue_size=4)
+        server = VariantServer(service, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        # one round trip, answered with the main_handler output of the identifier
+        status, content = request("/variants/P00439")
+        assert status == 200
+        information = json.loads(content, object_pairs_hook=OrderedDict)
+        expected = main_handler("P00439", form="", verbose=False)
+        assert information == json.loads(json.dumps(expected, default=serialize_table), object_pairs_hook=OrderedDict)
+        assert len(information["VARIANTS"]) > 0
+
+        # repeated lookups are answered from the results kept in memory
+        assert request("/variants/P00439") == (200, content)
+        status, content = request("/variants", json.dumps({"ids": ["P00439", "P0043", "P00439"]}))
+        batch = json.loads(content, object_pairs_hook=OrderedDict)
+        assert status == 200 and list(batch) == ["P00439", "P0043"]
+        assert batch["P00439"] == information and batch["P0043"]["ERROR"] == "Invalid UniProt accession"
+        assert request("/variants/P0043")[0] == 400
+        assert request("/variants", "{}")[0] == 400
+        assert request("/nothing")[0] == 404
+
+        status, content = request("/health")
+        health = json.loads(content)
+        assert status == 200
+        assert (health["processed"], health["cached"], health["queued"], health["running"]) == (1, 2, 0, 0)
+        status, content = request("/metrics")
+        assert status == 200
+        assert 'codereview_service_requests_total{outcome="processed"} 1' in content.splitlines()
+
+        server.shutdown()
+        server.server_close()
+        service.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+        stub.shutdown()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python2.7
+
+import json
+import time
+import random
+import hashlib
+import threading
+import multiprocessing
+from urlparse import urlsplit
+from urlparse import parse_qs
+from collections import OrderedDict
+from email.utils import formatdate
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from cache import ResponseCache
+from parsers import parse_information_from_uniprot
+from parsers import parse_uniprot_txt_stream
+from library import ensembl_rest_url
+from library import uniprot_rest_url
+
+
+def synthetic_uniprot_entry(accession, sequence, transcripts=1, name=None, gene=None):
+    """
+    Gets the fasta and txt (flat file) of a synthetic human UniProt entry,
+    with Ensembl cross-references to its transcripts.
+
+    @param accession: UniProt accession
+    @param sequence: protein sequence
+    @param transcripts: number of Ensembl transcripts (one gene per transcript)
+    @param name: UniProt name (defaults to <accession>_HUMAN)
+    @param gene: gene name (defaults to G<accession>)
+    @return: returns the fasta and txt str()
+    """
+
+    name = name or "%s_HUMAN" % accession
+    gene = gene or "G%s" % accession
+
+    fasta = [">sp|%s|%s Synthetic protein OS=Homo sapiens OX=9606 GN=%s PE=1 SV=1" % (accession, name, gene)]
+    fasta.extend([sequence[i:i + 60] for i in range(0, len(sequence), 60)])
+
+    txt = ["ID   %s              Reviewed;         %s AA." % (name, len(sequence)),
+           "AC   %s;" % accession]
+    for i in range(transcripts):
+        txt.append("DR   Ensembl; ENST%s%02d; ENSP%s%02d; ENSG%s%02d." % (accession, i, accession, i, accession, i))
+    txt.append("SQ   SEQUENCE   %s AA;  0 MW;  0000000000000000 CRC64;" % len(sequence))
+    txt.extend(["     %s" % sequence[i:i + 60] for i in range(0, len(sequence), 60)])
+    txt.append("//")
+
+    return "\n".join(fasta) + "\n", "\n".join(txt) + "\n"
+
+
+class StubData(object):
+    """
+    Responses served by the stub server. UniProt entries are replayed from
+    fixture files (e.g. Data/P00439.*) or synthesized, and the Ensembl
+    responses (sequences, genes, translation overlaps and variations) are
+    synthesized deterministically from them. Recorded responses (a
+    response cache directory of a live run, see cache.ResponseCache) are
+    replayed instead when available.
+    """
+
+    def __init__(self, variants=200, noise=0.5, release=111, uniprot_release="2024_01", recorded=None, seed=0):
+        """
+        Init method.
+
+        @param variants: number of variants overlapping each translation
+        @param noise: fraction of extra filtered out entries (intron, synonymous, etc.)
+        @param release: Ensembl release reported by /info/data
+        @param uniprot_release: UniProt release reported by the X-UniProt-Release header
+        @param recorded: optional response cache directory with recorded responses
+        @param seed: random seed
+        """
+
+        self.variants = variants
+        self.noise = noise
+        self.release = release
+        self.uniprot_release = uniprot_release
+        self.seed = seed
+        self.recorded = None
+        if recorded is not None:
+            self.recorded = ResponseCache(recorded, ttl=None, max_size=None)
+
+        self.entries = OrderedDict()
+        self.modified = {}
+        self.translations = {}
+
+        return
+
+    def add_entry(self, accession, fasta, txt):
+        """
+        Adds (or updates) a UniProt entry (and its Ensembl translations).
+
+        @param accession: UniProt accession
+        @param fasta: fasta str()
+        @param txt: txt str()
+        """
+
+        self.entries[accession] = (fasta, txt)
+        # Last-Modified has a resolution of seconds: updates always move it forward
+        self.modified[accession] = max(int(time.time()), self.modified.get(accession, 0) + 1)
+        sequence = parse_information_from_uniprot(fasta.splitlines(), form="", verbose=False)[0]
+        entry = parse_uniprot_txt_stream(accession, txt, features=False, checksum=False)
+        for enst, ensp, ensg in zip(entry["ENSEMBL_TRANSCRIPT"], entry["ENSEMBL_PROTEIN"], entry["ENSEMBL_GENE"]):
+            self.translations[ensp] = (sequence, enst, ensg)
+            self.translations[enst] = (sequence, enst, ensg)
+
+        return
+
+    def add_fixture(self, accession, path="Data"):
+        """Adds a UniProt entry from fixture files (<path>/<accession>.fasta and .txt)"""
+
+        with open("%s/%s.fasta" % (path, accession)) as inputfile:
+            fasta = inputfile.read()
+        with open("%s/%s.txt" % (path, accession)) as inputfile:
+            txt = inputfile.read()
+        self.add_entry(accession, fasta, txt)
+
+        return
+
+    def add_synthetic(self, accession, length, transcripts=1):
+        """Adds a synthetic UniProt entry (see synthetic_uniprot_entry)"""
+
+        rand = random.Random("%s%s" % (self.seed, accession))
+        sequence = "M" + "".join([rand.choice("ACDEFGHIKLMNPQRSTVWY") for i in range(length - 1)])
+        fasta, txt = synthetic_uniprot_entry(accession, sequence, transcripts=transcripts)
+        self.add_entry(accession, fasta, txt)
+
+        return
+
+    def overlap_translation(self, ensp, features):
+        """
+        Synthesizes the /overlap/translation entries of a translation. All the
+        random values of an entry are drawn before it is filtered by feature
+        type, so the entries do not depend on the requested features.
+        """
+
+        sequence = self.translations[ensp][0]
+        rand = random.Random("%s%s" % (self.seed, ensp))
+        entries = []
+        for i in range(int(self.variants * (1 + self.noise))):
+            site = rand.randint(1, len(sequence) - 1)
+            somatic = rand.random() < 0.3
+            vid = "%s%s" % ("COSM" if somatic else "rs", rand.randint(1, 10 ** 7))
+            feature_type = "somatic_transcript_variation" if somatic else "transcript_variation"
+            if i < self.variants:
+                vtype = "missense_variant"
+                residues = "%s/%s" % (sequence[site - 1], rand.choice("ACDEFGHIKLMNPQRSTVWY"))
+            else:
+                vtype = rand.choice(["intron_variant", "synonymous_variant", "frameshift_variant"])
+                residues = "" if vtype == "intron_variant" else sequence[site - 1]
+            frequency = round(rand.random() / 10, 4)
+            if feature_type not in features:
+                continue
+            entries.append({"start": site, "end": site, "residues": residues, "type": vtype, "id": vid,
+                            "feature_type": feature_type, "codons": "aGc/aTc", "allele": "G/T",
+                            "minor_allele_frequency": frequency if not somatic else None,
+                            "translation": ensp, "seq_region_name": ensp, "polyphen": None, "sift": None})
+
+        return entries
+
+    def variation(self, vid):
+        """Synthesizes the /variation entry of a variant"""
+
+        rand = random.Random("%s%s" % (self.seed, vid))
+        position = rand.randint(1, 10 ** 8)
+        return {"name": vid, "var_class": "SNP", "source": "Variants imported from dbSNP",
+                "mappings": [{"location": "%s:%s-%s" % (rand.randint(1, 22), position, position),
+                              "assembly_name": "GRCh38", "allele_string": "G/T", "strand": 1}],
+                "phenotypes": [{"trait": "Synthetic trait", "source": "OMIM"}] if rand.random() < 0.2 else [],
+                "genotypes": [], "synonyms": [], "populations": [], "evidence": [],
+                "most_severe_consequence": "missense_variant", "MAF": None, "ambiguity": "K"}
+
+    def respond_uniprot(self, content, accessions, headers=None):
+        """
+        Gets the response to a UniProt entries request, with an ETag (the
+        checksum of the content), a Last-Modified (of the latest modified
+        entry) and the UniProt release. Conditional requests (If-None-Match,
+        or else If-Modified-Since) of unchanged entries get a 304 Not Modified.
+
+        @param content: entries str()
+        @param accessions: accessions of the entries
+        @param headers: request headers
+        @return: returns the status code, content type, body str() and response headers
+        """
+
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        modified = max([self.modified[accession] for accession in accessions] or [0])
+        response_headers = OrderedDict([("ETag", etag), ("Last-Modified", formatdate(modified, usegmt=True)),
+                                        ("X-UniProt-Release", self.uniprot_release)])
+        not_modified = False
+        if headers is not None and headers.get("If-None-Match") is not None:
+            not_modified = headers.get("If-None-Match") == etag
+        elif headers is not None and headers.get("If-Modified-Since") is not None:
+            since = parsedate_tz(headers.get("If-Modified-Since"))
+            not_modified = since is not None and modified <= mktime_tz(since)
+        if not_modified:
+            return 304, "text/plain", "", response_headers
+
+        return 200, "text/plain", content, response_headers
+
+    def respond(self, method, path, body=None, headers=None):
+        """
+        Gets the response to a request.
+
+        @param method: "GET" or "POST"
+        @param path: request path (with the query)
+        @param body: POSTed JSON object
+        @param headers: request headers
+        @return: returns the status code, content type, body str() and response headers
+        """
+
+        if self.recorded is not None:
+            if path.startswith("/uniprotkb"):
+                origin = uniprot_rest_url[:-len("/uniprotkb")]
+            else:
+                origin = ensembl_rest_url
+            content = self.recorded.get(origin + path, body)
+            if content is not None:
+                return 200, "text/plain", content, {}
+
+        split = urlsplit(path)
+        route = split.path.strip("/").split("/")
+        query = parse_qs(split.query.replace(";", "&"))
+        features = query.get("feature", ["transcript_variation", "somatic_transcript_variation"])
+
+        if route[0] == "uniprotkb" and len(route) == 2 and route[1] == "accessions":
+            # paged as UniProt: 'size' entries per page (25 by default, at most 500), with a
+            # Link rel="next" to the next page (at 'cursor')
+            ext = query["format"][0]
+            size = min(int(query.get("size", [25])[0]), 500)
+            cursor = int(query.get("cursor", [0])[0])
+            accessions = [accession for accession in query["accessions"][0].split(",") if accession in self.entries]
+            page = accessions[cursor:cursor + size]
+            content = "".join([self.entries[accession][0 if ext == "fasta" else 1] for accession in page])
+            status, content_type, content, response_headers = self.respond_uniprot(content, page, headers)
+            if cursor + size < len(accessions):
+                params = [param for param in split.query.split("&") if not param.startswith("cursor=")]
+                response_headers["Link"] = '<%s?%s&cursor=%s>; rel="next"' % \
+                                           (split.path, "&".join(params), cursor + size)
+            return status, content_type, content, response_headers
+        elif route[0] == "uniprotkb" and route[1:] == ["search"]:
+            content = "Entry\n" + "".join(["%s\n" % accession for accession in self.entries][:1])
+            return 200, "text/plain", content, {"X-UniProt-Release": self.uniprot_release}
+        elif route[0] == "uniprotkb" and len(route) == 2:
+            accession, _, ext = route[1].partition(".")
+            if accession in self.entries:
+                return self.respond_uniprot(self.entries[accession][0 if ext == "fasta" else 1], [accession],
+                                            headers)
+        elif route[0] == "info" and route[1:] == ["data"]:
+            return 200, "application/json", json.dumps({"releases": [self.release]}), {}
+        elif route[0] == "sequence" and method == "POST":
+            return 200, "application/json", json.dumps([{"query": ensp, "id": ensp, "version": 1,
+                                                         "seq": self.translations[ensp][0], "molecule": "protein"}
+                                                        for ensp in body["ids"] if ensp in self.translations]), {}
+        elif route[0] == "sequence" and len(route) == 3:
+            if route[2] in self.translations:
+                return 200, "text/plain", self.translations[route[2]][0] + "\n", {}
+        elif route[0] == "lookup" and method == "POST":
+            return 200, "application/json", json.dumps(dict([(enst, {"id": enst, "Parent": self.translations[enst][2]}
+                                                                if enst in self.translations else None)
+                                                               for enst in body["ids"]])), {}
+        elif route[0] == "overlap" and route[1] == "id" and len(route) == 3:
+            if route[2] in self.translations:
+                enst, ensg = self.translations[route[2]][1:]
+                return 200, "application/json", json.dumps([{"id": enst, "Parent": ensg,
+                                                             "feature_type": "transcript"}]), {}
+        elif route[0] == "overlap" and route[1] == "translation" and len(route) == 3:
+            if route[2] in self.translations:
+                return 200, "application/json", json.dumps(self.overlap_translation(route[2], features)), {}
+        elif route[0] == "variation" and method == "POST":
+            return 200, "application/json", json.dumps(dict([(vid, self.variation(vid)) for vid in body["ids"]])), {}
+
+        return 404, "text/plain", "", {}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serves the StubData responses (and /_stats, /_reset with the traffic counters)"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    def reply(self, status, content_type, content, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method, body=None, size=0):
+        server = self.server
+        if self.path == "/_stats":
+            with server.lock:
+                return self.reply(200, "application/json", json.dumps(server.stats))
+        if self.path == "/_reset":
+            with server.lock:
+                server.stats = OrderedDict([("requests", 0), ("bytes_received", 0), ("bytes_sent", 0),
+                                            ("endpoints", OrderedDict())])
+            return self.reply(200, "application/json", "{}")
+
+        status, content_type, content, headers = server.data.respond(method, self.path, body, self.headers)
+        endpoint = "/" + self.path.strip("/").split("/")[0].split("?")[0]
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats["bytes_received"] += size
+            server.stats["bytes_sent"] += len(content)
+            server.stats["endpoints"][endpoint] = server.stats["endpoints"].get(endpoint, 0) + 1
+        self.reply(status, content_type, content, headers)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        size = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(size))
+        self.handle_request("POST", body, size)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP stub of the Ensembl and UniProt REST APIs (see StubData)"""
+
+    daemon_threads = True
+
+    def __init__(self, data, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), StubHandler)
+        self.data = data
+        self.lock = threading.Lock()
+        self.stats = OrderedDict([("requests", 0), ("bytes_received", 0), ("bytes_sent", 0),
+                                  ("endpoints", OrderedDict())])
+
+    def url(self):
+        """Gets the URL of the server"""
+
+        return "http://127.0.0.1:%s" % self.server_address[1]
+
+
+def serve_stub(data, queue):
+    """Runs a stub server (in a separate process), sending its URL through queue"""
+
+    server = StubServer(data)
+    queue.put(server.url())
+    server.serve_forever()
+
+
+def start_stub(data):
+    """
+    Starts a stub server in a separate process (so it does not use the
+    CPU time of the process being measured).
+
+    @param data: StubData object
+    @return: returns the server process and URL
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_stub, args=(data, queue))
+    process.daemon = True
+    process.start()
+
+    return process, queue.get(timeout=30)
+
+
+def use_servers(ensembl_url, uniprot_url):
+    """
+    Points the fetchers at other Ensembl and UniProt servers (e.g. a stub server).
+
+    @param ensembl_url: Ensembl REST server
+    @param uniprot_url: UniProt REST server (e.g. <url>/uniprotkb)
+    @return: returns the previous Ensembl and UniProt servers
+    """
+
+    import main
+    import fetchers
+    import refresh
+
+    previous = (fetchers.ensembl_rest_url, fetchers.uniprot_rest_url)
+    fetchers.ensembl_rest_url = ensembl_url
+    fetchers.uniprot_rest_url = uniprot_url
+    main.uniprot_rest_url = uniprot_url
+    refresh.uniprot_rest_url = uniprot_url
+
+    return previous
+
+
+if __name__ == "__main__":
+    # e.g. python stub.py 8000 (serves P00439 and a titin sized synthetic protein)
+    import sys
+
+    data = StubData()
+    data.add_fixture("P00439")
+    data.add_synthetic("Q99999", 35000, transcripts=4)
+    server = StubServer(data, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    print "Serving on %s" % server.url()
+    server.serve_forever()
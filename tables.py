@@ -0,0 +1,406 @@
+#!/usr/bin/env python2.7
+
+from array import array
+from collections import Mapping
+from collections import OrderedDict
+
+
+class ResidueTable(object):
+    """
+    Compact, array-backed per residue table of a protein sequence.
+    Residue codes are kept in the sequence string and the variants and
+    mutations of each site as offsets into their record lists (one
+    compressed-sparse-row index per record list), so no per residue
+    objects are held in memory. The per residue dictionaries of
+    get_entities and get_residues are created lazily by the views.
+    """
+
+    def __init__(self, identifier, sequence, variants, mutations):
+        """
+        Init method. Indexes the variants and mutations by site.
+
+        @param identifier: UNIPROT identifier
+        @param sequence: UNIPROT sequence
+        @param variants: list of variant dictionaries
+        @param mutations: list of mutation dictionaries
+        """
+
+        self.identifier = identifier
+        self.sequence = sequence
+        self.records = OrderedDict([("VARIANTS", variants), ("MUTATIONS", mutations)])
+        self.sites = {}
+        self.offsets = {}
+        self.indices = {}
+
+        length = len(sequence)
+        for key in self.records:
+            records = self.records[key]
+            sites = array("l", [int(var["SITE"]) for var in records])
+
+            # counting sort of the record indices by site (stable, keeps the list order)
+            offsets = array("l", [0]) * (length + 2)
+            for site in sites:
+                if 0 < site <= length:
+                    offsets[site + 1] += 1
+            for site in range(1, length + 2):
+                offsets[site] += offsets[site - 1]
+
+            cursor = array("l", offsets)
+            indices = array("l", [0]) * offsets[length + 1]
+            for i, site in enumerate(sites):
+                if 0 < site <= length:
+                    indices[cursor[site]] = i
+                    cursor[site] += 1
+
+            self.sites[key] = sites
+            self.offsets[key] = offsets
+            self.indices[key] = indices
+
+        return
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def count(self, key, site):
+        """
+        Gets the number of records at a site.
+
+        @param key: "VARIANTS" or "MUTATIONS"
+        @param site: sequence site (1-based int)
+        @return: returns an int
+        """
+
+        offsets = self.offsets[key]
+        return offsets[site + 1] - offsets[site]
+
+    def site_records(self, key, site):
+        """
+        Gets the records at a site, in list order.
+
+        @param key: "VARIANTS" or "MUTATIONS"
+        @param site: sequence site (1-based int)
+        @return: returns a list of variant dictionaries
+        """
+
+        offsets = self.offsets[key]
+        records = self.records[key]
+        indices = self.indices[key]
+
+        return [records[indices[i]] for i in range(offsets[site], offsets[site + 1])]
+
+    def entities(self):
+        """Gets the per residue entities view (see CoreSEQUENCE.get_entities)"""
+
+        return EntitiesView(self)
+
+    def residues(self):
+        """Gets the per residue residues view (see CoreSEQUENCE.get_residues)"""
+
+        return ResiduesView(self)
+
+
+class ResidueView(Mapping):
+    """
+    Read-only dictionary-like view of a ResidueTable, keyed by site
+    str() ("1", "2", ...). Each residue entry is built on access.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        for i in xrange(1, len(self.table) + 1):
+            yield str(i)
+
+    def __contains__(self, site):
+        try:
+            return 0 < int(site) <= len(self.table)
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, site):
+        if site not in self:
+            raise KeyError(site)
+        return self.entry(int(site))
+
+    def __repr__(self):
+        return repr(OrderedDict(self.iteritems()))
+
+    def entry(self, site):
+        raise NotImplementedError
+
+
+class EntitiesView(ResidueView):
+    """Per residue variant and mutation sources"""
+
+    def entry(self, site):
+        res = OrderedDict()
+        res["VARIANTS"] = [var["SOURCE"] for var in self.table.site_records("VARIANTS", site)]
+        res["MUTATIONS"] = [var["SOURCE"] for var in self.table.site_records("MUTATIONS", site)]
+        return res
+
+
+class ResiduesView(ResidueView):
+    """Per residue UniProt residue and the variations observed at it"""
+
+    def entry(self, site):
+        residue = self.table.sequence[site - 1]
+        res = OrderedDict()
+        res["UNIPROT_ID"] = str(site)
+        res["UNIPROT_NAME"] = residue
+        res["UNIPROT_ACC"] = self.table.identifier
+        for key in self.table.records:
+            for var in self.table.site_records(key, site):
+                res["%s:%s" % (var["SOURCE"], var["VARIATION"])] = residue
+        return res
+
+
+class VariantStore(list):
+    """
+    Insertion ordered list of variants, de-duplicated on (source id,
+    site, residue change) with a hash index, so adding and looking up
+    variants is O(1). The same variant seen from several Ensembl
+    transcripts is kept once, with the transcripts and proteins it
+    was seen in merged into its provenance lists. All the list methods
+    keep the index in sync: append/extend/+= add variants as add/update,
+    and the other in place changes (insert, pop, remove, del, item and
+    slice assignment, sort, etc.) rebuild the index, merging repeated
+    variants into their first occurrence.
+    """
+
+    # provenance lists merged when the same variant is added again
+    provenance = ("ENSEMBL_TRANSCRIPTS", "ENSEMBL_PROTEINS")
+
+    def __init__(self, variants=()):
+        """
+        Init method.
+
+        @param variants: optional iterable of variant dictionaries
+        """
+
+        list.__init__(self)
+        self.index = {}
+        self.update(variants)
+
+    @staticmethod
+    def key(variant):
+        """Gets the de-duplication key of a variant"""
+
+        return variant["SOURCE"], variant["SITE"], variant["RES1"], variant["RES2"]
+
+    def __contains__(self, variant):
+        return self.key(variant) in self.index
+
+    def get(self, variant, default=None):
+        """Gets the stored variant with the same key as variant"""
+
+        position = self.index.get(self.key(variant))
+        if position is None:
+            return default
+        return self[position]
+
+    def add(self, variant):
+        """
+        Adds a variant, or merges its provenance into the stored one.
+
+        @param variant: variant dictionary
+        @return: returns the stored variant
+        """
+
+        key = self.key(variant)
+        position = self.index.get(key)
+        if position is None:
+            self.index[key] = len(self)
+            list.append(self, variant)
+            return variant
+
+        stored = self[position]
+        if stored is not variant:
+            for name in self.provenance:
+                if name in stored and name in variant:
+                    for value in variant[name]:
+                        if value not in stored[name]:
+                            stored[name].append(value)
+        return stored
+
+    def update(self, variants):
+        """Adds all the variants of an iterable (see add)"""
+
+        for variant in variants:
+            self.add(variant)
+
+    def reindex(self):
+        """Rebuilds the index once the list changed in place (see add)"""
+
+        variants = list(self)
+        list.__delitem__(self, slice(None))
+        self.index = {}
+        self.update(variants)
+
+    def append(self, variant):
+        self.add(variant)
+
+    def extend(self, variants):
+        self.update(variants)
+
+    def __iadd__(self, variants):
+        self.update(variants)
+        return self
+
+    def insert(self, position, variant):
+        if variant in self:
+            self.add(variant)
+        else:
+            list.insert(self, position, variant)
+            self.reindex()
+
+    def pop(self, position=-1):
+        variant = list.pop(self, position)
+        if position == -1 or position == len(self):
+            del self.index[self.key(variant)]
+        else:
+            self.reindex()
+        return variant
+
+    def remove(self, variant):
+        list.remove(self, variant)
+        self.reindex()
+
+    def __setitem__(self, position, value):
+        list.__setitem__(self, position, value)
+        self.reindex()
+
+    def __delitem__(self, position):
+        list.__delitem__(self, position)
+        self.reindex()
+
+    def __setslice__(self, start, end, values):
+        list.__setslice__(self, start, end, values)
+        self.reindex()
+
+    def __delslice__(self, start, end):
+        list.__delslice__(self, start, end)
+        self.reindex()
+
+    def __imul__(self, times):
+        list.__imul__(self, times)
+        self.reindex()
+        return self
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.reindex()
+
+    def reverse(self):
+        list.reverse(self)
+        self.reindex()
+
+    def __reduce__(self):
+        # pickle/copy would append the variants before the index exists
+        return self.__class__, (list(self),)
+
+
+def serialize_table(obj):
+    """
+    JSON serializer for the residue views (to be used as the 'default'
+    argument of json.dump/json.dumps).
+
+    @param obj: object not serializable by json
+    @return: returns an OrderedDict for residue views
+    """
+
+    if isinstance(obj, ResidueView):
+        return OrderedDict(obj.iteritems())
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+if __name__ == "__main__":
+    # testing routines
+    import copy
+    import json
+    import pickle
+
+    def variant(source, site, transcript="ENST1"):
+        var = OrderedDict([("SOURCE", source), ("SITE", str(site)), ("RES1", "A"), ("RES2", "V"),
+                           ("ENSEMBL_TRANSCRIPTS", [transcript]), ("ENSEMBL_PROTEINS", [transcript.replace("T", "P")])])
+        return var
+
+    def assert_indexed(store, sources):
+        assert [var["SOURCE"] for var in store] == sources, [var["SOURCE"] for var in store]
+        assert store.index == dict([(store.key(var), i) for i, var in enumerate(store)])
+
+    # ResidueTable: the CSR views match a naive scan of the records
+    sequence = "MSTAVLENPGLG"
+    variants = [variant("rs3", 3), variant("rs1", 1), variant("rs3b", 3), variant("rs12", 12),
+                variant("rs0", 0), variant("rs13", 13), variant("rs3c", 3)]
+    for var in variants:
+        var["VARIATION"] = "p.X%sV" % var["SITE"]
+    mutations = [variant("MUT1", 5), variant("MUT2", 1)]
+    for var in mutations:
+        var["VARIATION"] = "p.X%sG" % var["SITE"]
+    table = ResidueTable("P00439", sequence, variants, mutations)
+    records = OrderedDict([("VARIANTS", variants), ("MUTATIONS", mutations)])
+    entities = OrderedDict()
+    residues = OrderedDict()
+    for site in range(1, len(sequence) + 1):
+        for key in records:
+            naive = [var for var in records[key] if int(var["SITE"]) == site]
+            assert table.count(key, site) == len(naive)
+            assert table.site_records(key, site) == naive
+        entities[str(site)] = OrderedDict([(key, [var["SOURCE"] for var in records[key] if int(var["SITE"]) == site])
+                                           for key in records])
+        residues[str(site)] = OrderedDict([("UNIPROT_ID", str(site)), ("UNIPROT_NAME", sequence[site - 1]),
+                                           ("UNIPROT_ACC", "P00439")])
+        for key in records:
+            for var in records[key]:
+                if int(var["SITE"]) == site:
+                    residues[str(site)]["%s:%s" % (var["SOURCE"], var["VARIATION"])] = sequence[site - 1]
+    assert len(table) == len(table.entities()) == len(sequence)
+    assert table.entities() == entities and table.residues() == residues
+    assert list(table.entities()) == list(entities)
+    assert table.entities()["3"]["VARIANTS"] == ["rs3", "rs3b", "rs3c"]
+    # out of range sites are not in the views
+    for site in ("0", "13", "x", None):
+        assert site not in table.residues()
+    try:
+        table.entities()["13"]
+        assert False
+    except KeyError:
+        pass
+    assert json.loads(json.dumps(table.residues(), default=serialize_table)) == json.loads(json.dumps(residues))
+
+    # VariantStore: de-duplication, provenance merge and index consistency
+    store = VariantStore([variant("rs1", 1), variant("rs2", 2), variant("rs1", 1, "ENST2")])
+    assert_indexed(store, ["rs1", "rs2"])
+    assert store[0]["ENSEMBL_TRANSCRIPTS"] == ["ENST1", "ENST2"]
+    assert variant("rs2", 2) in store and variant("rs2", 3) not in store
+    store.append(variant("rs3", 3))
+    store.append(variant("rs2", 2, "ENST3"))
+    store.extend([variant("rs4", 4), variant("rs1", 1)])
+    store += [variant("rs5", 5)]
+    assert_indexed(store, ["rs1", "rs2", "rs3", "rs4", "rs5"])
+    assert store.get(variant("rs2", 2))["ENSEMBL_TRANSCRIPTS"] == ["ENST1", "ENST3"]
+    store.insert(0, variant("rs0", 0))
+    store.insert(0, variant("rs3", 3))
+    assert_indexed(store, ["rs0", "rs1", "rs2", "rs3", "rs4", "rs5"])
+    assert store.pop()["SOURCE"] == "rs5" and store.pop(0)["SOURCE"] == "rs0"
+    assert_indexed(store, ["rs1", "rs2", "rs3", "rs4"])
+    store.remove(store[1])
+    del store[0]
+    assert_indexed(store, ["rs3", "rs4"])
+    store[0] = variant("rs6", 6)
+    store[1:1] = [variant("rs7", 7), variant("rs6", 6)]
+    assert_indexed(store, ["rs6", "rs7", "rs4"])
+    del store[:1]
+    store.sort(key=lambda var: var["SOURCE"])
+    assert_indexed(store, ["rs4", "rs7"])
+    store.reverse()
+    store *= 2
+    assert_indexed(store, ["rs7", "rs4"])
+    for other in (copy.copy(store), copy.deepcopy(store), pickle.loads(pickle.dumps(store, 2))):
+        assert isinstance(other, VariantStore)
+        assert_indexed(other, ["rs7", "rs4"])
+    assert json.loads(json.dumps(store)) == json.loads(json.dumps(list(store)))
@@ -2,11 +2,48 @@
 
 import os
 import sys
-import requests
+import json
 import time
+import codecs
+import requests
+import threading
+from array import array
 from datetime import datetime
+from urlparse import urljoin
 from collections import OrderedDict
 
+from scheduler import RequestScheduler
+
+# shared HTTP transport: one keep-alive connection pool per host
+http_pool_connections = 10
+http_pool_maxsize = 10
+# (connect, read) timeouts in seconds
+http_timeout = (5, 60)
+http_session = None
+http_session_lock = threading.Lock()
+
+# optional on-disk response cache (see cache.ResponseCache)
+response_cache = None
+
+# every outbound request is paced and retried by the scheduler
+request_scheduler = RequestScheduler()
+
+# optional local store of Ensembl protein sequences (see sequences.SequenceStore)
+sequence_store = None
+
+# optional local store of the results of each identifier (see results.ResultsStore)
+results_store = None
+
+# optional run metrics (see metrics.Metrics)
+metrics = None
+
+# where diagnostic messages (see flash) are written to
+diagnostics_output = sys.stdout
+
+# number of failed requests per identifier (see record_request_failure)
+request_failures = {}
+request_failures_lock = threading.Lock()
+
 
 def current_time():
     """
@@ -29,15 +66,29 @@ def current_time():
 
 def flash(message):
     """
-    Flashes a message out.
+    Flashes a message out (see set_diagnostics_output).
 
     @param message: input message str()
     """
 
     message = str(message)
 
-    print(message)
-    sys.stdout.flush()
+    diagnostics_output.write(message + "\n")
+    diagnostics_output.flush()
+    return
+
+
+def set_diagnostics_output(output):
+    """
+    Sets where diagnostic messages (warnings, errors and verbose messages)
+    are written to, e.g. sys.stderr when the records are written to stdout.
+
+    @param output: file object
+    """
+
+    global diagnostics_output
+    diagnostics_output = output
+
     return
 
 
@@ -88,95 +139,563 @@ def write_log(message, output_file):
     return
 
 
-def request_info_url(identifier, url, lines=False, verbose=True):
+def configure_http_session(pool_connections=None, pool_maxsize=None, timeout=None):
+    """
+    Configures the shared HTTP transport. Any existing session is
+    closed, so the new settings apply to the following requests.
+
+    @param pool_connections: number of hosts to keep connection pools for
+    @param pool_maxsize: maximum number of connections kept per host
+    @param timeout: (connect, read) timeouts in seconds
+    """
+
+    global http_pool_connections, http_pool_maxsize, http_timeout, http_session
+
+    with http_session_lock:
+        if pool_connections is not None:
+            http_pool_connections = pool_connections
+        if pool_maxsize is not None:
+            http_pool_maxsize = pool_maxsize
+        if timeout is not None:
+            http_timeout = timeout
+        if http_session is not None:
+            http_session.close()
+            http_session = None
+
+    return
+
+
+def get_http_session():
+    """
+    Gets the shared HTTP transport (a *requests* session), creating it
+    on first use. Connections are kept alive and reused across requests
+    and threads, and responses are gzip negotiated.
+
+    @return: returns a requests.Session
+    """
+
+    global http_session
+
+    with http_session_lock:
+        if http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=http_pool_connections,
+                                                    pool_maxsize=http_pool_maxsize,
+                                                    max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate",
+                                    "Connection": "keep-alive"})
+            http_session = session
+
+    return http_session
+
+
+def set_response_cache(cache):
+    """
+    Sets the response cache used by request_info_url.
+
+    @param cache: cache.ResponseCache object (None disables caching)
+    """
+
+    global response_cache
+    response_cache = cache
+
+    return
+
+
+def set_request_scheduler(scheduler):
+    """
+    Sets the scheduler used by request_info_url.
+
+    @param scheduler: scheduler.RequestScheduler object
+    """
+
+    global request_scheduler
+    request_scheduler = scheduler
+
+    return
+
+
+def set_sequence_store(store):
+    """
+    Sets the sequence store used by the Ensembl sequence fetchers.
+
+    @param store: sequences.SequenceStore object (None disables the store)
+    """
+
+    global sequence_store
+    sequence_store = store
+
+    return
+
+
+def get_sequence_store():
+    """Gets the sequence store used by the Ensembl sequence fetchers (or None)"""
+
+    return sequence_store
+
+
+def set_results_store(store):
+    """
+    Sets the results store used by CoreSEQUENCE (db=True).
+
+    @param store: results.ResultsStore object (None disables the store)
     """
-    Gets formatted content from the provided url.
 
-    If it fails, tries to access it a few more times to make sure it
-    was not a temporary error.
+    global results_store
+    results_store = store
+
+    return
+
+
+def get_results_store():
+    """Gets the results store used by CoreSEQUENCE (or None)"""
+
+    return results_store
+
+
+def set_metrics(run_metrics):
+    """
+    Sets the metrics the requests and CoreSEQUENCE stages are recorded in.
+
+    @param run_metrics: metrics.Metrics object (None disables the metrics)
+    """
+
+    global metrics
+    metrics = run_metrics
+
+    return
+
+
+def get_metrics():
+    """Gets the metrics the requests and CoreSEQUENCE stages are recorded in (or None)"""
+
+    return metrics
+
+
+def record_request_failure(identifier):
+    """
+    Records a request of an identifier that failed (server unreachable or
+    error status), so its results are known to be incomplete.
+
+    @param identifier: identifier the request was sent for
+    """
+
+    with request_failures_lock:
+        request_failures[identifier] = request_failures.get(identifier, 0) + 1
+
+    return
+
+
+def get_request_failures(identifier):
+    """Gets the number of failed requests of an identifier (since reset_request_failures)"""
+
+    with request_failures_lock:
+        return request_failures.get(identifier, 0)
+
+
+def reset_request_failures(identifier):
+    """Resets the failed requests of an identifier (e.g. when its run starts and ends)"""
+
+    with request_failures_lock:
+        request_failures.pop(identifier, None)
+
+    return
+
+
+def send_request(identifier, url, data=None, headers=None, stream=False, verbose=True):
+    """
+    Sends a request through the shared HTTP transport.
+
+    Requests are paced by the request scheduler and, if throttled or
+    temporarily unavailable, retried with backoff until the scheduler's
+    retry budget is exhausted.
+
+    @param identifier: identifier used for error handling
+    @param url: input URL
+    @param data: optional object POSTed as a JSON body (GET if None)
+    @param headers: optional request headers
+    @param stream: Boolean only the response headers are read (the body
+        is read by the caller, see request_stream_url)
+    @param verbose: Boolean
+    @return: returns a response object from *requests* or None if the
+        server could not be reached
+    """
+
+    session = get_http_session()
+    scheduler = request_scheduler
+    run_metrics = metrics
+    if run_metrics is not None:
+        start = time.time()
+    if data is not None:
+        headers = dict(headers or {})
+        headers["Content-Type"] = "application/json"
+        headers["Accept"] = "application/json"
+
+    attempt = 0
+    while True:
+        scheduler.acquire(url)
+        try:
+            if data is None:
+                req = session.get(url, headers=headers, timeout=http_timeout, stream=stream)
+            else:
+                req = session.post(url, data=json.dumps(data), headers=headers, timeout=http_timeout,
+                                   stream=stream)
+        except requests.exceptions.RequestException as error:
+            if scheduler.retry(url, None, attempt):
+                attempt += 1
+                continue
+            message = "%s\tError: Could not connect to %s (%s)..." % (identifier, url, error)
+            flash(message)
+            path = os.getcwd() + "/"
+            output_file = "e_url.log"
+            write_log(message, path + output_file)
+            record_request_failure(identifier)
+            if run_metrics is not None:
+                run_metrics.record_request(url, time.time() - start, retries=attempt)
+            return None
+        if verbose:
+            flash("%s %s" % (req.status_code, url))
+
+        # throttled or temporarily unavailable (or a gateway error): waits and tries again
+        if req.status_code == 429 or req.status_code == 502 or req.status_code == 503 or req.status_code == 504:
+            if scheduler.retry(url, req.headers, attempt):
+                # releases the connection of a streamed response
+                req.close()
+                attempt += 1
+                continue
+        else:
+            scheduler.update(url, req.headers)
+        break
+
+    if run_metrics is not None:
+        # the size of streamed responses is recorded once they are read
+        run_metrics.record_request(url, time.time() - start, size=0 if stream else len(req.content),
+                                   retries=attempt, status=req.status_code)
+
+    return req
+
+
+def request_info_url(identifier, url, lines=False, verbose=True, data=None, cached=True):
+    """
+    Gets formatted content from the provided url (see send_request).
 
     @param identifier: identifier used for error handling
     @param url: input URL
     @param lines: Boolean outputs either a list or a string
     @param verbose: Boolean
+    @param data: optional object POSTed as a JSON body (GET if None)
+    @param cached: Boolean uses the response cache (if set)
     @return: returns a data object from *requests*
     """
 
     info = ""
-    req = requests.get(url)
-    if verbose:
-        print req.status_code, url
+    cache = response_cache if cached else None
+    if cache is not None:
+        content = cache.get(url, data)
+        if content is not None:
+            if metrics is not None:
+                metrics.record_cached(url)
+            if verbose:
+                flash("cached %s" % url)
+            if lines:
+                return content.splitlines()
+            return content.decode("utf-8")
+
+    req = send_request(identifier, url, data=data, verbose=verbose)
+    if req is None:
+        if lines:
+            return []
+        return info
 
     if req.status_code == 200:
+        if cache is not None:
+            cache.set(url, req.content, data)
         if lines:
             info = [line for line in req.iter_lines()]
         else:
             info = req.text
-    elif req.status_code == 400 or req.status_code == 404 or req.status_code == 502:
+    elif req.status_code == 400 or req.status_code == 404:
+        # no data (e.g. an identifier unknown to the server)
         if lines:
             info = []
         else:
             info = ""
-    elif req.status_code == 429 or req.status_code == 503 or req.status_code == 504:
-        time.sleep(0.5)
-        request_info_url(identifier, url, lines=lines, verbose=verbose)
     else:
         status = req.status_code
         message = "%s\tError %s: Could not download the data from %s at this time..." % (identifier, status, url)
-        print(message)
+        record_request_failure(identifier)
+        flash(message)
         path = os.getcwd() + "/"
         output_file = "e_url.log"
         with open(path + output_file, "a") as outlog:
             outlog.write(message + "\n")
+        if lines:
+            info = []
 
     return info
 
 
-def uniprot_summary_mapping(entities_dict, residues_dict, form="plain"):
+def request_stream_url(identifier, url, chunk_size=64 * 1024, cached=True, verbose=True):
     """
-    Gets mappings of uniprot/domain/ptms/variants/features.
+    Gets the content of url as a stream of text chunks, read from the
+    socket as they arrive, so large responses are never held in memory
+    as a whole (see request_info_url). If the connection is lost midway,
+    the request is sent again (within the scheduler's retry budget) and
+    the part of the response already streamed is skipped.
 
-    @param entities_dict: Dictionary of dictionaries containing information
-    per residue.
-    @param residues_dict: Dictionary of dictionaries containing information
-    per residue.
+    @param identifier: identifier used for error handling
+    @param url: input URL
+    @param chunk_size: size of the chunks read from the socket, in bytes
+    @param cached: Boolean uses the response cache (if set)
+    @param verbose: Boolean
+    @return: yields unicode str() chunks (none if the data could not be downloaded)
+    """
+
+    cache = response_cache if cached else None
+    if cache is not None:
+        inputfile = cache.open(url)
+        if inputfile is not None:
+            if metrics is not None:
+                metrics.record_cached(url)
+            if verbose:
+                flash("cached %s" % url)
+            # cached bodies are also streamed in chunks
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            with inputfile:
+                for raw in iter(lambda: inputfile.read(chunk_size), ""):
+                    text = decoder.decode(raw)
+                    if text:
+                        yield text
+            text = decoder.decode("", True)
+            if text:
+                yield text
+            return
+
+    # number of characters already streamed
+    streamed = 0
+    attempt = 0
+    while True:
+        req = send_request(identifier, url, stream=True, verbose=verbose)
+        if req is None:
+            return
+
+        if req.status_code != 200:
+            req.close()
+            # 400/404: no data, other statuses (e.g. 5xx) make the results incomplete
+            if req.status_code != 400 and req.status_code != 404:
+                status = req.status_code
+                message = "%s\tError %s: Could not download the data from %s at this time..." % \
+                          (identifier, status, url)
+                record_request_failure(identifier)
+                flash(message)
+                path = os.getcwd() + "/"
+                output_file = "e_url.log"
+                write_log(message, path + output_file)
+            return
+
+        # the body is written to the cache as it arrives (if it is to be cached)
+        writer = cache.writer(url) if cache is not None else None
+        decoder = codecs.getincrementaldecoder(req.encoding or "utf-8")(errors="replace")
+        position = 0
+        size = 0
+        complete = False
+        try:
+            try:
+                for raw in req.iter_content(chunk_size):
+                    size += len(raw)
+                    if writer is not None:
+                        writer.write(raw)
+                    text = decoder.decode(raw)
+                    start = position
+                    position += len(text)
+                    if position > streamed:
+                        yield text[max(0, streamed - start):]
+                        streamed = position
+                text = decoder.decode("", True)
+                if position + len(text) > streamed:
+                    yield text[max(0, streamed - position):]
+                complete = True
+            finally:
+                req.close()
+                if metrics is not None:
+                    metrics.record_bytes(url, size)
+                # incomplete bodies (lost connections, streams closed midway) are not cached
+                if writer is not None:
+                    if complete:
+                        writer.commit()
+                    else:
+                        writer.discard()
+        except requests.exceptions.RequestException as error:
+            if request_scheduler.retry(url, None, attempt):
+                attempt += 1
+                continue
+            message = "%s\tError: Lost the connection to %s (%s)..." % (identifier, url, error)
+            record_request_failure(identifier)
+            flash(message)
+            path = os.getcwd() + "/"
+            output_file = "e_url.log"
+            write_log(message, path + output_file)
+            # the content streamed so far is incomplete
+            raise IOError(message)
+
+        return
+
+
+def request_conditional_url(identifier, url, etag=None, last_modified=None, verbose=True):
+    """
+    Gets the content of url only if it changed since a previous response,
+    with an HTTP conditional request (If-None-Match/If-Modified-Since), or
+    unconditionally if there are no validators, along with the response
+    headers (e.g. to record the validators). The response cache is not used.
+
+    @param identifier: identifier used for error handling
+    @param url: input URL
+    @param etag: ETag of the previous response
+    @param last_modified: Last-Modified of the previous response
+    @param verbose: Boolean
+    @return: returns the status code (None if the request failed), the
+        content str() (None unless 200) and the response headers
+    """
+
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+
+    req = send_request(identifier, url, headers=headers, verbose=verbose)
+    if req is None:
+        return None, None, {}
+
+    content = None
+    if req.status_code == 200:
+        content = req.content
+
+    return req.status_code, content, req.headers
+
+
+def next_page_url(url, headers):
+    """
+    Gets the URL of the next page of a paginated response (e.g. UniProt).
+
+    @param url: URL of the current page (relative links are resolved against it)
+    @param headers: response headers
+    @return: returns the URL of the Link rel="next" header, or None if it was the last page
+    """
+
+    for link in requests.utils.parse_header_links(headers.get("Link", "")):
+        if link.get("rel") == "next":
+            return urljoin(url, link.get("url"))
+
+    return None
+
+
+def site_counts(length, sites):
+    """
+    Counts the records at each residue of a sequence.
+
+    @param length: sequence length
+    @param sites: iterable of sequence sites (1-based int)
+    @return: returns an array of counts per residue
+    """
+
+    counts = array("l", [0]) * length
+    for site in sites:
+        if 0 < site <= length:
+            counts[site - 1] += 1
+
+    return counts
+
+
+def presence_track(length, sites, symbol):
+    """
+    Gets an 'alignment' track with a symbol at each site and '-' elsewhere.
+
+    @param length: sequence length
+    @param sites: iterable of sequence sites (1-based int)
+    @param symbol: symbol str() used at the sites
+    @return: returns a str() track
+    """
+
+    track = bytearray("-" * length)
+    code = ord(symbol)
+    for site in sites:
+        if 0 < site <= length:
+            track[site - 1] = code
+
+    return str(track)
+
+
+def density_track(counts, window):
+    """
+    Gets the mean number of records per residue over a sliding window
+    (centered at each residue and truncated at the sequence ends).
+
+    @param counts: array of counts per residue
+    @param window: window size in residues
+    @return: returns a list of floats
+    """
+
+    length = len(counts)
+    prefix = array("l", [0]) * (length + 1)
+    total = 0
+    for i, count in enumerate(counts):
+        total += count
+        prefix[i + 1] = total
+
+    half = window // 2
+    density = []
+    for i in xrange(length):
+        start = max(0, i - half)
+        end = min(length, i - half + window)
+        density.append(round(float(prefix[end] - prefix[start]) / (end - start), 3))
+
+    return density
+
+
+def uniprot_summary_mapping(sequence, variant_sites, mutation_sites, tracks=None, window=15, form="plain"):
+    """
+    Gets mappings of uniprot/domain/ptms/variants/features. Tracks are
+    built in bulk from the sequence and the variant/mutation sites, with
+    no per residue entries needed.
+
+    @param sequence: UNIPROT sequence
+    @param variant_sites: iterable of variant sites (1-based int)
+    @param mutation_sites: iterable of mutation sites (1-based int)
+    @param tracks: extra tracks: "VARIANT_COUNTS", "MUTATION_COUNTS" (records
+        per residue), "VARIANT_DENSITY" and "MUTATION_DENSITY" (mean records
+        per residue over a sliding window)
+    @param window: window size (in residues) of the density tracks
     @param form: output format
     @return: returns a dictionary of 'alignments'
     """
 
-    assert len(entities_dict) == len(residues_dict)
-
-    # get feature entries that appear in the residues entries
     # get a 'alignment' view of residues, ss and domains
     # all under a dictionary structure
     maps = OrderedDict()
+    length = len(sequence)
 
     # RES all
-    fet_align = ""
-    for res in residues_dict:
-        try:
-            fet_align += residues_dict[res]["UNIPROT_NAME"]
-        except:
-            fet_align += "-"
-    maps["UNIPROT_NAME"] = fet_align
-
-    # Variants
-    fet_align = ""
-    for res in entities_dict:
-        if entities_dict[res]["VARIANTS"] != []:
-            fet_align += "V"
-        else:
-            fet_align += "-"
-    maps["VARIANTS"] = fet_align
-
-    # Mutations
-    fet_align = ""
-    for res in entities_dict:
-        if entities_dict[res]["MUTATIONS"] != []:
-            fet_align += "M"
-        else:
-            fet_align += "-"
-    maps["MUTATIONS"] = fet_align
+    maps["UNIPROT_NAME"] = sequence
+
+    # Variants and Mutations
+    maps["VARIANTS"] = presence_track(length, variant_sites, "V")
+    maps["MUTATIONS"] = presence_track(length, mutation_sites, "M")
+
+    if tracks:
+        counts = OrderedDict()
+        counts["VARIANT"] = site_counts(length, variant_sites)
+        counts["MUTATION"] = site_counts(length, mutation_sites)
+        for track in tracks:
+            kind, _, measure = track.partition("_")
+            if kind not in counts or measure not in ("COUNTS", "DENSITY"):
+                raise ValueError("Unknown summary track %s..." % track)
+            if measure == "COUNTS":
+                maps[track] = counts[kind].tolist()
+            else:
+                maps[track] = density_track(counts[kind], window)
 
     if form is "plain":
         print(maps)